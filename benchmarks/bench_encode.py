@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+
+# size-targeted encoder vs the original crop_and_encode resize loop
+#
+#   python benchmarks/bench_encode.py --images 'data/pages/*.jpg'
+#
+# Reports time, number of encodes and output size per image for both, so
+# speed and how close each gets to the 3.2MB budget can be compared. Without
+# --images, synthetic newsprint-like pages are generated. Each page is also
+# cut to the --crops sizes, since most LLM requests send a region (an ad, a
+# comic) rather than the whole page.
+
+import argparse
+import base64
+import glob
+import io
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFilter
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+import encoding
+
+legacy_encodes = 0
+
+
+def encode_img(image):
+    global legacy_encodes
+    legacy_encodes += 1
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG', quality=95, optimize=True, subsampling=0)
+    buffer.seek(0)
+    return base64.b64encode(buffer.read()).decode("utf-8")
+
+
+def legacy_encode(img, max_file_size=encoding.MAX_FILE_SIZE):
+    """crop_and_encode's loop before the size-targeted encoder"""
+    max_size = 4000
+    image_encode = encode_img(img)
+    if len(image_encode) <= max_file_size:
+        return image_encode
+    while max_size >= 100:
+        width, height = img.size
+        scale = max_size / max(width, height)
+        if scale >= 1:
+            resized_img = img
+        else:
+            resized_img = img.resize((int(width * scale), int(height * scale)), Image.LANCZOS)
+        image_encode = encode_img(resized_img)
+        if len(image_encode) <= max_file_size:
+            return image_encode
+        size_ratio = max_file_size / len(image_encode)
+        max_size = int(max_size * (size_ratio ** 0.5) * 0.93)
+    return image_encode
+
+
+def synthetic_page(seed, size):
+    """Columns of 'text' lines and a few grey boxes over scanner noise"""
+    rng = np.random.default_rng(seed)
+    w, h = size
+    noise = rng.normal(225, 12, (h, w)).clip(0, 255).astype(np.uint8)
+    page = Image.fromarray(noise).convert('RGB')
+    draw = ImageDraw.Draw(page)
+    for col in range(5):
+        x0 = int(w * (0.03 + col * 0.19))
+        for y in range(int(h * 0.08), h - 40, 22):
+            for x in range(x0, x0 + int(w * 0.17), 12):
+                if rng.random() < 0.8:
+                    draw.rectangle((x, y, x + rng.integers(4, 11), y + 12), fill=(30, 30, 30))
+    for _ in range(4):
+        x, y = int(rng.integers(0, w - 600)), int(rng.integers(0, h - 600))
+        draw.rectangle((x, y, x + 500, y + 500), fill=tuple([int(rng.integers(80, 200))] * 3))
+    return page.filter(ImageFilter.GaussianBlur(0.6))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark crop_and_encode encoders')
+    parser.add_argument('--images', help='glob of page images')
+    parser.add_argument('--pages', type=int, default=6)
+    parser.add_argument('--size', type=int, nargs=2, default=[5000, 7000], metavar=('W', 'H'))
+    parser.add_argument('--crops', nargs='*', default=['1000x1000', '2000x1500', '3000x2500'],
+                        help='WxH regions cut from the middle of each page (none to skip)')
+    args = parser.parse_args()
+
+    if args.images:
+        pages = [Image.open(f).convert('RGB') for f in sorted(glob.glob(args.images))[:args.pages]]
+    else:
+        pages = [synthetic_page(i, args.size) for i in range(args.pages)]
+
+    images = []
+    for i, page in enumerate(pages):
+        page.load()
+        images.append((f'{i}', page))
+        for crop in args.crops:
+            w, h = (int(v) for v in crop.split('x'))
+            x, y = max(0, (page.size[0] - w) // 2), max(0, (page.size[1] - h) // 2)
+            images.append((f'{i}:{crop}', page.crop((x, y, x + w, y + h))))
+
+    # per image size: {encoder: [sec, encodes, MB, count]}
+    totals = {}
+    print("image\t\tencoder\t\tsec\tencodes\tMB")
+    for name, img in images:
+        size = name.split(':')[1] if ':' in name else 'page'
+        by_encoder = totals.setdefault(size, {'legacy': [0, 0, 0, 0], 'targeted': [0, 0, 0, 0]})
+
+        legacy_encodes = 0
+        start = time.perf_counter()
+        out = legacy_encode(img)
+        row = [time.perf_counter() - start, legacy_encodes, len(out) / 1024 ** 2, 1]
+        print(f"{name:<12}\tlegacy\t\t{row[0]:.3f}\t{row[1]}\t{row[2]:.2f}")
+        by_encoder['legacy'] = [a + b for a, b in zip(by_encoder['legacy'], row)]
+
+        encoding.encode_stats['encodes'] = 0
+        start = time.perf_counter()
+        out = encoding.encode_to_budget(img)
+        row = [time.perf_counter() - start, encoding.encode_stats['encodes'], len(out) / 1024 ** 2, 1]
+        print(f"{name:<12}\ttargeted\t{row[0]:.3f}\t{row[1]}\t{row[2]:.2f}")
+        by_encoder['targeted'] = [a + b for a, b in zip(by_encoder['targeted'], row)]
+        if len(out) > encoding.MAX_FILE_SIZE:
+            print(f"{name:<12}\ttargeted output over budget!")
+
+    print("\ntotal\t\tencoder\t\tmean sec\tencodes\tmean MB")
+    for size, by_encoder in totals.items():
+        for encoder, (sec, encodes, mb, count) in by_encoder.items():
+            print(f"{size:<12}\t{encoder:<8}\t{sec / count:.3f}\t\t{encodes}\t{mb / count:.2f}")
+        print(f"{size:<12}\tspeedup: {by_encoder['legacy'][0] / by_encoder['targeted'][0]:.2f}x")
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+
+# json_extract.extract_json vs the original decode_message/fix_json_values
+#
+#   python benchmarks/bench_json_extract.py
+#   python benchmarks/bench_json_extract.py --fixtures /shared-output/llm_responses.jsonl
+#
+# Runs each response in the fixture corpus (JSONL of {"stage", "response"};
+# worker.py appends real ones when LLM_RECORD_FILE is set) through both
+# parsers, lists the responses where they disagree, and times both - per
+# response and on item lists of growing length, clean, truncated, and with
+# braces inside string values (where the old nested scan goes quadratic),
+# counting how many items each recovers.
+
+import argparse
+import json
+import logging
+import re
+import sys
+import time
+from pathlib import Path
+
+from json_repair import repair_json
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+import json_extract
+
+logging.disable(logging.WARNING)
+
+
+def fix_json_values(text):
+    try:
+        text = repair_json(text)
+        return text
+    except Exception as e:
+        text = re.sub(r'("[^"]+"):\s*([0-9]+[A-Za-z][A-Za-z0-9]*)', r'\1: "\2"', text)
+        text = re.sub(r',(\s*[}\]])', r'\1', text)
+        return text
+
+
+def legacy_decode(text):
+    """worker.py's decode_message before json_extract"""
+    to_strip = [r'json\n', '<|end_of_box|>', '<|start_of_box|>','<|begin_of_box|>',
+                '<think>', '</think>', '```json', '```']
+    for t in to_strip:
+        text = text.strip().replace(t, '')
+    cleaned = text.replace('\n', '').strip()
+    if cleaned and cleaned[0] != '{':
+        cleaned = '{' + cleaned
+    if cleaned and not cleaned.endswith('}'):
+        cleaned = cleaned + '}'
+    for i, char in enumerate(cleaned):
+        if char == '{':
+            bracket_count = 0
+            for j in range(i, len(cleaned)):
+                if cleaned[j] == '{':
+                    bracket_count += 1
+                elif cleaned[j] == '}':
+                    bracket_count -= 1
+                    if bracket_count == 0:
+                        candidate = cleaned[i:j+1]
+                        try:
+                            return json.loads(candidate)
+                        except json.JSONDecodeError:
+                            try:
+                                return json.loads(fix_json_values(candidate))
+                            except json.JSONDecodeError:
+                                return {"error": "Badly formed JSON response"}
+    return {"error": "Badly formed JSON response"}
+
+
+def legacy_query(msg):
+    """llm_query's json.loads then decode_message"""
+    try:
+        return json.loads(msg)
+    except json.JSONDecodeError:
+        return legacy_decode(msg)
+
+
+def timed(fn, text, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn(text)
+    return (time.perf_counter() - start) / repeat
+
+
+def unusable(result):
+    # a list (or string) result made llm_query fail on result['model'] and retry
+    return not isinstance(result, dict) or result == {"error": "Badly formed JSON response"}
+
+
+def item_list(n, summary='The council voted to raise the activity fee.', truncate=False):
+    item = json.dumps({"category": "campus news", "title": "Senate approves fee",
+                       "subject": "student government", "summary": summary, "confidence": 0.86})
+    text = '"items": [' + ', '.join([item] * n) + ']}'
+    # cut off mid-item, as when the model hits its token limit
+    return text[:-60] if truncate else text
+
+
+def item_count(result):
+    items = result.get('items') if isinstance(result, dict) else None
+    return len(items) if isinstance(items, list) else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark LLM response JSON extraction')
+    parser.add_argument('--fixtures', default=str(Path(__file__).parent / 'fixtures' / 'llm_responses.jsonl'))
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--lengths', type=int, nargs='+', default=[50, 200, 800])
+    args = parser.parse_args()
+
+    with open(args.fixtures) as f:
+        fixtures = [json.loads(line) for line in f if line.strip()]
+
+    totals = {'legacy': 0.0, 'extract': 0.0}
+    failed = {'legacy': 0, 'extract': 0}
+    print("n\tstage\tlegacy ms\textract ms\tresult")
+    for n, fx in enumerate(fixtures):
+        text = fx['response']
+        old, new = legacy_query(text), json_extract.extract_json(text)
+        old_t, new_t = timed(legacy_query, text, args.repeat), timed(json_extract.extract_json, text, args.repeat)
+        totals['legacy'] += old_t
+        totals['extract'] += new_t
+        failed['legacy'] += unusable(old)
+        failed['extract'] += unusable(new)
+        result = 'same' if old == new else 'differs'
+        print(f"{n}\t{fx['stage']}\t{old_t * 1000:.3f}\t\t{new_t * 1000:.3f}\t\t{result}")
+        if old != new:
+            print(f"\tlegacy:  {json.dumps(old)[:160]}\n\textract: {json.dumps(new)[:160]}")
+
+    print(f"\n{len(fixtures)} responses: legacy {totals['legacy'] * 1000:.2f}ms "
+          f"({failed['legacy']} unusable), extract {totals['extract'] * 1000:.2f}ms "
+          f"({failed['extract']} unusable)")
+
+    cases = [('clean', {}), ('truncated', {'truncate': True}),
+             ('"{" in text', {'summary': 'Fee {sic raised.'})]
+    print("\nitem list\tn\tchars\tlegacy ms\titems\textract ms\titems")
+    for name, kwargs in cases:
+        for n in args.lengths:
+            text = item_list(n, **kwargs)
+            old_t, new_t = timed(legacy_query, text, 1), timed(json_extract.extract_json, text, 1)
+            print(f"{name:<12}\t{n}\t{len(text)}\t{old_t * 1000:.1f}\t\t{item_count(legacy_query(text))}"
+                  f"\t{new_t * 1000:.1f}\t\t{item_count(json_extract.extract_json(text))}")
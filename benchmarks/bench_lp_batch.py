@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+
+# pages/sec for layout detection by batch size (CPU by default)
+#
+#   python benchmarks/bench_lp_batch.py --images 'data/pages/*.jpg' --batch-sizes 1 2 4 8
+#
+# Without --images, synthetic pages of --size are used; they exercise the same
+# resize/forward path but find no boxes, so use real pages for final numbers.
+
+import argparse
+import glob
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import layoutparser as lp
+from PIL import Image
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+import layout
+
+
+def load_pages(pattern, count, size):
+    if pattern:
+        files = sorted(glob.glob(pattern))[:count]
+        return [np.array(Image.open(f).convert('RGB')) for f in files]
+    rng = np.random.default_rng(0)
+    w, h = size
+    return [rng.integers(0, 255, (h, w, 3), dtype=np.uint8) for _ in range(count)]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark batched layout detection')
+    parser.add_argument('--config', default='/shared-output/config.yml')
+    parser.add_argument('--model', default='/shared-output/model_final.pth')
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--images', help='glob of page images')
+    parser.add_argument('--pages', type=int, default=16)
+    parser.add_argument('--size', type=int, nargs=2, default=[2500, 3500], metavar=('W', 'H'))
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 2, 4, 8])
+    args = parser.parse_args()
+
+    lp_model = lp.models.Detectron2LayoutModel(
+        config_path=args.config,
+        model_path=args.model,
+        extra_config=["MODEL.ROI_HEADS.SCORE_THRESH_TEST", 0.5],
+        device=args.device
+    )
+    pages = load_pages(args.images, args.pages, args.size)
+    print(f"{len(pages)} pages on {args.device}")
+
+    # warm up so the first batch size doesn't pay for lazy init
+    layout.detect_batch(lp_model, pages[:1], batch_size=1)
+
+    baseline = None
+    print("batch\tsec\tpages/sec\tspeedup")
+    for batch_size in args.batch_sizes:
+        start = time.perf_counter()
+        layouts = layout.detect_batch(lp_model, pages, batch_size=batch_size)
+        elapsed = time.perf_counter() - start
+        rate = len(pages) / elapsed
+        baseline = baseline or rate
+        print(f"{batch_size}\t{elapsed:.1f}\t{rate:.2f}\t\t{rate / baseline:.2f}x")
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+# local stand-in for the Islandora REST solr endpoint, for trying
+# nrp-and-redis/full-solr-query.py without touching the production server
+#
+#   python benchmarks/stub_solr.py --pids 20000 --latency 0.05
+#   python nrp-and-redis/full-solr-query.py --url http://localhost:8983 --namespace test --max-pid 20000
+#
+# Serves a synthetic namespace of page PIDs 1..--pids, with some deleted
+# (never returned), some hidden from prefix queries (only found by the
+# leftover PID lookups, like the items the old harvester had to scoop up) and
+# some books. Supports the queries the harvester sends: PID prefix with
+# cursorMark paging sorted on PID, and PID:("a" OR "b" ...) lookups.
+
+import re
+import json
+import time
+import random
+import argparse
+from urllib.parse import urlparse, unquote, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+PREFIX = re.compile(r'PID:(\w+)\\:(\d+)\*')
+LOOKUP = re.compile(r'PID:\((.*?)\)')
+
+
+def build_corpus(namespace, n, seed):
+    rng = random.Random(seed)
+    docs = {}
+    hidden = set()
+    for i in range(1, n + 1):
+        roll = rng.random()
+        if roll < 0.02:
+            continue  # deleted
+        pid = f'{namespace}:{i}'
+        model = 'info:fedora/islandora:bookCModel' if roll < 0.03 else 'info:fedora/islandora:pageCModel'
+        docs[pid] = {'PID': pid, 'RELS_EXT_hasModel_uri_ms': [model],
+                     'mods_identifier_local_displayLabel_ms': [f'udk_{1900 + i % 100}/{i}']}
+        if roll > 0.99:
+            hidden.add(pid)
+    return docs, hidden
+
+
+class Handler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        url = urlparse(self.path)
+        query = unquote(url.path.split('/v1/solr/', 1)[-1])
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+        pages_only = 'pageCModel' in query
+        docs = [d for d in self.server.docs.values()
+                if not pages_only or 'pageCModel' in d['RELS_EXT_hasModel_uri_ms'][0]]
+        body = {}
+
+        m, lookup = PREFIX.search(query), LOOKUP.search(query)
+        if m:
+            prefix = f'{m.group(1)}:{m.group(2)}'
+            docs = sorted((d for d in docs if d['PID'].startswith(prefix)
+                           and d['PID'] not in self.server.hidden), key=lambda d: d['PID'])
+            cursor = params.get('cursorMark', '*')
+            if cursor != '*':
+                docs = [d for d in docs if d['PID'] > cursor]
+            docs = docs[:int(params.get('rows', 10))]
+            body['nextCursorMark'] = docs[-1]['PID'] if docs else cursor
+        elif lookup:
+            wanted = set(re.findall(r'"([^"]+)"', lookup.group(1)))
+            docs = [d for d in docs if d['PID'] in wanted]
+        else:
+            docs = []
+        body['response'] = {'numFound': len(docs), 'docs': docs}
+
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Stub Islandora solr endpoint')
+    parser.add_argument('--port', type=int, default=8983)
+    parser.add_argument('--namespace', default='test')
+    parser.add_argument('--pids', type=int, default=20000)
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds added to each request')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(('localhost', args.port), Handler)
+    server.docs, server.hidden = build_corpus(args.namespace, args.pids, args.seed)
+    server.latency = args.latency
+    pages = sum('pageCModel' in d['RELS_EXT_hasModel_uri_ms'][0] for d in server.docs.values())
+    print(f"Serving {pages} page PIDs ({len(server.hidden)} hidden from prefix queries) on port {args.port}")
+    server.serve_forever()
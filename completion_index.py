@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+# persistent index of which pids each stage has completed, for populate-queue.py
+#
+# One row per (stream, pid) holding a bitmask of which tracked fields came
+# back with a value (for pages: page, date, volume, number), so both "every
+# pid with a pages row" (OPTION A) and "pids missing page/date/volume/number"
+# (OPTION B) are a single indexed query instead of a re-scan of every csv.
+#
+# consolidate.py keeps /shared-output/consolidated/completed.sqlite up to
+# date; locally, output files can be added to an index (only new ones are read):
+#   python completion_index.py 'data/*' --db data/completed.sqlite
+#
+# A file counts for a stream only if its name starts with the stream
+# (pages_<worker>_..., merged_data_pages_<year>.csv); lp_pages_* files have a
+# pid column too but say nothing about the LLM pages stage.
+
+import os
+import re
+import glob
+import sqlite3
+import logging
+import argparse
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# fields whose presence is tracked per stream, bit 0 first
+TRACKED = {'pages': ['page', 'date', 'volume', 'number']}
+
+
+def open_index(path):
+    conn = sqlite3.connect(path)
+    conn.execute('''CREATE TABLE IF NOT EXISTS completed (
+        stream TEXT, pid TEXT, fields INTEGER, PRIMARY KEY (stream, pid)) WITHOUT ROWID''')
+    conn.execute('CREATE TABLE IF NOT EXISTS loaded_files (name TEXT PRIMARY KEY, mtime REAL)')
+    return conn
+
+
+def field_mask(stream, fields):
+    return sum(1 << TRACKED[stream].index(f) for f in fields)
+
+
+def record(conn, stream, df):
+    """Mark df's pids complete for stream; a pid's newer results replace its older entry"""
+    tracked = TRACKED.get(stream, [])
+    flags = pd.DataFrame({'pid': df['pid'].astype(str).str.strip()})
+    for field in tracked:
+        if field in df:
+            flags[field] = df[field].notna() & (df[field].astype(str).str.strip() != '')
+        else:
+            flags[field] = False
+    per_pid = flags.groupby('pid').any()
+    masks = sum((per_pid[f].astype(int) * (1 << bit) for bit, f in enumerate(tracked)),
+                pd.Series(0, index=per_pid.index))
+    with conn:
+        conn.executemany('INSERT OR REPLACE INTO completed VALUES (?, ?, ?)',
+                         ((stream, pid, int(mask)) for pid, mask in masks.items()))
+    return len(masks)
+
+
+def read_results(fn, stream):
+    columns = ['pid'] + TRACKED.get(stream, [])
+    if fn.endswith('.parquet'):
+        df = pd.read_parquet(fn)
+    else:
+        # a real csv parser: titles and summaries contain quoted commas
+        df = pd.read_csv(fn, dtype=str, usecols=lambda c: c in columns)
+    return df[[c for c in columns if c in df]]
+
+
+def is_stream_file(fn, stream):
+    """True for a worker shard or consolidated csv of stream, by file name"""
+    return re.match(r'^(merged_data_)?%s(_.+)?\.(csv|parquet)$' % re.escape(stream), os.path.basename(fn)) is not None
+
+
+def update_from_files(conn, files, stream):
+    """Record stream's result files (csv or parquet) not already in the index, oldest first"""
+    loaded = {row[0] for row in conn.execute('SELECT name FROM loaded_files')}
+    new_files = sorted((f for f in files if is_stream_file(f, stream)
+                        and os.path.basename(f) not in loaded), key=os.path.getmtime)
+    for fn in new_files:
+        try:
+            df = read_results(fn, stream)
+        except pd.errors.EmptyDataError:
+            df = pd.DataFrame(columns=['pid'])
+        if 'pid' not in df:
+            logger.warning(f"No pid column in {fn}, skipping")
+            continue
+        record(conn, stream, df.dropna(subset=['pid']))
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO loaded_files VALUES (?, ?)',
+                         (os.path.basename(fn), os.path.getmtime(fn)))
+    logger.info(f"Indexed {len(new_files)} new {stream} files ({len(loaded)} already indexed)")
+
+
+def completed(conn, stream, fields=None, require_all=False):
+    """Pids with a stream result; with fields, only those with any (or all) of them"""
+    if not fields:
+        rows = conn.execute('SELECT pid FROM completed WHERE stream = ?', (stream,))
+    elif require_all:
+        mask = field_mask(stream, fields)
+        rows = conn.execute('SELECT pid FROM completed WHERE stream = ? AND fields & ? = ?',
+                            (stream, mask, mask))
+    else:
+        rows = conn.execute('SELECT pid FROM completed WHERE stream = ? AND fields & ? != 0',
+                            (stream, field_mask(stream, fields)))
+    return {row[0] for row in rows}
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description='Build/update the per-stage completed pid index')
+    parser.add_argument('pattern', nargs='?', default='data/*')
+    parser.add_argument('--db', default='data/completed.sqlite')
+    parser.add_argument('--stream', default='pages')
+    args = parser.parse_args()
+    conn = open_index(args.db)
+    update_from_files(conn, glob.glob(args.pattern), args.stream)
+    for stream, count in conn.execute('SELECT stream, COUNT(*) FROM completed GROUP BY stream'):
+        logger.info(f"{stream}: {count} pids complete")
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+
+# incremental consolidation of worker output shards on the PVC
+#
+#   python consolidate.py --src /shared-output --out /shared-output/consolidated
+#
+# Worker shards (pages_<pod>_<time>.parquet, the older .csv, ...) are merged
+# into one parquet file per stream and year:
+#   <out>/<stream>/year=<year>/data.parquet
+# The year comes from the page identifier's date range. A manifest
+# (<out>/manifest.sqlite) records every shard already merged, so a run only
+# reads new shards (in parallel) and only rewrites the partitions they touch.
+# Nothing has to be moved to already-downloaded/ to avoid merging it twice.
+#
+# A re-processed pid replaces its earlier rows: the newest shard holding the
+# pid wins. Within it, rows are deduplicated on pid plus box coordinates
+# (ads, editorial comics, LP boxes) or pid alone (pages).
+#
+# The pids each stream now covers are recorded in <out>/completed.sqlite
+# (see completion_index.py) for populate-queue.py.
+
+import os
+import re
+import time
+import sqlite3
+import logging
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import result_writer
+import completion_index
+
+logger = logging.getLogger(__name__)
+
+STREAMS = list(result_writer.SCHEMAS)
+BOX = ['x_1', 'y_1', 'x_2', 'y_2']
+# columns besides pid that identify a row; None = keep every row of the winning shard
+DEDUP_KEYS = {'lp_items': BOX, 'lp_pages': [], 'ads': BOX, 'ed_comics': BOX, 'pages': [],
+              'llm_items': None, 'errors': None}
+SHARD = re.compile(r'^(%s)_.+\.(parquet|csv)$' % '|'.join(STREAMS))
+# a year on its own (udk_01-05-1906_...) or leading a YYYYMMDD date (udk-x-19060723-...)
+YEAR = re.compile(r'(?<!\d)(1[89]\d\d|20\d\d)(?:[01]\d[0-3]\d)?(?!\d)')
+
+
+def open_manifest(out_dir):
+    conn = sqlite3.connect(os.path.join(out_dir, 'manifest.sqlite'))
+    conn.execute('''CREATE TABLE IF NOT EXISTS merged_files (
+        name TEXT PRIMARY KEY, stream TEXT, mtime REAL, rows INTEGER, merged_at REAL)''')
+    return conn
+
+
+def new_shards(src_dir, conn, streams):
+    """[(stream, path, mtime)] not in the manifest, oldest first"""
+    merged = {row[0] for row in conn.execute('SELECT name FROM merged_files')}
+    shards = []
+    for entry in os.scandir(src_dir):
+        m = SHARD.match(entry.name)
+        if m and m.group(1) in streams and entry.name not in merged:
+            shards.append((m.group(1), entry.path, entry.stat().st_mtime))
+    logger.info(f"{len(shards)} new shards ({len(merged)} already merged)")
+    return sorted(shards, key=lambda s: (s[2], s[1]))
+
+
+def read_shard(stream, path):
+    """A shard as a table with the stream's schema (old csv shards are fitted to it)"""
+    schema = result_writer.SCHEMAS[stream]
+    if path.endswith('.parquet'):
+        table = pq.read_table(path)
+        if table.schema.equals(schema):
+            return table
+        rows = table.to_pylist()
+    else:
+        try:
+            # read as text so ids and page numbers keep their form; fit_row converts
+            rows = pd.read_csv(path, dtype=str).to_dict('records')
+        except pd.errors.EmptyDataError:
+            rows = []
+    return pa.Table.from_pylist([result_writer.fit_row(row, schema) for row in rows], schema=schema)
+
+
+def year_of(identifier):
+    m = YEAR.search(identifier) if isinstance(identifier, str) else None
+    return m.group(1) if m else 'unknown'
+
+
+def dedup(stream, df):
+    """Last writer wins: rows from the newest shard per pid, then unique per key"""
+    df = df[df['_order'] == df.groupby('pid')['_order'].transform('max')]
+    keys = DEDUP_KEYS[stream]
+    if keys is not None:
+        df = df.drop_duplicates(subset=['pid'] + keys, keep='last')
+    return df
+
+
+def partition_path(out_dir, stream, year):
+    return os.path.join(out_dir, stream, f'year={year}', 'data.parquet')
+
+
+def merge_partition(out_dir, stream, year, new_rows, csv=False):
+    """Rewrite one partition with new_rows replacing any earlier rows for their pids"""
+    schema = result_writer.SCHEMAS[stream]
+    path = partition_path(out_dir, stream, year)
+    frames = []
+    if os.path.exists(path):
+        existing = pq.read_table(path).to_pandas()
+        existing['_order'] = -1
+        frames.append(existing)
+    frames.append(new_rows)
+    df = dedup(stream, pd.concat(frames, ignore_index=True))
+    df = df.drop(columns=['_order', '_year']).sort_values('pid', kind='stable')
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = os.path.join(os.path.dirname(path), '.tmp-data.parquet')
+    pq.write_table(pa.Table.from_pandas(df, schema=schema, preserve_index=False), tmp, compression='zstd')
+    os.replace(tmp, path)
+    if csv:
+        df.to_csv(os.path.join(out_dir, f'merged_data_{stream}_{year}.csv'), index=False)
+    return len(df)
+
+
+def consolidate(src_dir, out_dir, streams=STREAMS, workers=16, csv=False):
+    os.makedirs(out_dir, exist_ok=True)
+    conn = open_manifest(out_dir)
+    shards = new_shards(src_dir, conn, streams)
+    if not shards:
+        return
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        tables = list(executor.map(lambda s: read_shard(s[0], s[1]), shards))
+    logger.info(f"Read {len(shards)} shards, {sum(t.num_rows for t in tables)} rows "
+                f"in {time.time() - start:.1f}s")
+
+    partitions = []
+    updated = {}
+    for stream in streams:
+        frames = []
+        for order, ((shard_stream, _, _), table) in enumerate(zip(shards, tables)):
+            if shard_stream == stream and table.num_rows:
+                df = table.to_pandas()
+                df['_order'] = order
+                frames.append(df)
+        if not frames:
+            continue
+        df = pd.concat(frames, ignore_index=True)
+        df['_year'] = df['identifier'].map(year_of)
+        partitions.extend((stream, year, rows) for year, rows in df.groupby('_year'))
+        if stream != 'errors':
+            updated[stream] = df[df['_order'] == df.groupby('pid')['_order'].transform('max')]
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        totals = list(executor.map(lambda p: merge_partition(out_dir, *p, csv=csv), partitions))
+    for (stream, year, rows), total in zip(partitions, totals):
+        logger.info(f"{stream} year={year}: {len(rows)} new rows, {total} rows in partition")
+
+    # pids completed per stage, for populate-queue.py
+    index = completion_index.open_index(os.path.join(out_dir, 'completed.sqlite'))
+    for stream, df in updated.items():
+        completion_index.record(index, stream, df)
+    index.close()
+
+    # recorded only once the partitions are written; a crash before this
+    # re-merges the same shards next run, which replacement makes harmless
+    with conn:
+        conn.executemany('INSERT OR REPLACE INTO merged_files VALUES (?, ?, ?, ?, ?)',
+                         [(os.path.basename(path), stream, mtime, table.num_rows, time.time())
+                          for (stream, path, mtime), table in zip(shards, tables)])
+    conn.close()
+    logger.info(f"Consolidated {len(shards)} shards into {len(partitions)} partitions "
+                f"in {time.time() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description='Merge new worker output shards into per-stream, per-year parquet')
+    parser.add_argument('--src', default='/shared-output')
+    parser.add_argument('--out', default='/shared-output/consolidated')
+    parser.add_argument('--streams', nargs='+', default=STREAMS, choices=STREAMS)
+    parser.add_argument('--workers', type=int, default=16)
+    parser.add_argument('--csv', action='store_true', help='also write touched partitions as merged_data_<stream>_<year>.csv')
+    args = parser.parse_args()
+    consolidate(args.src, args.out, args.streams, args.workers, args.csv)
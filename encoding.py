@@ -0,0 +1,243 @@
+# size-targeted image encoding for LLM requests
+#
+# The endpoint takes images up to ~3.2MB of base64. Crops up to
+# DIRECT_ENCODE_PIXELS are simply encoded at full size first, since most fit
+# and one encode is cheaper than predicting. For larger images (whole pages)
+# encode_to_budget() predicts the size from a small mosaic of
+# full-resolution tiles (encoded at 1x and 0.5x to see how size falls with
+# scale), picks the dimensions that should land just under budget, and
+# usually finishes in one encode - two when the prediction is off. Either
+# way it keeps shrinking until the data fits.
+#
+# encode_region() memoizes encodes for the page being processed, keyed by
+# (page token from begin_page(), crop box, size budget, encoder settings), so
+# a region sent more than once - e.g. the whole page for both the header and
+# item prompts - is encoded once. Encodes for any other page token (a query
+# of a failed page still running) bypass the memo, so one page's crop is
+# never served for another. clear_page_memo() cancels or waits out the
+# page's prefetches and frees the memo when the page is finished.
+# prepare_regions() starts a page's encodes on a thread pool ahead of its LLM
+# calls; Pillow releases the GIL while resizing and encoding, so threads give
+# real parallelism without pickling pages over to worker processes. Those
+# are counted apart from the memo: the first query to collect a prefetched
+# region is a prefetch use (with the seconds it still had to wait), not a
+# hit, and only later requests for the same region are hits.
+
+import io
+import os
+import math
+import time
+import base64
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from PIL import Image
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+MAX_FILE_SIZE = 3355443  # 3.2MB of base64
+MAX_SIZE = 4000  # pixel length once an image has to be resized
+# at or below this many pixels try a full-size encode before predicting
+DIRECT_ENCODE_PIXELS = int(os.environ.get('DIRECT_ENCODE_PIXELS', 4_000_000))
+
+# per-stage encoder settings ('header', 'items', 'ads', 'edc'); anything not
+# set for a stage comes from 'default'
+ENCODE_POLICY = {
+    'default': {'format': 'JPEG', 'quality': 95, 'optimize': True, 'subsampling': 0},
+}
+
+encode_stats = {'images': 0, 'encodes': 0}
+
+_page_memo = {}
+_memo_lock = threading.Lock()
+_page_token = 0
+_prefetches = []
+memo_stats = {'hits': 0, 'misses': 0, 'seconds_saved': 0.0,
+              'prefetched': 0, 'prefetch_used': 0, 'prefetch_wait': 0.0}
+
+ENCODE_WORKERS = int(os.environ.get('ENCODE_WORKERS', 2))
+_encode_pool = None
+
+
+def policy_for(stage='default'):
+    return {**ENCODE_POLICY['default'], **ENCODE_POLICY.get(stage, {})}
+
+
+def mime_type(stage='default'):
+    return Image.MIME[policy_for(stage)['format']]
+
+
+def encode(img, policy):
+    buffer = io.BytesIO()
+    img.save(buffer, **policy)
+    encode_stats['encodes'] += 1
+    return buffer.getvalue()
+
+
+def _resize(img, scale):
+    if scale >= 1:
+        return img
+    size = (max(1, int(img.size[0] * scale)), max(1, int(img.size[1] * scale)))
+    # reducing_gap does most of a large reduction with a fast box filter first
+    return img.resize(size, Image.LANCZOS, reducing_gap=3.0)
+
+
+def _mosaic(img, grid=4, tile=256):
+    """grid x grid tiles cut from across the image at full resolution"""
+    w, h = img.size
+    tile = max(8, min(tile, w // grid, h // grid))
+    mosaic = Image.new(img.mode, (tile * grid, tile * grid))
+    for row in range(grid):
+        for col in range(grid):
+            x = int((col + 0.5) * w / grid) - tile // 2
+            y = int((row + 0.5) * h / grid) - tile // 2
+            mosaic.paste(img.crop((x, y, x + tile, y + tile)), (col * tile, row * tile))
+    return mosaic
+
+
+def estimate_size(img, policy):
+    """(predicted full-size bytes, exponent of bytes vs pixel count)"""
+    mosaic = _mosaic(img)
+    sample = len(encode(mosaic, policy))
+    half = len(encode(_resize(mosaic, 0.5), policy))
+    # bytes ~ pixels ** alpha; alpha < 1 since shrinking packs in more detail
+    alpha = math.log(sample / half) / math.log(4) if half < sample else 1.0
+    alpha = min(1.0, max(0.5, alpha))
+    predicted = sample * (img.size[0] * img.size[1]) / (mosaic.size[0] * mosaic.size[1])
+    return predicted, alpha
+
+
+def encode_to_budget(img, max_file_size=MAX_FILE_SIZE, stage='default'):
+    """Base64 string of img, resized only as much as needed to fit max_file_size"""
+    policy = policy_for(stage)
+    if policy['format'] == 'JPEG' and img.mode not in ('RGB', 'L'):
+        img = img.convert('RGB')
+    budget = max_file_size * 3 // 4  # base64 adds a third
+    encode_stats['images'] += 1
+    start = time.time()
+
+    scale = 1.0
+    data = None
+    passes = 0
+    if img.size[0] * img.size[1] <= DIRECT_ENCODE_PIXELS:
+        data = encode(img, policy)
+        passes = 1
+    if data is None or len(data) > budget:
+        # the full-size encode, when there is one, measures better than the mosaic
+        predicted, alpha = estimate_size(img, policy)
+        if data is not None:
+            predicted = len(data)
+        if predicted > budget * (1.0 if data is not None else 1.1):
+            # aim a little under budget; cap at MAX_SIZE like the old resize loop
+            pixel_ratio = (budget * 0.97 / predicted) ** (1 / alpha)
+            scale = min(pixel_ratio ** 0.5, MAX_SIZE / max(img.size))
+            data = None
+
+    while data is None or len(data) > budget:
+        if data is not None:
+            if max(img.size) * scale < 16:
+                raise ValueError(f"Could not encode a {img.size} image under {max_file_size} bytes")
+            # correct by the measured overshoot, always shrinking at least 10%
+            scale *= min(0.9, (budget / len(data)) ** (0.5 / alpha) * 0.95)
+        data = encode(_resize(img, scale), policy)
+        passes += 1
+    logger.info(f"Encoded image at {scale if scale < 1 else 1:.2f}x: "
+                f"{len(data) * 4 / 3 / (1024 * 1024):.2f}MB in {passes} pass(es)")
+    metrics.observe('stage_seconds', time.time() - start, stage='encode', prompt=stage)
+    return base64.b64encode(data).decode("utf-8")
+
+
+def begin_page():
+    """Token for the page about to be encoded; pass it to encode_region and prepare_regions"""
+    global _page_token
+    with _memo_lock:
+        _page_token += 1
+        return _page_token
+
+
+def encode_region(image, box=None, max_file_size=MAX_FILE_SIZE, stage='default', page=None, prefetch=False):
+    """encode_to_budget(image.crop(box)), shared by every request for the current page"""
+    policy = policy_for(stage)
+    key = (page, box, max_file_size, tuple(sorted(policy.items())))
+    with _memo_lock:
+        current = page is not None and page == _page_token
+        if current:
+            entry = _page_memo.get(key)
+            owner = entry is None
+            if owner:
+                # a prefetched entry is unclaimed until a query first asks for it
+                entry = _page_memo[key] = {'ready': threading.Event(), 'unclaimed': prefetch}
+
+    if not current:
+        if prefetch:
+            return None  # the page is already over
+        return encode_to_budget(image.crop(box) if box else image, max_file_size, stage)
+
+    if not owner:
+        if prefetch:
+            return None  # already encoded for a query
+        # another query or the prefetch pool already encoded (or is encoding) this region
+        start = time.time()
+        entry['ready'].wait()
+        if 'error' in entry:
+            raise entry['error']
+        with _memo_lock:
+            if entry['unclaimed']:
+                entry['unclaimed'] = False
+                memo_stats['prefetch_used'] += 1
+                memo_stats['prefetch_wait'] += time.time() - start
+            else:
+                memo_stats['hits'] += 1
+                memo_stats['seconds_saved'] += entry['seconds']
+        return entry['value']
+
+    start = time.time()
+    try:
+        img = image.crop(box) if box else image
+        entry['value'] = encode_to_budget(img, max_file_size, stage)
+        return entry['value']
+    except Exception as e:
+        entry['error'] = e
+        raise
+    finally:
+        entry['seconds'] = time.time() - start
+        with _memo_lock:
+            memo_stats['prefetched' if prefetch else 'misses'] += 1
+        entry['ready'].set()
+
+
+def prepare_regions(image, regions, page, max_file_size=MAX_FILE_SIZE):
+    """Start encoding [(box, stage)] for a page in the background; encode_region collects them"""
+    global _encode_pool
+    if ENCODE_WORKERS < 1:
+        return
+    with _memo_lock:
+        if _encode_pool is None:
+            _encode_pool = ThreadPoolExecutor(max_workers=ENCODE_WORKERS)
+    for box, stage in dict.fromkeys(regions):
+        # errors are raised again to the llm_query that asks for the region
+        _prefetches.append(_encode_pool.submit(encode_region, image, box, max_file_size, stage,
+                                               page=page, prefetch=True))
+
+
+def clear_page_memo():
+    """Drop the page's queued prefetches, wait out running ones, then free the memo"""
+    for future in _prefetches:
+        future.cancel()
+    wait(_prefetches)
+    _prefetches.clear()
+    with _memo_lock:
+        _page_memo.clear()
+
+
+def log_memo_stats():
+    s = memo_stats
+    lookups = s['hits'] + s['misses'] + s['prefetch_used']
+    rate = s['hits'] / lookups if lookups else 0
+    logger.info(f"Encode memo: {s['hits']}/{lookups} hits ({rate:.0%}), "
+                f"{s['seconds_saved']:.1f}s of encoding saved")
+    if s['prefetched']:
+        logger.info(f"Encode prefetch: {s['prefetch_used']}/{s['prefetched']} prefetched regions used, "
+                    f"{s['prefetch_wait']:.1f}s waited on them")
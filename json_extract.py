@@ -0,0 +1,119 @@
+# single-pass extraction of the JSON object in an LLM response
+#
+# Responses usually arrive without their opening brace (llm_query prefills
+# "{"), and may be wrapped in ```json fences, box tokens or a <think> block,
+# carry invalid values (12A, trailing commas) or be cut off mid-list.
+# extract_json() strips the wrappers, then makes one pass over the text -
+# tracking strings and escapes, so braces inside values don't count - to find
+# the first complete top-level object. json.loads is tried on it as-is and
+# json_repair only runs when that fails or the object never closes.
+
+import re
+import json
+import logging
+from json_repair import repair_json
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+WRAPPERS = re.compile(r'<think>.*?</think>|```json|```|<\|(?:begin|start|end)_of_box\|>|</?think>|^json\n',
+                      re.DOTALL)
+# characters that matter for finding the end of the object; everything
+# between them is skipped by the regex engine rather than a python loop
+STRUCTURE = re.compile(r'[{}"\\]')
+
+BAD_JSON = {"error": "Badly formed JSON response"}
+
+extract_stats = {'responses': 0, 'clean': 0, 'repaired': 0, 'failed': 0}
+
+
+def strip_wrappers(text):
+    return WRAPPERS.sub('', text.strip()).strip()
+
+
+def object_end(text, start):
+    """Index just past the object opened at text[start], or None if it never closes"""
+    depth = 0
+    in_string = False
+    skip = -1
+    for m in STRUCTURE.finditer(text, start):
+        i = m.start()
+        if i < skip:
+            continue
+        c = m.group()
+        if in_string:
+            if c == '\\':
+                skip = i + 2  # escaped character, whatever it is
+            elif c == '"':
+                in_string = False
+        elif c == '"':
+            in_string = True
+        elif c == '{':
+            depth += 1
+        elif c == '}':
+            depth -= 1
+            if depth == 0:
+                return i + 1
+    return None
+
+
+def repair(text):
+    try:
+        return repair_json(text)
+    except Exception as e:
+        # Fallback to manual fixes if json-repair fails
+        logger.debug(f"json-repair failed: {e}, trying manual fixes")
+        text = re.sub(r'("[^"]+"):\s*([0-9]+[A-Za-z][A-Za-z0-9]*)', r'\1: "\2"', text)
+        text = re.sub(r',(\s*[}\]])', r'\1', text)
+        return text
+
+
+def extract_json(text):
+    """First JSON object in an LLM response as a dict, or BAD_JSON"""
+    extract_stats['responses'] += 1
+    text = strip_wrappers(text)
+    # the prefilled "{" isn't echoed back, so a response that opens on a key
+    # (or has no object at all) gets one
+    if text and text[0] != '{' and (text[0] == '"' or '{' not in text):
+        text = '{' + text
+    start = text.find('{')
+    if start < 0:
+        extract_stats['failed'] += 1
+        metrics.inc('llm_json_total', result='failed')
+        logger.warning(f'No JSON object in response: {text[:200]}')
+        return dict(BAD_JSON)
+
+    end = object_end(text, start)
+    candidate = text[start:end]
+    if end is not None:
+        try:
+            # strict=False allows raw newlines inside strings
+            data = json.loads(candidate, strict=False)
+            if isinstance(data, dict):
+                extract_stats['clean'] += 1
+                metrics.inc('llm_json_total', result='clean')
+                return data
+        except json.JSONDecodeError:
+            pass
+
+    try:
+        data = json.loads(repair(candidate), strict=False)
+    except json.JSONDecodeError as e:
+        logger.warning(f'JSON decode error at position {e.pos}: {e.msg}')
+        logger.warning(f'Problematic text: {candidate[max(0, e.pos - 50):e.pos + 50]}')
+        data = None
+    if not isinstance(data, dict):
+        extract_stats['failed'] += 1
+        metrics.inc('llm_json_total', result='failed')
+        return dict(BAD_JSON)
+    extract_stats['repaired'] += 1
+    metrics.inc('llm_json_total', result='repaired')
+    return data
+
+
+def log_extract_stats():
+    n = extract_stats['responses']
+    rate = extract_stats['repaired'] / n if n else 0
+    logger.info(f"LLM JSON: {extract_stats['clean']} clean, {extract_stats['repaired']} repaired "
+                f"({rate:.0%}), {extract_stats['failed']} failed of {n}")
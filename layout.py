@@ -0,0 +1,86 @@
+# batched layoutparser / Detectron2 inference shared by worker.py and worker_lp.py
+#
+# lp_model.detect() runs one page per forward pass. detect_batch() runs the
+# same preprocessing as Detectron2's DefaultPredictor on a list of pages and
+# sends them through the model together, which keeps a GPU busy. Results are
+# the same per-page dicts the workers have always built for filter_lp.
+
+import os
+import logging
+import torch
+
+logger = logging.getLogger(__name__)
+
+LP_BATCH_SIZE = int(os.environ.get('LP_BATCH_SIZE', 4 if torch.cuda.is_available() else 1))
+
+
+# highlight specific columns from lp
+def filter_lp(results):
+    max_items = {}
+    for item in results:
+        key = (item['x_1'], item['y_1'], item['x_2'], item['y_2'])
+        if key not in max_items or item['score'] > max_items[key]['score']:
+            max_items[key] = item
+    return list(max_items.values())
+
+
+def to_results(layout, pid, identifier, scale=1):
+    """layoutparser Layout -> filtered list of box dicts for one page
+
+    scale maps boxes from a reduced-resolution decode back to full-page coordinates.
+    """
+    results = []
+    for l in layout:
+        results.append({
+            'x_1': l.block.x_1 * scale, 'y_1': l.block.y_1 * scale,
+            'x_2': l.block.x_2 * scale, 'y_2': l.block.y_2 * scale,
+            'score': l.score, 'type': l.type,
+            'identifier': identifier, 'pid': pid,
+        })
+    return filter_lp(results)
+
+
+def _forward(lp_model, images):
+    """One forward pass over images, mirroring DefaultPredictor.__call__"""
+    predictor = lp_model.model
+    inputs = []
+    with torch.no_grad():
+        for image in images:
+            if predictor.input_format == 'RGB':
+                image = image[:, :, ::-1]
+            height, width = image.shape[:2]
+            resized = predictor.aug.get_transform(image).apply_image(image)
+            tensor = torch.as_tensor(resized.astype('float32').transpose(2, 0, 1))
+            inputs.append({'image': tensor, 'height': height, 'width': width})
+        outputs = predictor.model(inputs)
+    return [lp_model.gather_output(o) for o in outputs]
+
+
+def _detect_chunk(lp_model, images):
+    try:
+        return _forward(lp_model, images)
+    except RuntimeError as e:
+        # large pages can exhaust GPU memory as a batch; split and retry
+        if 'out of memory' not in str(e) or len(images) == 1:
+            raise
+        torch.cuda.empty_cache()
+        half = len(images) // 2
+        logger.warning(f"LP batch of {len(images)} ran out of memory, splitting")
+        return _detect_chunk(lp_model, images[:half]) + _detect_chunk(lp_model, images[half:])
+
+
+def detect_batch(lp_model, images, batch_size=LP_BATCH_SIZE):
+    """Detect layouts for a list of page arrays (H, W, 3); one Layout per page, in order"""
+    if batch_size <= 1:
+        return [lp_model.detect(image) for image in images]
+    layouts = []
+    for i in range(0, len(images), batch_size):
+        layouts.extend(_detect_chunk(lp_model, images[i:i + batch_size]))
+    return layouts
+
+
+def detect_pages(lp_model, pages, batch_size=LP_BATCH_SIZE):
+    """pages = [(pid, identifier, image_array[, scale])] -> list of per-page result lists"""
+    layouts = detect_batch(lp_model, [p[2] for p in pages], batch_size)
+    return [to_results(layout, page[0], page[1], page[3] if len(page) > 3 else 1)
+            for page, layout in zip(pages, layouts)]
@@ -0,0 +1,143 @@
+# persistent cache of raw LLM responses, shared by pods through a sqlite file on the PVC
+#
+# Keyed by (model, hash of the system prompt, user text, hash of the encoded
+# image), so a reprocessing pass (populate-queue.py OPTION B, a pod killed
+# before its results were saved) gets the earlier answer back instead of
+# paying for the same request again. Raw responses are stored, not parsed
+# ones, so a parser change applies to cached answers too. Responses that
+# don't parse to a JSON object are not cached.
+#
+#   LLM_CACHE=/shared-output/llm-cache.sqlite   enable (unset = off)
+#   LLM_CACHE_MB=2048                           evict least recently used past this
+#   LLM_CACHE_MODE=replay                       cache only: a miss fails the query
+#                                               and nothing is sent to the endpoint
+#   LLM_CACHE_REFRESH=header                    prompt types that always ask the
+#                                               model again (and update the cache)
+#
+# Replay re-runs the queue over pages already processed to regenerate their
+# outputs, e.g. after changing json_extract or result_writer.
+
+import os
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+LLM_CACHE = os.environ.get('LLM_CACHE')
+LLM_CACHE_MB = float(os.environ.get('LLM_CACHE_MB', 2048))
+MODE = os.environ.get('LLM_CACHE_MODE', 'on') if LLM_CACHE else 'off'
+REFRESH = {s for s in os.environ.get('LLM_CACHE_REFRESH', '').split(',') if s}
+# eviction sums the whole table, so only check every N stores per worker
+EVICT_EVERY = 500
+
+cache_stats = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0}
+
+_conn = None
+_lock = threading.Lock()
+_stores = 0
+
+
+class CacheMiss(LookupError):
+    """No cached response in replay mode"""
+
+
+def _connect():
+    global _conn
+    if _conn is None:
+        os.makedirs(os.path.dirname(LLM_CACHE) or '.', exist_ok=True)
+        # shared with other pods over the PVC: plain rollback journal (WAL
+        # needs shared memory) and wait out other writers' locks
+        _conn = sqlite3.connect(LLM_CACHE, timeout=60, check_same_thread=False)
+        _conn.execute('''CREATE TABLE IF NOT EXISTS responses (
+            key TEXT PRIMARY KEY, model TEXT, prompt TEXT, response TEXT,
+            size INTEGER, created REAL, used REAL)''')
+        _conn.execute('CREATE INDEX IF NOT EXISTS responses_used ON responses (used)')
+        _conn.commit()
+        logger.info(f"LLM response cache at {LLM_CACHE} ({MODE})")
+    return _conn
+
+
+def key(model, sys_prompt, text, image):
+    """Cache key for one request; image is the encoded (base64) payload"""
+    parts = [model, hashlib.sha256(sys_prompt.encode('utf-8')).hexdigest(), text,
+             hashlib.sha256(image.encode('ascii')).hexdigest()]
+    return hashlib.sha256('\0'.join(parts).encode('utf-8')).hexdigest()
+
+
+def get(cache_key, prompt):
+    """(raw response, model that answered) or None; raises CacheMiss in replay mode"""
+    if MODE == 'off' or (prompt in REFRESH and MODE != 'replay'):
+        return None
+    try:
+        with _lock:
+            conn = _connect()
+            row = conn.execute('SELECT response, model FROM responses WHERE key = ?', (cache_key,)).fetchone()
+            if row:
+                with conn:
+                    conn.execute('UPDATE responses SET used = ? WHERE key = ?', (time.time(), cache_key))
+    except sqlite3.Error as e:
+        logger.warning(f"Could not read LLM cache: {e}")
+        row = None
+    if row is None:
+        cache_stats['misses'] += 1
+        metrics.inc('llm_cache_total', result='miss', prompt=prompt)
+        if MODE == 'replay':
+            raise CacheMiss(f"No cached {prompt} response (LLM_CACHE_MODE=replay)")
+        return None
+    cache_stats['hits'] += 1
+    metrics.inc('llm_cache_total', result='hit', prompt=prompt)
+    return row[0], row[1]
+
+
+def put(cache_key, prompt, response, model):
+    global _stores
+    if MODE != 'on':
+        return
+    now = time.time()
+    try:
+        with _lock:
+            conn = _connect()
+            with conn:
+                conn.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)',
+                             (cache_key, model, prompt, response, len(response), now, now))
+            _stores += 1
+            if _stores % EVICT_EVERY == 0:
+                evict(conn)
+    except sqlite3.Error as e:
+        # a full or busy cache shouldn't fail the page
+        logger.warning(f"Could not cache LLM response: {e}")
+        return
+    cache_stats['stores'] += 1
+
+
+def evict(conn, max_bytes=LLM_CACHE_MB * 1024 ** 2):
+    """Delete least recently used responses until under 90% of max_bytes"""
+    total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+    if total <= max_bytes:
+        return
+    excess = total - max_bytes * 0.9
+    cutoff = None
+    for used, size in conn.execute('SELECT used, size FROM responses ORDER BY used'):
+        excess -= size
+        cutoff = used
+        if excess <= 0:
+            break
+    with conn:
+        deleted = conn.execute('DELETE FROM responses WHERE used <= ?', (cutoff,)).rowcount
+    cache_stats['evictions'] += deleted
+    logger.info(f"LLM cache evicted {deleted} responses ({total / 1024 ** 2:.0f}MB over {LLM_CACHE_MB:.0f}MB)")
+
+
+def log_cache_stats():
+    if MODE == 'off':
+        return
+    s = cache_stats
+    lookups = s['hits'] + s['misses']
+    rate = s['hits'] / lookups if lookups else 0
+    logger.info(f"LLM cache: {s['hits']} hits ({rate:.0%}), {s['misses']} misses, "
+                f"{s['stores']} stored, {s['evictions']} evicted")
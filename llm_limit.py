@@ -0,0 +1,197 @@
+# adaptive concurrency and retry policy for the LLM endpoint
+#
+# AdaptiveLimiter caps this pod's in-flight LLM requests with an AIMD limit:
+# each call that comes back at normal latency raises the limit by 1/limit
+# (about +1 per round of calls), while a 429, a 5xx, a timeout or a latency
+# above LLM_LATENCY_FACTOR x the prompt type's baseline halves it, at most
+# once per LLM_DECREASE_COOLDOWN seconds so one burst of failures counts once.
+# The baseline is the 10th percentile of the prompt type's last 50
+# successful latencies, so one unusually fast reply doesn't make every
+# ordinary one look slow. A Retry-After header holds every request on the
+# pod until it has passed. The limit starts at LLM_CONCURRENCY and probes
+# upwards from there as far as LLM_MAX_CONCURRENCY (the size of the LLM
+# pool), never below 1.
+#
+# Errors are classified before retrying: 429/5xx/timeouts are overload and
+# retried with full-jitter backoff (so pods don't retry in lockstep),
+# dropped connections and waits for a slot or for the fleet rate limit
+# (rate_limit.py) that ran out of time are retried, other 4xx (bad request,
+# auth, image too large) and local errors are raised at once. Each prompt
+# type has a deadline (LLM_DEADLINES) that covers waiting for the rate limit
+# and a slot, every attempt and the backoff between them; no retry starts
+# that could not finish in it.
+
+import os
+import time
+import random
+import logging
+import threading
+from collections import deque
+from email.utils import parsedate_to_datetime
+
+import openai
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+LLM_CONCURRENCY = int(os.environ.get('LLM_CONCURRENCY', 4))
+LLM_MAX_CONCURRENCY = max(LLM_CONCURRENCY, int(os.environ.get('LLM_MAX_CONCURRENCY', 16)))
+LLM_LATENCY_FACTOR = float(os.environ.get('LLM_LATENCY_FACTOR', 3))
+LLM_DECREASE_COOLDOWN = float(os.environ.get('LLM_DECREASE_COOLDOWN', 10))
+LLM_BACKOFF_CAP = float(os.environ.get('LLM_BACKOFF_CAP', 60))
+
+# seconds from the first attempt until an llm_query gives up, per prompt type
+DEADLINES = {'header': 300, 'items': 600, 'ads': 120, 'edc': 120, 'default': 300}
+DEADLINES.update({k: float(v) for k, v in (item.split('=') for item in
+                  os.environ.get('LLM_DEADLINES', '').split(',') if item)})
+
+OVERLOAD = 'overload'  # retry, and back the limit off
+RETRY = 'retry'        # retry, the endpoint isn't the problem
+FATAL = 'fatal'        # retrying won't help
+
+limit_stats = {'calls': 0, 'overloads': 0, 'slow': 0, 'decreases': 0, 'fatal': 0, 'wait_seconds': 0.0}
+
+
+class EmptyResponse(Exception):
+    """Completion came back without choices"""
+
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+
+def deadline_for(stage):
+    return time.time() + DEADLINES.get(stage, DEADLINES['default'])
+
+
+def retry_after(e):
+    """Seconds from the Retry-After header of an API error, or None"""
+    response = getattr(e, 'response', None)
+    value = response.headers.get('retry-after') if response is not None else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+
+def classify(e):
+    if isinstance(e, openai.APITimeoutError):
+        return OVERLOAD
+    if isinstance(e, (openai.APIConnectionError, EmptyResponse, DeadlineExceeded)):
+        # a deadline hit waiting for a slot or the fleet's rate limit isn't the
+        # request's fault; the retry loop's own deadline check stops it
+        return RETRY
+    if isinstance(e, openai.APIStatusError):
+        if e.status_code == 429 or e.status_code >= 500:
+            return OVERLOAD
+        if e.status_code in (408, 409):
+            return RETRY
+    return FATAL
+
+
+def retry_delay(e, attempt):
+    """(retryable, seconds to wait) for an error from attempt n (0-based)"""
+    kind = classify(e)
+    if kind == FATAL:
+        return False, 0
+    wait = retry_after(e)
+    if wait is not None:
+        # spread the pods that were all told the same time
+        return True, wait + random.uniform(0, 1 + wait * 0.2)
+    return True, random.uniform(0, min(LLM_BACKOFF_CAP, 2 * 2 ** attempt))
+
+
+class AdaptiveLimiter:
+    """AIMD cap on concurrent LLM requests; use `with limiter.slot(stage, deadline):`"""
+
+    def __init__(self, initial=LLM_CONCURRENCY, max_limit=LLM_MAX_CONCURRENCY, min_limit=1):
+        self.max_limit = max(min_limit, max_limit)
+        self.min_limit = min_limit
+        self.limit = float(min(self.max_limit, max(min_limit, initial)))
+        self.in_flight = 0
+        self.blocked_until = 0.0
+        self.last_decrease = 0.0
+        self.best = {}  # prompt type -> recent successful latencies
+        self.cond = threading.Condition()
+
+    def acquire(self, deadline):
+        start = time.time()
+        with self.cond:
+            while True:
+                now = time.time()
+                if now >= deadline:
+                    raise DeadlineExceeded(f"No LLM slot before the deadline (limit {self.limit:.1f})")
+                if now < self.blocked_until:
+                    self.cond.wait(min(self.blocked_until, deadline) - now)
+                elif self.in_flight >= int(self.limit):
+                    self.cond.wait(deadline - now)
+                else:
+                    break
+            self.in_flight += 1
+            waited = time.time() - start
+            limit_stats['wait_seconds'] += waited
+        metrics.observe('stage_seconds', waited, stage='llm_wait')
+
+    def _decrease(self, now, reason):
+        if now - self.last_decrease < LLM_DECREASE_COOLDOWN:
+            return
+        self.last_decrease = now
+        old = self.limit
+        self.limit = max(self.min_limit, self.limit / 2)
+        limit_stats['decreases'] += 1
+        metrics.inc('llm_limit_total', event='decrease', reason=reason)
+        logger.info(f"LLM concurrency limit {old:.1f} -> {self.limit:.1f} ({reason})")
+
+    def release(self, stage, seconds, error=None):
+        now = time.time()
+        with self.cond:
+            self.in_flight -= 1
+            limit_stats['calls'] += 1
+            kind = classify(error) if error is not None else None
+            if kind == OVERLOAD:
+                limit_stats['overloads'] += 1
+                wait = retry_after(error)
+                if wait:
+                    self.blocked_until = max(self.blocked_until, now + wait)
+                self._decrease(now, type(error).__name__)
+            elif kind == FATAL:
+                limit_stats['fatal'] += 1
+            elif kind is None:
+                best = self.best.setdefault(stage, deque(maxlen=50))
+                if len(best) >= 10 and seconds > LLM_LATENCY_FACTOR * sorted(best)[len(best) // 10]:
+                    limit_stats['slow'] += 1
+                    self._decrease(now, 'latency')
+                else:
+                    self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+                best.append(seconds)
+            self.cond.notify_all()
+
+    def slot(self, stage, deadline):
+        return _Slot(self, stage, deadline)
+
+    def log_stats(self):
+        s = limit_stats
+        logger.info(f"LLM limiter: limit={self.limit:.1f}/{self.max_limit}, {s['calls']} calls, "
+                    f"{s['overloads']} overloaded, {s['slow']} slow, {s['fatal']} fatal, "
+                    f"{s['decreases']} decreases, {s['wait_seconds']:.0f}s waiting for a slot")
+
+
+class _Slot:
+    def __init__(self, limiter, stage, deadline):
+        self.limiter = limiter
+        self.stage = stage
+        self.deadline = deadline
+
+    def __enter__(self):
+        self.limiter.acquire(self.deadline)
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.limiter.release(self.stage, time.time() - self.start, exc)
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+# sqlite index of layoutparser output (lp_items_*.parquet from worker_lp.py, or
+# the older lp_items_*.csv), keyed by pid
+#
+# Build or top up the index on the PVC (only files not seen before are read):
+#   python lp_store.py '/shared-output/lp_items_*' '/shared-output/lp_pages_*' --db /shared-output/lp_items.sqlite
+#
+# worker.py with LP_SOURCE=store then looks boxes up here instead of loading
+# the Detectron2 model. The pages table lists every pid LP ran on (from
+# lp_pages_* files, plus any pid with boxes), so a page with no boxes is told
+# apart from one never processed: lookup raises NotIndexed for the latter and
+# the task fails instead of going on with no boxes.
+
+import os
+import glob
+import sqlite3
+import logging
+import argparse
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+COLUMNS = ['pid', 'identifier', 'x_1', 'y_1', 'x_2', 'y_2', 'score', 'type']
+PAGE_COLUMNS = ['pid', 'boxes']
+
+
+class NotIndexed(LookupError):
+    """LP never ran on the page (or its output isn't loaded yet)"""
+
+
+def open_store(path, readonly=True):
+    if readonly:
+        # shared between the main loop and the pipeline's detect thread, reads only
+        return sqlite3.connect(f'file:{path}?mode=ro', uri=True, check_same_thread=False)
+    conn = sqlite3.connect(path)
+    conn.execute('''CREATE TABLE IF NOT EXISTS lp_items (
+        pid TEXT, identifier TEXT, x_1 REAL, y_1 REAL, x_2 REAL, y_2 REAL,
+        score REAL, type INTEGER)''')
+    conn.execute('CREATE INDEX IF NOT EXISTS lp_items_pid ON lp_items (pid)')
+    conn.execute('CREATE TABLE IF NOT EXISTS pages (pid TEXT PRIMARY KEY, boxes INTEGER)')
+    conn.execute('CREATE TABLE IF NOT EXISTS loaded_files (name TEXT PRIMARY KEY, mtime REAL)')
+    return conn
+
+
+def build_store(files, path):
+    """Add LP files not yet loaded; a re-processed pid replaces its older rows"""
+    conn = open_store(path, readonly=False)
+    loaded = {row[0] for row in conn.execute('SELECT name FROM loaded_files')}
+    new_files = sorted((f for f in files if os.path.basename(f) not in loaded), key=os.path.getmtime)
+    logger.info(f"{len(new_files)} new LP files ({len(loaded)} already loaded)")
+
+    for i, fn in enumerate(new_files):
+        is_pages = os.path.basename(fn).startswith('lp_pages_')
+        columns = PAGE_COLUMNS if is_pages else COLUMNS
+        try:
+            if fn.endswith('.parquet'):
+                df = pd.read_parquet(fn, columns=columns)
+            else:
+                df = pd.read_csv(fn, usecols=lambda c: c in columns)
+        except pd.errors.EmptyDataError:
+            df = pd.DataFrame(columns=columns)
+        with conn:
+            if is_pages:
+                conn.executemany('INSERT OR REPLACE INTO pages VALUES (?, ?)',
+                                 df.reindex(columns=PAGE_COLUMNS).itertuples(index=False, name=None))
+            else:
+                pids = df['pid'].unique().tolist() if len(df) else []
+                conn.executemany('DELETE FROM lp_items WHERE pid = ?', [(p,) for p in pids])
+                conn.executemany(f'INSERT INTO lp_items ({",".join(COLUMNS)}) VALUES ({",".join("?" * len(COLUMNS))})',
+                                 df.reindex(columns=COLUMNS).itertuples(index=False, name=None))
+                # older output has no lp_pages files; a pid with boxes was processed
+                conn.executemany('INSERT OR IGNORE INTO pages VALUES (?, ?)',
+                                 df.groupby('pid').size().items() if len(df) else [])
+            conn.execute('INSERT OR REPLACE INTO loaded_files VALUES (?, ?)',
+                         (os.path.basename(fn), os.path.getmtime(fn)))
+        if (i + 1) % 1000 == 0:
+            logger.info(f"Loaded {i + 1}/{len(new_files)} files")
+    conn.close()
+
+
+def lookup(conn, pid, identifier=None):
+    """LP results for a page in the same dict format as layout.to_results
+
+    Raises NotIndexed if the store has no record of LP running on the page.
+    """
+    rows = conn.execute(f'SELECT {",".join(COLUMNS)} FROM lp_items WHERE pid = ?', (pid,)).fetchall()
+    if not rows and conn.execute('SELECT 1 FROM pages WHERE pid = ?', (pid,)).fetchone() is None:
+        raise NotIndexed(f"No LP results stored for {pid}")
+    results = [dict(zip(COLUMNS, row)) for row in rows]
+    for item in results:
+        item['type'] = int(item['type'])
+        if identifier is not None:
+            item['identifier'] = identifier
+    return results
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description='Build/update the sqlite index of LP results')
+    parser.add_argument('patterns', nargs='*', default=['/shared-output/lp_items_*', '/shared-output/lp_pages_*'])
+    parser.add_argument('--db', default='/shared-output/lp_items.sqlite')
+    args = parser.parse_args()
+    build_store([fn for pattern in args.patterns for fn in glob.glob(pattern)], args.db)
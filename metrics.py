@@ -0,0 +1,167 @@
+# per-worker metrics in Prometheus text format
+#
+# Modules record into this process-wide registry (observe() for latency
+# histograms, inc() for counters); serve() exposes it on METRICS_PORT for a
+# Prometheus scrape and/or rewrites METRICS_FILE every METRICS_INTERVAL
+# seconds, e.g. one file per pod on the PVC to compare across the fleet:
+#
+#   newspaper_stage_seconds         fetch / download / decode / detect / encode / lease
+#   newspaper_llm_seconds           per prompt type (header, items, ads, edc)
+#   newspaper_bytes_total           downloaded from Islandora, uploaded to the LLM
+#   newspaper_tasks_total           pages finished, by result
+#   newspaper_retries_total         by what was retried
+#   newspaper_llm_json_total        responses parsed clean, repaired or failed
+#
+# Which stage's histogram dominates says whether the fleet is bound on
+# Islandora, the GPU or the LLM endpoint before changing parallelism.
+
+import os
+import time
+import logging
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+logger = logging.getLogger(__name__)
+
+PREFIX = 'newspaper_'
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+METRICS_PORT = int(os.environ.get('METRICS_PORT', 0))
+METRICS_FILE = os.environ.get('METRICS_FILE')
+METRICS_INTERVAL = float(os.environ.get('METRICS_INTERVAL', 60))
+
+_lock = threading.Lock()
+_counters = {}  # (name, labels) -> value
+_histograms = {}  # (name, labels) -> [bucket counts..., sum, count]
+_started = time.time()
+_served = False
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def inc(name, value=1, **labels):
+    with _lock:
+        key = _key(name, labels)
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(name, seconds, **labels):
+    with _lock:
+        h = _histograms.setdefault(_key(name, labels), [0] * (len(BUCKETS) + 2))
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                h[i] += 1
+        h[-2] += seconds
+        h[-1] += 1
+
+
+class timer:
+    """with metrics.timer('stage_seconds', stage='decode'): ..."""
+
+    def __init__(self, name, **labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        observe(self.name, time.time() - self.start, **self.labels)
+
+
+def _labels(labels, **extra):
+    labels = tuple(labels) + tuple(extra.items())
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}'
+
+
+def render(**const_labels):
+    """Everything recorded so far in Prometheus text exposition format"""
+    const = tuple(const_labels.items())
+    lines = []
+    with _lock:
+        counters = sorted(_counters.items())
+        histograms = sorted((k, list(v)) for k, v in _histograms.items())
+    seen = set()
+    for (name, labels), value in counters:
+        if name not in seen:
+            lines.append(f'# TYPE {PREFIX}{name} counter')
+            seen.add(name)
+        lines.append(f'{PREFIX}{name}{_labels(const + labels)} {value}')
+    for (name, labels), h in histograms:
+        if name not in seen:
+            lines.append(f'# TYPE {PREFIX}{name} histogram')
+            seen.add(name)
+        for bound, count in zip(BUCKETS, h):
+            lines.append(f'{PREFIX}{name}_bucket{_labels(const + labels, le=bound)} {count}')
+        lines.append(f'{PREFIX}{name}_bucket{_labels(const + labels, le="+Inf")} {h[-1]}')
+        lines.append(f'{PREFIX}{name}_sum{_labels(const + labels)} {h[-2]:.3f}')
+        lines.append(f'{PREFIX}{name}_count{_labels(const + labels)} {h[-1]}')
+
+    uptime = time.time() - _started
+    tasks = sum(v for (name, _), v in counters if name == 'tasks_total')
+    lines.append(f'# TYPE {PREFIX}uptime_seconds gauge')
+    lines.append(f'{PREFIX}uptime_seconds{_labels(const)} {uptime:.0f}')
+    lines.append(f'# TYPE {PREFIX}tasks_per_second gauge')
+    lines.append(f'{PREFIX}tasks_per_second{_labels(const)} {tasks / uptime if uptime else 0:.4f}')
+    return '\n'.join(lines) + '\n'
+
+
+def write_file(path, **const_labels):
+    tmp = f'{path}.tmp'
+    with open(tmp, 'w') as f:
+        f.write(render(**const_labels))
+    os.replace(tmp, path)
+
+
+def flush(worker_id):
+    """Write METRICS_FILE now (on exit), without waiting for the next interval"""
+    if METRICS_FILE:
+        try:
+            write_file(METRICS_FILE.format(worker=worker_id), worker=worker_id)
+        except OSError as e:
+            logger.warning(f"Could not write metrics: {e}")
+
+
+def serve(worker_id):
+    """Start the endpoint and/or file writer configured by METRICS_PORT / METRICS_FILE"""
+    global _served
+    if _served:
+        return
+    _served = True
+
+    if METRICS_PORT:
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                body = render(worker=worker_id).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        server = ThreadingHTTPServer(('', METRICS_PORT), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        logger.info(f"Serving metrics on :{METRICS_PORT}/metrics")
+
+    if METRICS_FILE:
+        path = METRICS_FILE.format(worker=worker_id)
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+
+        def loop():
+            while True:
+                time.sleep(METRICS_INTERVAL)
+                try:
+                    write_file(path, worker=worker_id)
+                except OSError as e:
+                    logger.warning(f"Could not write metrics to {path}: {e}")
+
+        threading.Thread(target=loop, daemon=True).start()
+        logger.info(f"Writing metrics to {path} every {METRICS_INTERVAL:.0f}s")
@@ -1,91 +1,156 @@
 #!/usr/bin/env python3
 
+# harvest every page PID + identifier in a namespace into all-items.csv
+#
+#   python full-solr-query.py --namespace $COLL_NS
+#
+# Each PID prefix (10*..99*) is paged through Solr with cursorMark, sorted on
+# PID, with up to --workers prefixes fetched at once. PIDs the prefix walk
+# misses (1-9, deleted items, Solr quirks) are then looked up in batches of
+# PID:("ns:a" OR "ns:b" ...) queries. New rows are appended to all-items.csv
+# and each prefix's cursor saved to all-items.cursors.json as it goes, so an
+# interrupted run picks up where it stopped.
+#
+# For a dry run against a local stub instead of Islandora:
+#   python ../benchmarks/stub_solr.py --port 8983 &
+#   python full-solr-query.py --url http://localhost:8983 --namespace test --max-pid 20000
+
+import os
+import sys
 import json
-from islandora7_rest import IslandoraClient
+import time
+import argparse
+import threading
+from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
-import sys
-import os
-
-# Connect to Islandora
-isURL = $ISLANDORA_URL
-is_client = IslandoraClient(isURL)
-
-# Test connection
-try:
-    is_client.solr_query('PID:*root')
-    print("✓ Islandora connection successful")
-except Exception as e:
-    print(f"✗ Islandora connection failed: {e}")
-    sys.exit()
-
-# Set query
-query = 'PID:$COLL_NS\\:{}* AND RELS_EXT_hasModel_uri_ms:"info:fedora/islandora:pageCModel"'
-fields = ['PID','mods_identifier_local_displayLabel_ms','RELS_EXT_hasModel_uri_ms']
-
-item_file = 'all-items.csv'
-
-if os.path.isfile(item_file):
-
-    existing_df = pd.read_csv(item_file)
-    all_items = existing_df.to_dict('records')
-    completed = set(existing_df['pid'].tolist())
-    print(f'{len(completed)} items already found')
-else:
-    all_items = []
-    completed = set()
-
-count = 0
-for i in range(10,99):
-# for i in [269]:
-
-    print(i)
-
-    for item in is_client.solr_generator(query.format(i), fl=fields):
-
-        try:
-            if item['PID'] not in completed:
-                all_items.append({'pid': item['PID'],
-                    'identifier': item['mods_identifier_local_displayLabel_ms'][0]
-                    })
-                completed.add(item['PID'])
-                count += 1
-                if count % 1000 == 0:
-                    print(count)
-        except Exception as e:
-            print(item)
-            print(e)
-            pd.DataFrame(all_items).to_csv(item_file, index=False)
-            break
-
-print(f"{len(all_items)} retrieved by solr_generator")
-# not all were caught for some reason, so scooping up missed ones
-# probably just an internal solr limit
-# note that this does query some legit missing pids, e.g., deleted items
-existing_numbers = {int(s.split(':')[1]) for s in completed}
-# range of integers ending in the highest PID
-complete_set = set(range(1, 200656))
-missing = sorted(complete_set - existing_numbers)
-
-print(f"{len(missing)} not found in first query. Starting second query.")
-
-for m in missing:
-    print(f'PID:"$COLL_NS:{m}"')
-    res = is_client.solr_query(f'PID:"$COLL_NS:{m}" AND RELS_EXT_hasModel_uri_ms:"info:fedora/islandora:pageCModel"')
-
-    if res['response']['numFound']>0:
-        item =  res['response']['docs'][0]
-        try:
-            if 'book' in  item['RELS_EXT_hasModel_uri_ms']:
-                print(f"$COLL_NS:{m} is a book")
-            else:
-                all_items.append({'pid': item['PID'],
-                    'identifier': item['mods_identifier_local_displayLabel_ms'][0]
-                    })
-                completed.add(item['PID'])
-                count += 1
-        except Exception as e:
-            print(item)
-            print(e)
-
-print(f"Done - {len(all_items)} collected")
-pd.DataFrame(all_items).to_csv(item_file, index=False)
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+PAGE_MODEL = 'RELS_EXT_hasModel_uri_ms:"info:fedora/islandora:pageCModel"'
+FIELDS = ['PID', 'mods_identifier_local_displayLabel_ms', 'RELS_EXT_hasModel_uri_ms']
+
+lock = threading.Lock()
+
+
+def get_session(workers):
+    retry = Retry(total=5, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504],
+                  respect_retry_after_header=True)
+    session = requests.Session()
+    session.mount('http', HTTPAdapter(pool_maxsize=workers, max_retries=retry))
+    return session
+
+
+def solr(session, url, query, **params):
+    """One Solr request through the Islandora REST solr endpoint"""
+    response = session.get(f'{url}/v1/solr/{quote(query, safe="")}',
+                           params={'fl': ','.join(FIELDS), 'wt': 'json', **params}, timeout=120)
+    response.raise_for_status()
+    return response.json()
+
+
+class Harvest:
+    """all-items.csv plus per-prefix cursors, appended to as results arrive"""
+
+    def __init__(self, item_file):
+        self.item_file = item_file
+        self.cursor_file = os.path.splitext(item_file)[0] + '.cursors.json'
+        self.completed = set()
+        self.cursors = {}
+        if os.path.isfile(item_file):
+            self.completed = set(pd.read_csv(item_file)['pid'].tolist())
+            print(f'{len(self.completed)} items already found')
+        if os.path.isfile(self.cursor_file):
+            with open(self.cursor_file) as f:
+                self.cursors = json.load(f)
+
+    def add(self, docs, prefix=None, cursor=None):
+        rows = []
+        for doc in docs:
+            try:
+                if doc['PID'] in self.completed or 'book' in str(doc.get('RELS_EXT_hasModel_uri_ms')):
+                    continue
+                rows.append({'pid': doc['PID'], 'identifier': doc['mods_identifier_local_displayLabel_ms'][0]})
+            except (KeyError, IndexError) as e:
+                print(f"Skipping {doc.get('PID')}: missing {e}")
+        with lock:
+            rows = [row for row in rows if row['pid'] not in self.completed]
+            if rows:
+                pd.DataFrame(rows).to_csv(self.item_file, mode='a', index=False,
+                                          header=not os.path.isfile(self.item_file))
+                self.completed.update(row['pid'] for row in rows)
+            if prefix is not None:
+                self.cursors[prefix] = cursor
+                tmp = self.cursor_file + '.tmp'
+                with open(tmp, 'w') as f:
+                    json.dump(self.cursors, f)
+                os.replace(tmp, self.cursor_file)
+        return len(rows)
+
+
+def walk_prefix(session, url, namespace, prefix, harvest, rows):
+    """cursorMark paging over PID:ns:<prefix>*, sorted on PID; returns new items"""
+    cursor = harvest.cursors.get(prefix, '*')
+    if cursor == 'done':
+        return 0
+    query = f'PID:{namespace}\\:{prefix}* AND {PAGE_MODEL}'
+    added = 0
+    while True:
+        res = solr(session, url, query, sort='PID asc', rows=rows, cursorMark=cursor)
+        next_cursor = res['nextCursorMark']
+        done = next_cursor == cursor
+        added += harvest.add(res['response']['docs'], prefix, 'done' if done else next_cursor)
+        if done:
+            return added
+        cursor = next_cursor
+
+
+def lookup_batch(session, url, pids, harvest):
+    query = 'PID:(' + ' OR '.join(f'"{pid}"' for pid in pids) + f') AND {PAGE_MODEL}'
+    res = solr(session, url, query, rows=len(pids))
+    return harvest.add(res['response']['docs'])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Harvest page PIDs and identifiers from Islandora Solr')
+    parser.add_argument('--url', default=os.environ.get('ISLANDORA_URL', 'https://digital.lib.ku.edu/islandora/rest'))
+    parser.add_argument('--namespace', default=os.environ.get('COLL_NS'), required='COLL_NS' not in os.environ)
+    parser.add_argument('--max-pid', type=int, default=200656, help='highest PID number in the namespace')
+    parser.add_argument('--workers', type=int, default=8, help='concurrent Solr requests')
+    parser.add_argument('--rows', type=int, default=1000, help='docs per cursor page')
+    parser.add_argument('--batch', type=int, default=100, help='PIDs per leftover lookup')
+    parser.add_argument('--item-file', default='all-items.csv')
+    args = parser.parse_args()
+
+    session = get_session(args.workers)
+    # Test connection
+    try:
+        solr(session, args.url, 'PID:*root', rows=0)
+        print("✓ Islandora connection successful")
+    except Exception as e:
+        print(f"✗ Islandora connection failed: {e}")
+        sys.exit()
+
+    harvest = Harvest(args.item_file)
+    start = time.time()
+    prefixes = [str(i) for i in range(10, 100)]
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        found = executor.map(lambda p: walk_prefix(session, args.url, args.namespace, p, harvest, args.rows),
+                             prefixes)
+        for prefix, added in zip(prefixes, found):
+            if added:
+                print(f'{prefix}*: {added} new items ({len(harvest.completed)} total)')
+    print(f"{len(harvest.completed)} retrieved by prefix walk in {time.time() - start:.0f}s")
+
+    # not all were caught for some reason, so scooping up missed ones
+    # note that this does query some legit missing pids, e.g., deleted items
+    existing_numbers = {int(s.split(':')[1]) for s in harvest.completed if s.split(':')[1].isdigit()}
+    missing = [f'{args.namespace}:{m}' for m in sorted(set(range(1, args.max_pid + 1)) - existing_numbers)]
+    batches = [missing[i:i + args.batch] for i in range(0, len(missing), args.batch)]
+    print(f"{len(missing)} not found in first query. Looking up in {len(batches)} batches.")
+
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        added = sum(executor.map(lambda b: lookup_batch(session, args.url, b, harvest), batches))
+
+    print(f"Done - {len(harvest.completed)} collected ({added} from lookups) in {time.time() - start:.0f}s")
@@ -1,36 +1,159 @@
 #!/usr/bin/env python3
 
-import redis
+# queue progress, throughput, ETA and a parallelism recommendation
+#
+#   python monitor_queue.py                    # table every --interval seconds
+#   python monitor_queue.py --json --once      # one JSON object, for scripts
+#
+# The completion rate is the drop in remaining (pending + processing) tasks
+# over the last --window seconds. Per-worker rates come from the heartbeats
+# workers write to <queue>:workers (task_queue.heartbeat): pages processed
+# since the previous sample, or since the worker started on the first one.
+# Workers beat once per page, so one is counted live until --heartbeat-age
+# (default the lease time) passes without a beat.
+# Stuck leases are tasks leased longer than LEASE_MS ago whose worker has not
+# renewed them - usually a killed pod; another worker reclaims them.
+# Bucket is how full the fleet's LLM rate limit buckets are (rate_limit.py):
+# near 0% the limit, not the pod count, is what sets the pace.
+#
+# The recommended parallelism is the number of pods at the median measured
+# per-pod rate needed to finish the remaining tasks within --deadline-hours.
+
+import sys
+import json
+import math
 import time
 import argparse
+import statistics
+from collections import deque
+from pathlib import Path
+
+# shared redis pool lives in the repo root, next to worker.py
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+import redis_pool
+import task_queue
+import rate_limit
+
+
+def worker_rates(beats, previous):
+    """{worker: pages/s}, from the change since the previous heartbeat seen"""
+    rates = {}
+    for worker, beat in beats.items():
+        last = previous.get(worker)
+        if last and beat['ts'] > last['ts'] and beat['processed'] >= last['processed']:
+            rates[worker] = (beat['processed'] - last['processed']) / (beat['ts'] - last['ts'])
+        elif beat['ts'] > beat.get('started', beat['ts']):
+            rates[worker] = beat['processed'] / (beat['ts'] - beat['started'])
+    return rates
+
+
+def recommend(remaining, pod_rate, deadline_hours, max_parallelism):
+    if not remaining or not pod_rate:
+        return None
+    return min(max_parallelism, max(1, math.ceil(remaining / (pod_rate * deadline_hours * 3600))))
+
+
+def format_eta(seconds):
+    if seconds is None:
+        return '-'
+    hours, rest = divmod(int(seconds), 3600)
+    return f'{hours}h{rest // 60:02d}m'
+
+
+def sample(r, queue, samples, window, previous, args):
+    now = time.time()
+    status = task_queue.queue_status(r, queue)
+    remaining = status['pending'] + status['processing']
+    samples.append((now, remaining))
+    while len(samples) > 2 and now - samples[0][0] > window:
+        samples.popleft()
 
-def monitor_progress():
+    rate = None
+    (t0, r0), (t1, r1) = samples[0], samples[-1]
+    if t1 > t0:
+        rate = max(0.0, (r0 - r1) / (t1 - t0))
+
+    beats = task_queue.live_workers(r, queue, args.heartbeat_age)
+    rates = worker_rates(beats, previous)
+    previous.clear()
+    previous.update(beats)
+    pod_rate = statistics.median(rates.values()) if rates else None
+    if rate is None and rates:
+        rate = sum(rates.values())
+
+    return {
+        'time': now,
+        **status,
+        'remaining': remaining,
+        'stuck_leases': task_queue.stuck_leases(r, queue),
+        'workers': len(beats),
+        'rate': rate,
+        'pod_rate': pod_rate,
+        'worker_rates': rates,
+        'eta_seconds': remaining / rate if rate else None,
+        'recommended_parallelism': recommend(remaining, pod_rate, args.deadline_hours, args.max_parallelism),
+        'llm_buckets': rate_limit.levels(r),
+    }
+
+
+def print_row(s):
+    rate = f"{s['rate'] * 60:.1f}" if s['rate'] is not None else '-'
+    pod_rate = f"{s['pod_rate'] * 60:.2f}" if s['pod_rate'] is not None else '-'
+    buckets = ' '.join(f"{name}={b['fill']:.0%}" for name, b in s['llm_buckets'].items()) or '-'
+    print(f"{time.strftime('%H:%M:%S', time.localtime(s['time']))}\t{s['pending']}\t{s['processing']}\t\t"
+          f"{s['failed']}\t{s['stuck_leases']}\t{s['workers']}\t{rate}\t{pod_rate}\t\t"
+          f"{format_eta(s['eta_seconds'])}\t{s['recommended_parallelism'] or '-'}\t\t{buckets}")
+
+
+def monitor_progress(args):
     """Monitor queue progress in real-time"""
-    r = redis.Redis(host='localhost', port=6379, db=0)
-    queue_name = 'newspaper-jobs'
+    r = redis_pool.get_redis_connection(host=args.host)
+    samples = deque()
+    previous = {}
+    s = {}
 
-    print("Monitoring queue progress (Ctrl+C to stop)...")
-    print("Time\t\tPending\tProcessing\tFailed")
+    if not args.json:
+        print("Monitoring queue progress (Ctrl+C to stop)...")
+        print(f"Rates are pages/min; parallelism = pods to finish within {args.deadline_hours:g}h")
+        print("Time\t\tPending\tProcessing\tFailed\tStuck\tWorkers\tRate\tPer pod\t\tETA\tParallelism\tBucket")
 
     try:
         while True:
-            pending = r.llen(queue_name)
-            processing = r.llen(f'{queue_name}:processing')
-            failed = r.llen(f'{queue_name}:failed')
-
-            timestamp = time.strftime('%H:%M:%S')
-            print(f"{timestamp}\t{pending}\t{processing}\t\t{failed}")
+            s = sample(r, args.queue, samples, args.window, previous, args)
+            if args.json:
+                print(json.dumps(s), flush=True)
+            else:
+                print_row(s)
 
-            if pending == 0 and processing == 0:
-                print("All jobs completed!")
+            if s['pending'] == 0 and s['processing'] == 0:
+                if not args.json:
+                    print("All jobs completed!")
+                break
+            if args.once:
                 break
 
-            time.sleep(10)
+            time.sleep(args.interval)
 
     except KeyboardInterrupt:
-        print("\nMonitoring stopped")
+        print("\nMonitoring stopped", file=sys.stderr)
+
+    if not args.json and s.get('recommended_parallelism'):
+        print(f"\nTo finish in {args.deadline_hours:g}h at {s['pod_rate'] * 60:.2f} pages/min per pod:")
+        print(f"  kubectl patch job newspaper-processing -p "
+              f"'{{\"spec\":{{\"parallelism\":{s['recommended_parallelism']}}}}}'")
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Monitor queue progress')
+    parser.add_argument('--queue', default='newspaper-jobs')
+    parser.add_argument('--host', default='localhost', help='redis host (port-forwarded by default)')
+    parser.add_argument('--interval', type=float, default=10, help='seconds between samples')
+    parser.add_argument('--window', type=float, default=600, help='seconds the completion rate is averaged over')
+    parser.add_argument('--deadline-hours', type=float, default=24, help='finish time the parallelism is sized for')
+    parser.add_argument('--max-parallelism', type=int, default=100)
+    parser.add_argument('--heartbeat-age', type=float, default=task_queue.LEASE_MS / 1000,
+                        help='seconds since its last heartbeat before a worker stops counting as live')
+    parser.add_argument('--json', action='store_true', help='one JSON object per sample (JSON lines)')
+    parser.add_argument('--once', action='store_true', help='take one sample and exit')
     args = parser.parse_args()
-    monitor_progress()
+    monitor_progress(args)
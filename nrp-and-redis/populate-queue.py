@@ -6,6 +6,22 @@ import pandas as pd
 import csv
 import glob
 import sys
+import time
+import argparse
+from pathlib import Path
+
+# shared redis pool lives in the repo root, next to worker.py
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+import redis_pool
+import task_queue
+import completion_index
+
+parser = argparse.ArgumentParser(description='Add unprocessed pids to the work queue')
+parser.add_argument('--reset', action='store_true', help='empty the queue before adding')
+parser.add_argument('--repass', action='store_true',
+                    help='queue pids again that were already finished or failed this pass (keeps the queue)')
+parser.add_argument('--chunk', type=int, default=2000, help='tasks per redis call')
+args = parser.parse_args()
 
 # Read all PIDs to process
 try:
@@ -14,36 +30,18 @@ except:
     print('all_items.csv not found. This must be created first via full-solr-query.py')
     sys.exit()
 
-completed = set()
+# completed pids per stage come from the completion index (completion_index.py):
+# consolidate.py maintains /shared-output/consolidated/completed.sqlite - copy
+# it to data/ - and any pages files in data/ not indexed yet are added here
+# (pages_* and merged_data_pages_* only, not lp_pages_*)
+index = completion_index.open_index('data/completed.sqlite')
+completion_index.update_from_files(index, glob.glob('data/*'), 'pages')
+
 # OPTION A - assume all captured PIDs are complete
-for file in glob.glob('data/*pages*.csv'):
-    try:
-        with open(file, 'r') as f:
-            header = f.readline().strip().split(',')
-            pid_idx = header.index('pid')
-            for line in f:
-                completed.add(line.split(',')[pid_idx])
-    except:
-        pass
+completed = completion_index.completed(index, 'pages')
 
 # # OPTION B - 2nd pass - only PIDs with page,num,vol,or date are complete
-# for file in glob.glob('data/*pages*.csv'):
-#     try:
-#         with open(file, 'r') as f:
-#             header = f.readline().strip().split(',')
-#             pid_idx = header.index('pid')
-#             page_idx = header.index('page')
-#             date_idx = header.index('date')
-#             vol_idx = header.index('volume')
-#             num_idx = header.index('number')
-#
-#             for line in f:
-#                 parts = line.split(',')
-#                 # Add if ANY of these have a value
-#                 if parts[page_idx] or parts[date_idx] or parts[vol_idx] or parts[num_idx]:
-#                     completed.add(parts[pid_idx])
-#     except:
-#         pass
+# completed = completion_index.completed(index, 'pages', ['page', 'date', 'volume', 'number'])
 
 # OPTION C - run all pages
 # no lines to comment out
@@ -61,30 +59,25 @@ print(f"To process: {len(to_process)}")
 
 # print(to_process)
 
-# Populate Redis with batching
-r = redis.Redis(host='localhost', port=6379, db=0)
-r.delete('newspaper-jobs')
-r.delete('newspaper-jobs:processing')
-
-# Batch insert using pipeline
-BATCH_SIZE = 5000
-pipe = r.pipeline()
-count = 0
-
-for _, row in to_process.iterrows():
-    # print(row['pid'])
-    # print(row['identifier'])
-    task = {'pid': row['pid'], 'identifier': row['identifier']}
-    pipe.lpush('newspaper-jobs', json.dumps(task))
-    count += 1
-
-    # Execute batch every BATCH_SIZE items
-    if count % BATCH_SIZE == 0:
-        pipe.execute()
-        print(f"Processed {count}/{len(to_process)}")
+# Populate Redis - additive: pids already enqueued this pass (queued, in
+# process, done or failed) are skipped (see task_queue.enqueue_tasks), so this
+# can top up a running job even when data/completed.sqlite is out of date.
+# --reset empties the queue first, as this script used to every time;
+# --repass keeps the queue but lets finished pids be queued again.
+r = redis_pool.get_redis_connection(host='localhost')
+if args.reset:
+    r.delete('newspaper-jobs', 'newspaper-jobs:processing', task_queue.enqueued_key('newspaper-jobs'))
+elif args.repass:
+    print(f"New pass: {task_queue.reset_enqueued(r, 'newspaper-jobs')} pids still queued or in process")
+if task_queue.QUEUE_BACKEND == 'stream':
+    task_queue.ensure_group(r, 'newspaper-jobs')
 
-# Execute remaining items
-if count % BATCH_SIZE != 0:
-    pipe.execute()
+start = time.time()
+added = task_queue.enqueue_tasks(r, 'newspaper-jobs',
+                                 {'pid': to_process['pid'].tolist(),
+                                  'identifier': to_process['identifier'].tolist()},
+                                 chunk=args.chunk)
+elapsed = time.time() - start
 
-print(f"Queue populated with {len(to_process)} tasks")
+print(f"Queue populated with {added} tasks ({len(to_process) - added} already queued) "
+      f"in {elapsed:.1f}s, {len(to_process) / max(elapsed, 1e-6):.0f} tasks/s")
@@ -0,0 +1,265 @@
+# Islandora datastream fetching shared by worker.py and worker_lp.py
+#
+# Fetched datastreams are cached on the shared PVC, keyed by a hash of
+# pid + datastream id, so a page downloaded by worker_lp.py is not downloaded
+# again by worker.py or on a retry/reprocessing pass. worker_lp.py reads pages
+# through open_page_image (JP2 where the page has one, else OBJ); worker.py
+# does too with LP_SOURCE=store, so the stored boxes match its crops, and
+# otherwise sends the OBJ. Writes are atomic
+# (temp file + rename) so pods never read a partial file, and the cache is
+# kept under IMAGE_CACHE_GB (default 20, a fifth of the 100Gi PVC that also
+# holds the outputs and the LLM cache) by evicting least recently used files (a hit
+# touches the file's mtime).
+#
+# Requests go through one keep-alive requests.Session per process, so pages
+# reuse TLS connections, and transient 429/5xx responses are retried by
+# urllib3 (honoring Retry-After).
+#
+# Downloads are streamed to the cache file (never held whole in memory) with
+# a MAX_IMAGE_MB guard, and open_image() decodes at a reduced scale where the
+# codec can do it cheaply (JPEG draft mode, JPEG2000 reduce levels).
+
+import os
+import time
+import io
+import math
+import hashlib
+import resource
+import logging
+import tempfile
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from PIL import Image
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+ISLANDORA_URL = 'https://digital.lib.ku.edu/islandora/object'
+
+CACHE_DIR = os.environ.get('IMAGE_CACHE_DIR', '/shared-output/image-cache')
+CACHE_MAX_BYTES = int(float(os.environ.get('IMAGE_CACHE_GB', 20)) * 1024 ** 3)
+# eviction scans the whole cache, so only check every N writes per worker
+EVICT_EVERY = 200
+
+cache_stats = {'hits': 0, 'misses': 0, 'bytes_saved': 0, 'evictions': 0}
+_writes = 0
+
+MAX_IMAGE_BYTES = int(float(os.environ.get('MAX_IMAGE_MB', 200)) * 1024 ** 2)
+
+HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', 8))
+_session = None
+_session_lock = threading.Lock()
+
+# JP2 vs OBJ: remembered per pid, and once JP2_STREAK pages in a namespace
+# have a JP2, assumed for the rest of it (a wrong guess falls back on 404).
+# An OBJ streak is never assumed: a page that does have a JP2 would be read
+# from OBJ, in a different pixel space than its stored LP boxes.
+JP2_STREAK = 20
+_pid_datastream = {}
+_namespace_datastream = {}
+
+
+def get_session():
+    global _session
+    with _session_lock:
+        if _session is None:
+            retry = Retry(total=3, backoff_factor=1,
+                          status_forcelist=[429, 500, 502, 503, 504],
+                          allowed_methods=['HEAD', 'GET'],
+                          respect_retry_after_header=True,
+                          raise_on_status=False)
+            adapter = HTTPAdapter(pool_connections=2, pool_maxsize=HTTP_POOL_SIZE, max_retries=retry)
+            _session = requests.Session()
+            _session.mount('https://', adapter)
+            _session.mount('http://', adapter)
+        return _session
+
+
+def datastream_url(pid, dsid):
+    return f'{ISLANDORA_URL}/{pid}/datastream/{dsid}/view'
+
+
+def cache_path(pid, dsid):
+    key = hashlib.sha256(f'{pid}/{dsid}'.encode('utf-8')).hexdigest()
+    return os.path.join(CACHE_DIR, key[:2], key)
+
+
+def evict(max_bytes=CACHE_MAX_BYTES):
+    """Delete least recently used files until the cache is under 90% of max_bytes"""
+    files = []
+    total = 0
+    for root, _, names in os.walk(CACHE_DIR):
+        for name in names:
+            path = os.path.join(root, name)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            # temp files left by a killed pod
+            if name.startswith('.tmp-') and st.st_mtime < time.time() - 3600:
+                os.remove(path)
+                continue
+            files.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+    if total <= max_bytes:
+        return
+
+    target = max_bytes * 0.9
+    for _, size, path in sorted(files):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass  # another pod evicted it first
+        total -= size
+        cache_stats['evictions'] += 1
+        if total <= target:
+            break
+    logger.info(f"Image cache evicted to {total / 1024 ** 3:.1f}GB")
+
+
+def is_cached(pid, dsid):
+    return bool(CACHE_DIR) and os.path.exists(cache_path(pid, dsid))
+
+
+def _stream_to(response, f):
+    length = int(response.headers.get('Content-Length') or 0)
+    if length > MAX_IMAGE_BYTES:
+        raise ValueError(f"Datastream is {length} bytes, over MAX_IMAGE_MB")
+    total = 0
+    for chunk in response.iter_content(chunk_size=1024 * 1024):
+        total += len(chunk)
+        if total > MAX_IMAGE_BYTES:
+            raise ValueError(f"Datastream over {MAX_IMAGE_BYTES} bytes, aborting download")
+        f.write(chunk)
+    metrics.inc('bytes_total', total, direction='downloaded')
+
+
+def open_datastream(pid, dsid='OBJ', timeout=60):
+    """Readable binary file for the datastream: the cached copy, or a streamed download"""
+    global _writes
+    path = cache_path(pid, dsid)
+    if CACHE_DIR:
+        try:
+            f = open(path, 'rb')
+            os.utime(path)  # mark as recently used
+            cache_stats['hits'] += 1
+            cache_stats['bytes_saved'] += os.fstat(f.fileno()).st_size
+            metrics.inc('image_cache_total', result='hit')
+            return f
+        except OSError:
+            pass
+    cache_stats['misses'] += 1
+    metrics.inc('image_cache_total', result='miss')
+
+    with metrics.timer('stage_seconds', stage='download'), \
+            get_session().get(datastream_url(pid, dsid), timeout=timeout, stream=True) as response:
+        response.raise_for_status()
+        if not CACHE_DIR:
+            buffer = io.BytesIO()
+            _stream_to(response, buffer)
+            buffer.seek(0)
+            return buffer
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                _stream_to(response, f)
+            os.replace(tmp, path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+    _writes += 1
+    if _writes % EVICT_EVERY == 0:
+        evict()
+    return open(path, 'rb')
+
+
+def get_datastream(pid, dsid='OBJ', timeout=60):
+    """Datastream bytes from the PVC cache, or from Islandora (then cached)"""
+    with open_datastream(pid, dsid, timeout) as f:
+        return f.read()
+
+
+def open_image(pid, dsid='OBJ', scale=1, timeout=60):
+    """Decoded RGB page and the factor it was reduced by (1 = full resolution)
+
+    scale > 1 asks for roughly 1/scale of the width and height. JPEG and
+    JPEG2000 decode straight to the smaller size; other formats are decoded
+    in full and then reduced.
+    """
+    with open_datastream(pid, dsid, timeout) as f, metrics.timer('stage_seconds', stage='decode'):
+        image = Image.open(f)
+        full_width = image.size[0]
+        if scale > 1 and image.format == 'JPEG':
+            image.draft('RGB', (image.size[0] // scale, image.size[1] // scale))
+        elif scale > 1 and image.format == 'JPEG2000':
+            image.reduce = int(math.log2(scale))
+        image.load()
+        if scale > 1 and image.size[0] == full_width:
+            image = image.reduce(int(scale))
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+    return image, full_width / image.size[0]
+
+
+def memory_mb():
+    """(current RSS, peak RSS) of this process in MB"""
+    with open('/proc/self/statm') as f:
+        rss_pages = int(f.read().split()[1])
+    rss = rss_pages * os.sysconf('SC_PAGE_SIZE') / 1024 ** 2
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # KB on linux
+    return rss, peak
+
+
+def _remember_datastream(pid, dsid):
+    _pid_datastream[pid] = dsid
+    namespace = pid.split(':')[0]
+    known, streak = _namespace_datastream.get(namespace, (None, 0))
+    streak = streak + 1 if known == dsid else 1
+    _namespace_datastream[namespace] = (dsid, streak)
+
+
+def preferred_datastream(pid):
+    """'JP2' if the page has one, else 'OBJ' - without a HEAD request when known"""
+    for dsid in ('JP2', 'OBJ'):
+        if is_cached(pid, dsid):
+            return dsid
+    if pid in _pid_datastream:
+        return _pid_datastream[pid]
+    known, streak = _namespace_datastream.get(pid.split(':')[0], (None, 0))
+    if known == 'JP2' and streak >= JP2_STREAK:
+        return known
+    try:
+        r = get_session().head(datastream_url(pid, 'JP2'), timeout=5, allow_redirects=True)
+        dsid = 'JP2' if r.status_code == 200 else 'OBJ'
+    except Exception as e:
+        dsid = 'OBJ'
+    return dsid
+
+
+def open_page_image(pid, scale=1, timeout=60):
+    """(image, reduced_by) for the page's JP2, falling back to OBJ"""
+    dsid = preferred_datastream(pid)
+    try:
+        result = open_image(pid, dsid, scale, timeout)
+    except requests.HTTPError as e:
+        if dsid != 'JP2' or e.response is None or e.response.status_code != 404:
+            raise
+        # namespace guess was wrong for this page
+        dsid = 'OBJ'
+        result = open_image(pid, dsid, scale, timeout)
+    _remember_datastream(pid, dsid)
+    return result
+
+
+def log_cache_stats():
+    lookups = cache_stats['hits'] + cache_stats['misses']
+    rate = cache_stats['hits'] / lookups if lookups else 0
+    logger.info(f"Image cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses ({rate:.0%}), "
+                f"{cache_stats['bytes_saved'] / 1024 ** 2:.0f}MB not downloaded, "
+                f"{cache_stats['evictions']} evictions")
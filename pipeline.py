@@ -0,0 +1,193 @@
+# staged prefetch pipeline for the worker main loop
+#
+#   lease (feeder thread) -> fetch pool -> detect thread -> ready queue -> main loop (LLM)
+#
+# At most `prefetch` tasks sit between leasing and the main loop, so the number
+# of decoded pages held in memory is capped at prefetch + 1. Each stage records
+# busy time and log_stats() reports utilization: the stage closest to 100% is
+# the bottleneck, and a high 'starved' share means the LLM stage is waiting on
+# the stages before it.
+
+import time
+import queue
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# queue signals from get_next_task that end or pause the stream
+SIGNALS = ("QUEUE_EMPTY", "REDIS_ERROR", None)
+# after a None (nothing to lease right now) wait this long before leasing
+# again; the pipeline owns polling, so the main loop doesn't sleep as well
+IDLE_SECONDS = 10
+
+# tasks leased but not yet handed to the main loop (for lease renewal)
+in_flight = []
+
+stage_stats = {}
+_stats_lock = threading.Lock()
+_started = time.time()
+
+
+def _record(stage, seconds, workers=1):
+    with _stats_lock:
+        s = stage_stats.setdefault(stage, {'busy': 0.0, 'items': 0, 'workers': workers})
+        s['busy'] += seconds
+        s['items'] += 1
+    metrics.observe('stage_seconds', seconds, stage=stage)
+
+
+def timed(stage, func, *args, workers=1):
+    start = time.time()
+    try:
+        return func(*args)
+    finally:
+        _record(stage, time.time() - start, workers)
+
+
+def log_stats():
+    elapsed = time.time() - _started
+    parts = []
+    for stage, s in stage_stats.items():
+        util = s['busy'] / (elapsed * s['workers']) if elapsed else 0
+        avg = s['busy'] / s['items'] if s['items'] else 0
+        parts.append(f"{stage}={util:.0%} ({s['items']} x {avg:.1f}s)")
+    logger.info(f"Pipeline utilization over {elapsed:.0f}s: {', '.join(parts)}")
+
+
+def run_pipeline(next_task, fetch, detect, prefetch=2, fetch_workers=2,
+                 batch_detect=None, batch_size=1):
+    """Yield (task, image, lp_data, error) per leased task, or (signal, None, None, None)
+
+    fetch(task) returns the page image and detect(task, image) its LP results;
+    an exception in either is returned as error so the caller can fail the task.
+    With batch_detect(tasks, images) and batch_size > 1 the detect stage runs
+    up to batch_size already-fetched pages per call.
+    prefetch=0 runs every stage inline, one task at a time.
+    """
+    if prefetch <= 0:
+        yield from _run_serial(next_task, fetch, detect)
+    else:
+        if batch_detect is None:
+            batch_size = 1
+        yield from _run_threaded(next_task, fetch, detect, prefetch, fetch_workers,
+                                 batch_detect, batch_size)
+
+
+def _run_serial(next_task, fetch, detect):
+    while True:
+        task = timed('lease', next_task)
+        if task in SIGNALS:
+            yield task, None, None, None
+            if task is None:
+                time.sleep(IDLE_SECONDS)
+            continue
+        try:
+            image = timed('fetch', fetch, task)
+            lp_data = timed('detect', detect, task, image)
+            item = (task, image, lp_data, None)
+        except Exception as e:
+            item = (task, None, None, e)
+        start = time.time()
+        yield item
+        _record('llm', time.time() - start)
+
+
+def _run_threaded(next_task, fetch, detect, prefetch, fetch_workers, batch_detect, batch_size):
+    slots = threading.Semaphore(prefetch)
+    fetched = queue.Queue(maxsize=prefetch)
+    ready = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+    pool = ThreadPoolExecutor(max_workers=fetch_workers)
+
+    def fetch_stage(task):
+        try:
+            image = timed('fetch', fetch, task, workers=fetch_workers)
+            fetched.put((task, image, None))
+        except Exception as e:
+            fetched.put((task, None, e))
+
+    def detect_one(task, image):
+        try:
+            return task, image, timed('detect', detect, task, image), None
+        except Exception as e:
+            return task, None, None, e
+
+    def detect_stage():
+        while not stop.is_set():
+            # block for one page, then take whatever else is already fetched
+            batch = [fetched.get()]
+            while len(batch) < batch_size:
+                try:
+                    batch.append(fetched.get_nowait())
+                except queue.Empty:
+                    break
+
+            for task, _, error in batch:
+                if error is not None:
+                    ready.put((task, None, None, error))
+            batch = [(task, image) for task, image, error in batch if error is None]
+            if not batch:
+                continue
+
+            if len(batch) == 1:
+                ready.put(detect_one(*batch[0]))
+                continue
+            try:
+                tasks = [t for t, _ in batch]
+                images = [i for _, i in batch]
+                lp_batch = timed('detect', batch_detect, tasks, images)
+                for task, image, lp_data in zip(tasks, images, lp_batch):
+                    ready.put((task, image, lp_data, None))
+            except Exception as e:
+                logger.warning(f"Batched detection failed ({str(e)}), retrying pages one at a time")
+                for task, image in batch:
+                    ready.put(detect_one(task, image))
+
+    def feeder():
+        while not stop.is_set():
+            slots.acquire()  # backpressure: wait for the main loop to take a task
+            try:
+                task = timed('lease', next_task)
+            except Exception as e:
+                logger.error(f"Pipeline lease failed: {str(e)}")
+                task = "REDIS_ERROR"
+            if task not in SIGNALS:
+                in_flight.append(task)
+                pool.submit(fetch_stage, task)
+                continue
+
+            # let in-flight tasks reach the main loop before it sees the signal
+            slots.release()
+            for _ in range(prefetch):
+                slots.acquire()
+            ready.put((task, None, None, None))
+            for _ in range(prefetch):
+                slots.release()
+            if task is not None:
+                return
+            time.sleep(IDLE_SECONDS)
+
+    threading.Thread(target=feeder, daemon=True, name='pipeline-lease').start()
+    threading.Thread(target=detect_stage, daemon=True, name='pipeline-detect').start()
+
+    try:
+        while True:
+            start = time.time()
+            item = ready.get()
+            _record('starved', time.time() - start)
+            task = item[0]
+            if task not in SIGNALS:
+                in_flight.remove(task)
+                slots.release()
+
+            start = time.time()
+            yield item
+            if task not in SIGNALS:
+                _record('llm', time.time() - start)
+    finally:
+        stop.set()
+        pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,134 @@
+# cluster-wide token buckets for the LLM endpoint, shared through Redis
+#
+# Every worker's llm_query takes one request token and one token per image
+# byte before sending. The buckets live in Redis and are refilled and taken
+# from in a single Lua call, using the Redis server's clock, so the whole
+# fleet together stays under LLM_RATE_RPS requests/s and
+# LLM_RATE_BYTES_PER_SEC image bytes/s however many pods are running. Each
+# bucket holds up to LLM_RATE_BURST_SECONDS of its rate. A rate of 0 turns
+# that bucket off, and with both off (the default) take() returns at once.
+#
+# When Redis can't be reached the request goes ahead unthrottled. The
+# per-pod limiter (llm_limit.py) still backs off if the endpoint objects.
+
+import os
+import time
+import random
+import logging
+import redis
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+LLM_RATE_RPS = float(os.environ.get('LLM_RATE_RPS', 0))
+LLM_RATE_BYTES_PER_SEC = float(os.environ.get('LLM_RATE_BYTES_PER_SEC', 0))
+LLM_RATE_BURST_SECONDS = float(os.environ.get('LLM_RATE_BURST_SECONDS', 2))
+
+BUCKETS = {'requests': 'llm-rate:requests', 'bytes': 'llm-rate:bytes'}
+
+rate_stats = {'taken': 0, 'throttled': 0, 'wait_seconds': 0.0, 'errors': 0}
+
+# Each bucket is a hash of tokens, last refill time, rate and burst. Tokens
+# are taken from every bucket or none; otherwise returns the seconds until
+# all of them could cover the cost.
+_TAKE = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local levels = {}
+local wait = 0
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[i * 3 - 2])
+    local burst = tonumber(ARGV[i * 3 - 1])
+    local cost = math.min(tonumber(ARGV[i * 3]), burst)
+    local state = redis.call('HMGET', key, 'tokens', 'ts')
+    local tokens = tonumber(state[1]) or burst
+    local ts = tonumber(state[2]) or now
+    tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+    levels[i] = tokens
+    if tokens < cost then
+        wait = math.max(wait, (cost - tokens) / rate)
+    end
+end
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[i * 3 - 2])
+    local burst = tonumber(ARGV[i * 3 - 1])
+    local tokens = levels[i]
+    if wait == 0 then
+        tokens = tokens - math.min(tonumber(ARGV[i * 3]), burst)
+    end
+    redis.call('HSET', key, 'tokens', tokens, 'ts', now, 'rate', rate, 'burst', burst)
+    redis.call('EXPIRE', key, math.ceil(burst / rate) + 60)
+end
+return tostring(wait)
+"""
+_script = None
+
+
+def _buckets(image_bytes):
+    """[(key, rate, burst, cost)] for the buckets that are switched on"""
+    buckets = []
+    if LLM_RATE_RPS > 0:
+        buckets.append((BUCKETS['requests'], LLM_RATE_RPS, max(1, LLM_RATE_RPS * LLM_RATE_BURST_SECONDS), 1))
+    if LLM_RATE_BYTES_PER_SEC > 0:
+        buckets.append((BUCKETS['bytes'], LLM_RATE_BYTES_PER_SEC,
+                        LLM_RATE_BYTES_PER_SEC * LLM_RATE_BURST_SECONDS, image_bytes))
+    return buckets
+
+
+def take(r, image_bytes, deadline=None):
+    """Block until the fleet's buckets have room for one request of image_bytes
+
+    Raises TimeoutError if that can't happen before deadline.
+    """
+    buckets = _buckets(image_bytes)
+    if not buckets:
+        return 0
+    global _script
+    if _script is None:
+        _script = r.register_script(_TAKE)
+    start = time.time()
+    try:
+        while True:
+            wait = float(_script(keys=[b[0] for b in buckets],
+                                 args=[v for b in buckets for v in b[1:]], client=r))
+            if wait == 0:
+                break
+            rate_stats['throttled'] += 1
+            if deadline is not None and time.time() + wait > deadline:
+                raise TimeoutError(f"LLM rate limit would delay the request past its deadline ({wait:.1f}s)")
+            # jitter so pods that were refused together don't all come back together
+            time.sleep(wait * random.uniform(1, 1.2))
+    except redis.RedisError as e:
+        rate_stats['errors'] += 1
+        logger.warning(f"Rate limiter unavailable, sending unthrottled: {str(e)}")
+        return 0
+    waited = time.time() - start
+    rate_stats['taken'] += 1
+    rate_stats['wait_seconds'] += waited
+    metrics.observe('stage_seconds', waited, stage='llm_rate')
+    return waited
+
+
+def levels(r):
+    """{bucket: {'tokens', 'burst', 'rate', 'fill'}} as of now, for monitor_queue.py"""
+    seconds, micros = r.time()
+    now = seconds + micros / 1e6
+    result = {}
+    for name, key in BUCKETS.items():
+        state = r.hgetall(key)
+        if not state:
+            continue
+        state = {k.decode('utf-8'): float(v) for k, v in state.items()}
+        tokens = min(state['burst'], state['tokens'] + max(0, now - state['ts']) * state['rate'])
+        result[name] = {'tokens': tokens, 'burst': state['burst'], 'rate': state['rate'],
+                        'fill': tokens / state['burst']}
+    return result
+
+
+def log_stats():
+    if not _buckets(0):
+        return
+    s = rate_stats
+    logger.info(f"LLM rate limit: {s['taken']} requests, {s['throttled']} throttled, "
+                f"{s['wait_seconds']:.0f}s waiting, {s['errors']} redis errors")
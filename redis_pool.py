@@ -0,0 +1,71 @@
+# shared, process-wide redis connection pool for workers and queue scripts
+
+import os
+import logging
+import threading
+import redis
+from redis.backoff import ExponentialBackoff
+from redis.retry import Retry
+
+logger = logging.getLogger(__name__)
+
+# one pool per (host, port, db) for the life of the process
+_pools = {}
+_pools_lock = threading.Lock()
+
+# connection churn for this worker - 'connects' should stay close to
+# 'created' (pool size); a growing gap means sockets are being dropped
+connection_stats = {'created': 0, 'connects': 0, 'errors': 0}
+
+
+class CountingConnection(redis.Connection):
+    """redis.Connection that records new connections and socket (re)connects"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        connection_stats['created'] += 1
+
+    def connect(self):
+        if self._sock is None:
+            connection_stats['connects'] += 1
+        try:
+            return super().connect()
+        except redis.ConnectionError:
+            connection_stats['errors'] += 1
+            raise
+
+
+def get_pool(host, port=6379, db=0, max_connections=16):
+    """Return the shared pool for host, creating it on first use"""
+    key = (host, port, db)
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = redis.ConnectionPool(
+                connection_class=CountingConnection,
+                host=host, port=port, db=db,
+                max_connections=max_connections,
+                socket_timeout=10,
+                socket_connect_timeout=10,
+                socket_keepalive=True,
+                # PING idle connections before reuse so a restarted redis pod
+                # is noticed before a command is sent
+                health_check_interval=30,
+                # reconnect with backoff: 0.5s, 1s, 2s, 4s, 8s (capped at 10s)
+                retry=Retry(ExponentialBackoff(cap=10, base=0.5), 5),
+                retry_on_error=[redis.ConnectionError],
+            )
+            logger.info(f"Created redis connection pool for {host}:{port}/{db}")
+        return _pools[key]
+
+
+def get_redis_connection(default_host='redis-service', host=None):
+    """Client backed by the shared pool; REDIS_HOST overrides default_host"""
+    host = host or os.environ.get('REDIS_HOST', default_host)
+    return redis.Redis(connection_pool=get_pool(host))
+
+
+def log_connection_stats(worker_id=''):
+    churn = connection_stats['connects'] - connection_stats['created']
+    logger.info(f"Redis connections {worker_id}: created={connection_stats['created']}, "
+                f"connects={connection_stats['connects']}, reconnects={churn}, "
+                f"errors={connection_stats['errors']}")
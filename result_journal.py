@@ -0,0 +1,152 @@
+# write-ahead journal of finished pages, so a killed worker loses no LLM work
+#
+# worker.py appends one JSON line per finished page - the task and every row
+# it produced - to JOURNAL_DIR/<worker>.jsonl and fsyncs the file at most
+# every JOURNAL_FSYNC_SECONDS. A page's task is acked as soon as its line is
+# synced (sync() returns those tasks), instead of when the parquet file
+# holding its rows is finalized, up to OUTPUT_ROTATE_SECONDS later. Once
+# the output writer has finalized everything handed to it, the journal is
+# truncated (reset()).
+#
+# At startup recover() replays journals left by dead workers into the
+# output writer: this worker's own journal (a restarted container keeps its
+# hostname) and any other journal not written to for JOURNAL_STALE_SECONDS
+# whose worker has no recent heartbeat. A journal is claimed by renaming it,
+# so two pods never replay the same one. A pod killed mid-replay leaves its
+# claimed .recovering- file to be picked up the same way; replaying a page
+# twice only duplicates rows that consolidate.py drops.
+#
+#   python result_journal.py     # replay stale journals by hand, e.g. after the job ends
+
+import os
+import json
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+JOURNAL_DIR = os.environ.get('JOURNAL_DIR', '/shared-output/journal')
+JOURNAL_FSYNC_SECONDS = float(os.environ.get('JOURNAL_FSYNC_SECONDS', 2))
+JOURNAL_STALE_SECONDS = float(os.environ.get('JOURNAL_STALE_SECONDS', 1800))
+
+
+def _json_default(value):
+    # numpy scalars from layout detection
+    return value.item() if hasattr(value, 'item') else str(value)
+
+
+class Journal:
+    def __init__(self, worker_id, journal_dir=JOURNAL_DIR):
+        os.makedirs(journal_dir, exist_ok=True)
+        self.path = os.path.join(journal_dir, f'{worker_id}.jsonl')
+        self.file = open(self.path, 'a', encoding='utf-8')
+        self.unsynced_tasks = []
+        self.last_sync = time.time()
+        self.stats = {'pages': 0, 'syncs': 0, 'resets': 0}
+
+    def append(self, task, results):
+        """Record a finished page: its task and {stream: [row dicts]}"""
+        self.file.write(json.dumps({'task': task, 'results': results}, default=_json_default) + '\n')
+        self.unsynced_tasks.append(task)
+        self.stats['pages'] += 1
+
+    def unsynced(self):
+        return list(self.unsynced_tasks)
+
+    def sync(self, force=False):
+        """fsync if due (or forced); returns the tasks whose pages are now durable"""
+        if not self.unsynced_tasks or (not force and time.time() - self.last_sync < JOURNAL_FSYNC_SECONDS):
+            return []
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.last_sync = time.time()
+        self.stats['syncs'] += 1
+        tasks, self.unsynced_tasks = self.unsynced_tasks, []
+        return tasks
+
+    def reset(self):
+        """Truncate once every journaled row is in a finalized output file;
+        returns tasks that were still waiting on a sync"""
+        self.file.flush()
+        self.file.truncate(0)
+        self.file.seek(0)
+        self.stats['resets'] += 1
+        tasks, self.unsynced_tasks = self.unsynced_tasks, []
+        return tasks
+
+    def close(self):
+        self.file.close()
+        if os.path.getsize(self.path) == 0:
+            os.remove(self.path)
+
+    def log_stats(self):
+        logger.info(f"Journal: {self.stats['pages']} pages, {self.stats['syncs']} syncs, "
+                    f"{self.stats['resets']} truncations, {len(self.unsynced_tasks)} awaiting sync")
+
+
+def read_journal(path):
+    """Records in a journal file, skipping a line cut off by the crash"""
+    records = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                logger.warning(f"Skipping a partial record in {path}")
+    return records
+
+
+def stale_journals(worker_id, live_workers=(), journal_dir=JOURNAL_DIR):
+    """Journals to recover: this worker's own and those of workers that stopped"""
+    if not os.path.isdir(journal_dir):
+        return []
+    now = time.time()
+    paths = []
+    for entry in os.scandir(journal_dir):
+        if not entry.name.endswith('.jsonl'):
+            continue
+        owner = entry.name[:-len('.jsonl')]
+        if entry.name.startswith('.recovering-'):
+            owner = None
+        st = entry.stat()
+        if st.st_size == 0:
+            continue  # nothing to recover; a live worker's may just be idle
+        if owner == worker_id:
+            paths.append(entry.path)
+        elif owner not in live_workers and now - st.st_mtime > JOURNAL_STALE_SECONDS:
+            paths.append(entry.path)
+    return paths
+
+
+def recover(writer, worker_id, live_workers=(), journal_dir=JOURNAL_DIR):
+    """Replay stale journals into writer and finalize; returns the pages recovered"""
+    pages = 0
+    for path in stale_journals(worker_id, live_workers, journal_dir):
+        claimed = os.path.join(journal_dir, f'.recovering-{worker_id}-{os.path.basename(path)}')
+        try:
+            os.rename(path, claimed)
+            os.utime(claimed)  # not stale while this pod replays it
+        except FileNotFoundError:
+            continue  # another pod claimed it first
+        records = read_journal(claimed)
+        for record in records:
+            writer.write(record['results'])
+        writer.finalize()
+        os.remove(claimed)
+        pages += len(records)
+        if records:
+            logger.info(f"Recovered {len(records)} pages from {os.path.basename(path)}")
+    return pages
+
+
+if __name__ == "__main__":
+    import argparse
+    import result_writer
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description='Replay journals left by stopped workers into parquet output')
+    parser.add_argument('--journal-dir', default=JOURNAL_DIR)
+    parser.add_argument('--out', default='/shared-output')
+    args = parser.parse_args()
+    writer = result_writer.ResultWriter('recovered', list(result_writer.SCHEMAS), args.out)
+    print(f"Recovered {recover(writer, 'recovered', journal_dir=args.journal_dir)} pages")
@@ -0,0 +1,175 @@
+# rolling parquet output, one open file per worker per result stream
+#
+# save_results used to write a new csv per stream every 20 pages (every page
+# in worker_lp.py), leaving hundreds of thousands of small files on the PVC.
+# ResultWriter keeps one parquet file open per stream and appends a row group
+# whenever a stream has OUTPUT_ROW_GROUP_ROWS rows buffered or the buffers are
+# OUTPUT_FLUSH_SECONDS old. Files are written as .tmp-<name> and renamed into
+# place when they rotate (OUTPUT_ROTATE_MB / OUTPUT_ROTATE_SECONDS) or the
+# worker exits, so anything without the .tmp- prefix is complete.
+#
+# A parquet file can't be read until its footer is written, so tasks are only
+# acked once the file holding their rows is finalized: write() and finalize()
+# return the tasks whose rows are now durable. Keep OUTPUT_ROTATE_SECONDS
+# under QUEUE_LEASE_SECONDS. A pod killed mid-file leaves its tasks unacked,
+# and they are reclaimed and processed again. worker.py instead acks pages
+# once they are in its journal (result_journal.py) and replays the journal
+# of a killed pod into the writer, so no finished LLM work is redone.
+#
+# Every stream has a fixed schema (SCHEMAS). LLM keys outside it, and values
+# that don't fit their column's type (e.g. confidence "high"), are kept as a
+# JSON object in the 'extra' column, so the files always read back with the
+# same columns.
+
+import os
+import math
+import json
+import time
+import logging
+from datetime import datetime
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+logger = logging.getLogger(__name__)
+
+ROW_GROUP_ROWS = int(os.environ.get('OUTPUT_ROW_GROUP_ROWS', 5000))
+FLUSH_SECONDS = float(os.environ.get('OUTPUT_FLUSH_SECONDS', 300))
+ROTATE_BYTES = int(float(os.environ.get('OUTPUT_ROTATE_MB', 128)) * 1024 ** 2)
+ROTATE_SECONDS = float(os.environ.get('OUTPUT_ROTATE_SECONDS', 600))
+
+S, F, I, B = pa.string(), pa.float64(), pa.int64(), pa.bool_()
+KEY = [('pid', S), ('identifier', S)]
+BOX = [('x_1', F), ('y_1', F), ('x_2', F), ('y_2', F)]
+LLM = [('confidence', F), ('model', S), ('error', S)]
+
+SCHEMAS = {
+    'lp_items': KEY + BOX + [('score', F), ('type', I)],
+    # one row per page layout detection ran on, boxes or not (see lp_store.py)
+    'lp_pages': KEY + [('boxes', I)],
+    # page/volume/number are strings: pages like "12A" are not rare
+    'pages': KEY + [('page', S), ('date', S), ('volume', S), ('number', S), ('section', S)] + LLM,
+    'llm_items': KEY + [('category', S), ('title', S), ('subject', S), ('named_entities', S),
+                        ('summary', S)] + LLM,
+    'ads': KEY + BOX + [('advertiser', S), ('address', S), ('phone', S), ('category', S),
+                        ('subcategory', S), ('keywords', S), ('summary', S)] + LLM,
+    'ed_comics': KEY + BOX + [('title', S), ('description', S), ('category', S), ('keywords', S),
+                              ('sensitive_content', B)] + LLM,
+    'errors': KEY + [('error', S), ('timestamp', S)],
+}
+SCHEMAS = {stream: pa.schema(fields + [('extra', S)]) for stream, fields in SCHEMAS.items()}
+
+
+def _coerce(value, type_):
+    """value as type_, raising ValueError/TypeError if it doesn't fit"""
+    if type_ == S:
+        if isinstance(value, str):
+            return value
+        if isinstance(value, (dict, list)):
+            return json.dumps(value)
+        return str(value)
+    if type_ == F:
+        return float(value)
+    if type_ == I:
+        if float(value) != int(float(value)):
+            raise ValueError(f"{value} is not an integer")
+        return int(float(value))
+    if type_ == B:
+        if isinstance(value, bool):
+            return value
+        if str(value).lower() in ('true', 'false'):
+            return str(value).lower() == 'true'
+        raise ValueError(f"{value} is not a boolean")
+    raise TypeError(f"No coercion to {type_}")
+
+
+def fit_row(row, schema):
+    """Result dict -> values for schema's columns; everything else as JSON in 'extra'"""
+    out = {}
+    extra = {}
+    for key, value in row.items():
+        if value is None or (isinstance(value, float) and math.isnan(value)):
+            continue
+        if key != 'extra' and key in schema.names:
+            try:
+                out[key] = _coerce(value, schema.field(key).type)
+                continue
+            except (TypeError, ValueError):
+                pass
+        extra[key] = value
+    out['extra'] = json.dumps(extra, default=str) if extra else None
+    return out
+
+
+class ResultWriter:
+    def __init__(self, worker_id, streams, out_dir='/shared-output'):
+        self.worker_id = worker_id
+        self.out_dir = out_dir
+        self.buffers = {stream: [] for stream in streams}
+        self.files = {}  # stream -> (ParquetWriter, temp path, final path)
+        self.tasks = []  # written but not yet in a finalized file
+        self.opened = None  # when the oldest unsaved row arrived
+        self.last_flush = time.time()
+        self.stats = {'rows': 0, 'row_groups': 0, 'files': 0}
+        os.makedirs(out_dir, exist_ok=True)
+
+    def unacked(self):
+        return list(self.tasks)
+
+    def holding(self):
+        """True while some written rows are not yet in a finalized file"""
+        return bool(self.tasks or self.files or any(self.buffers.values()))
+
+    def write(self, results, tasks=()):
+        """Buffer {stream: [row dicts]} for tasks; returns tasks that are now safe to ack"""
+        for stream, rows in results.items():
+            self.buffers[stream].extend(rows)
+        self.tasks.extend(tasks)
+        if self.opened is None and (self.tasks or any(self.buffers.values())):
+            self.opened = time.time()
+
+        stale = time.time() - self.last_flush >= FLUSH_SECONDS
+        for stream, rows in self.buffers.items():
+            if len(rows) >= ROW_GROUP_ROWS or (stale and rows):
+                self._flush(stream)
+        if stale:
+            self.last_flush = time.time()
+
+        if self.opened and (time.time() - self.opened >= ROTATE_SECONDS or
+                            any(os.path.getsize(tmp) >= ROTATE_BYTES for _, tmp, _ in self.files.values())):
+            return self.finalize()
+        return []
+
+    def _flush(self, stream):
+        schema = SCHEMAS[stream]
+        table = pa.Table.from_pylist([fit_row(row, schema) for row in self.buffers[stream]], schema=schema)
+        if stream not in self.files:
+            name = f"{stream}_{self.worker_id}_{datetime.now().strftime('%Y%m%d_%H%M%S%f')}.parquet"
+            tmp = os.path.join(self.out_dir, f'.tmp-{name}')
+            self.files[stream] = (pq.ParquetWriter(tmp, schema, compression='zstd'), tmp,
+                                  os.path.join(self.out_dir, name))
+        self.files[stream][0].write_table(table)
+        self.stats['rows'] += table.num_rows
+        self.stats['row_groups'] += 1
+        self.buffers[stream] = []
+
+    def finalize(self):
+        """Write out every buffer and close the open files; returns all tasks now safe to ack"""
+        for stream, rows in self.buffers.items():
+            if rows:
+                self._flush(stream)
+        for stream, (writer, tmp, path) in self.files.items():
+            writer.close()
+            with open(tmp, 'rb') as f:
+                os.fsync(f.fileno())
+            os.replace(tmp, path)
+            self.stats['files'] += 1
+            logger.info(f"Saved {path}")
+        self.files = {}
+        self.opened = None
+        self.last_flush = time.time()
+        tasks, self.tasks = self.tasks, []
+        return tasks
+
+    def log_stats(self):
+        logger.info(f"Output: {self.stats['rows']} rows in {self.stats['row_groups']} row groups, "
+                    f"{self.stats['files']} files finalized, {len(self.tasks)} tasks awaiting finalize")
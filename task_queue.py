@@ -0,0 +1,327 @@
+# redis task queue shared by worker.py, worker_lp.py and the nrp-and-redis scripts
+#
+# QUEUE_BACKEND=stream (default) - Redis Streams + consumer group. Tasks are
+#   leased with XREADGROUP, acked with XACK (O(1)), and leases left idle by a
+#   crashed/evicted pod are reclaimed with XAUTOCLAIM. Tasks delivered
+#   MAX_DELIVERIES times go to the '<queue>:failed' dead-letter stream.
+# QUEUE_BACKEND=list - original BRPOPLPUSH / LREM lists, kept for draining
+#   queues populated before the switch.
+#
+# Either way, '<queue>:enqueued' holds every pid enqueued in this pass -
+# queued, leased, done or dead-lettered - and enqueue_tasks() skips pids
+# already in it, so re-running populate-queue.py only tops the queue up even
+# when the completion index it reads is behind the workers. Only
+# populate-queue.py --reset or --repass (reset_enqueued()) lets finished
+# pids be queued again.
+
+import os
+import json
+import time
+import logging
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+QUEUE_BACKEND = os.environ.get('QUEUE_BACKEND', 'stream')
+GROUP = 'workers'
+# a lease idle this long belongs to a dead worker; live workers renew theirs
+LEASE_MS = int(os.environ.get('QUEUE_LEASE_SECONDS', 900)) * 1000
+MAX_DELIVERIES = int(os.environ.get('QUEUE_MAX_DELIVERIES', 5))
+BATCH_SIZE = int(os.environ.get('QUEUE_BATCH_SIZE', 5))
+# must stay under the 10s socket timeout in redis_pool
+BLOCK_MS = 5000
+
+# tasks leased by XREADGROUP but not yet handed to the main loop
+_leased = {}
+# queues whose consumer group this process has already created or found
+_groups = set()
+
+
+def task_key(task):
+    """Task payload without queue bookkeeping (what was originally enqueued)"""
+    return {k: v for k, v in task.items() if k not in ('msg_id', 'attempts')}
+
+
+def ensure_group(r, queue):
+    try:
+        r.xgroup_create(queue, GROUP, id='0', mkstream=True)
+    except Exception as e:
+        if 'BUSYGROUP' not in str(e):
+            raise
+    _groups.add(queue)
+
+
+# SADD decides which pids are new, and only those are pushed, in one atomic
+# call per chunk - so concurrent or repeated populate runs never double-queue
+_ENQUEUE = """
+local batch = {}
+local added = 0
+for i = 2, #ARGV, 2 do
+    if redis.call('SADD', KEYS[2], ARGV[i]) == 1 then
+        added = added + 1
+        if ARGV[1] == 'stream' then
+            redis.call('XADD', KEYS[1], '*', 'task', ARGV[i + 1], 'attempts', 0)
+        else
+            batch[#batch + 1] = ARGV[i + 1]
+        end
+    end
+end
+if #batch > 0 then
+    redis.call('LPUSH', KEYS[1], unpack(batch))
+end
+return added
+"""
+
+
+def enqueued_key(queue):
+    """set of pids enqueued this pass, kept after they are acked or dead-lettered"""
+    return f'{queue}:enqueued'
+
+
+def reset_enqueued(r, queue, chunk=10000):
+    """Start a new pass: forget finished pids, keeping those still queued or leased"""
+    pids = set()
+    if QUEUE_BACKEND == 'stream':
+        start = '-'
+        while r.exists(queue):
+            entries = r.xrange(queue, start, '+', count=chunk)
+            pids.update(json.loads(fields[b'task'].decode('utf-8'))['pid'] for _, fields in entries)
+            if len(entries) < chunk:
+                break
+            start = '(' + entries[-1][0].decode('utf-8')
+    else:
+        for key in (queue, f'{queue}:processing'):
+            pids.update(json.loads(task.decode('utf-8'))['pid'] for task in r.lrange(key, 0, -1))
+    pids = list(pids)
+    pipe = r.pipeline()
+    pipe.delete(enqueued_key(queue))
+    for start in range(0, len(pids), chunk):
+        pipe.sadd(enqueued_key(queue), *pids[start:start + chunk])
+    pipe.execute()
+    return len(pids)
+
+
+def payloads(columns):
+    """Task JSON for {name: values} built column by column; matches json.dumps(task, sort_keys=True)"""
+    parts = [[f'{json.dumps(name)}: {json.dumps(v)}' for v in columns[name]] for name in sorted(columns)]
+    return ['{' + ', '.join(row) + '}' for row in zip(*parts)]
+
+
+def enqueue_tasks(r, queue, columns, chunk=2000):
+    """Enqueue tasks given as {name: values} (must include 'pid'), skipping pids
+    already queued; returns the number added"""
+    script = r.register_script(_ENQUEUE)
+    tasks = payloads(columns)
+    pids = [str(pid) for pid in columns['pid']]
+    added = 0
+    # unpack() in the script is limited to ~8000 values
+    for start in range(0, len(tasks), chunk):
+        args = [QUEUE_BACKEND]
+        for pid, task in zip(pids[start:start + chunk], tasks[start:start + chunk]):
+            args += [pid, task]
+        added += script(keys=[queue, enqueued_key(queue)], args=args)
+    return added
+
+
+def _decode(queue, entries):
+    tasks = []
+    for msg_id, fields in entries:
+        if not fields:
+            # entry was deleted after being leased - nothing to process
+            continue
+        task = json.loads(fields[b'task'].decode('utf-8'))
+        task['msg_id'] = msg_id.decode('utf-8')
+        task['attempts'] = int(fields.get(b'attempts', 0))
+        tasks.append(task)
+    return tasks
+
+
+def _dead_letter(r, queue, msg_id, reason):
+    entries = r.xrange(queue, msg_id, msg_id)
+    pipe = r.pipeline()
+    if entries:
+        fields = dict(entries[0][1])
+        fields[b'reason'] = reason
+        pipe.xadd(f'{queue}:failed', fields)
+    pipe.xack(queue, GROUP, msg_id)
+    pipe.xdel(queue, msg_id)
+    pipe.execute()
+
+
+def _reclaim(r, queue, consumer, count):
+    """Dead-letter poison tasks, then claim other expired leases for consumer"""
+    stale = r.xpending_range(queue, GROUP, min='-', max='+', count=100, idle=LEASE_MS)
+    for p in stale:
+        if p['times_delivered'] >= MAX_DELIVERIES:
+            mid = p['message_id'].decode('utf-8')
+            logger.warning(f"Task {mid} delivered {p['times_delivered']} times, moving to {queue}:failed")
+            _dead_letter(r, queue, mid, 'max deliveries')
+
+    result = r.xautoclaim(queue, GROUP, consumer, LEASE_MS, start_id='0-0', count=count)
+    tasks = _decode(queue, result[1])
+    if tasks:
+        logger.info(f"Reclaimed {len(tasks)} expired leases")
+    return tasks
+
+
+def queue_status(r, queue):
+    """pending = not yet leased, processing = leased but not acked"""
+    if QUEUE_BACKEND == 'stream':
+        if not r.exists(queue):
+            processing = 0
+            total = 0
+        else:
+            processing = r.xpending(queue, GROUP)['pending']
+            total = r.xlen(queue)
+        failed = r.xlen(f'{queue}:failed') if r.exists(f'{queue}:failed') else 0
+        # acked entries are deleted, so the stream holds pending + processing
+        return {'pending': total - processing, 'processing': processing, 'failed': failed}
+    return {'pending': r.llen(queue),
+            'processing': r.llen(f'{queue}:processing'),
+            'failed': r.llen(f'{queue}:failed')}
+
+
+def _lease(r, queue, consumer, count):
+    tasks = _reclaim(r, queue, consumer, count)
+    if not tasks:
+        result = r.xreadgroup(GROUP, consumer, {queue: '>'}, count=count, block=BLOCK_MS)
+        if result:
+            tasks = _decode(queue, result[0][1])
+    return tasks
+
+
+def next_task(r, queue, consumer, count=BATCH_SIZE):
+    """Return a task dict, None (nothing right now, retry) or "QUEUE_EMPTY" """
+    if QUEUE_BACKEND != 'stream':
+        return _next_task_list(r, queue)
+
+    buffered = _leased.setdefault(queue, deque())
+    if buffered:
+        return buffered.popleft()
+
+    if queue not in _groups:
+        ensure_group(r, queue)
+    try:
+        tasks = _lease(r, queue, consumer, count)
+    except Exception as e:
+        # the stream (and its group) was deleted, e.g. populate-queue.py --reset
+        if 'NOGROUP' not in str(e):
+            raise
+        ensure_group(r, queue)
+        tasks = _lease(r, queue, consumer, count)
+    if tasks:
+        buffered.extend(tasks)
+        return buffered.popleft()
+
+    status = queue_status(r, queue)
+    logger.info(f"Queue status: main={status['pending']}, processing={status['processing']}")
+    if status['pending'] == 0 and status['processing'] == 0:
+        logger.info("All queues empty - no more work")
+        return "QUEUE_EMPTY"
+    # leases held elsewhere will either be acked or expire and be reclaimed,
+    # so stay around to drain the tail instead of exiting
+    return None
+
+
+def _next_task_list(r, queue):
+    result = r.brpoplpush(queue, f'{queue}:processing', timeout=60)
+    if result:
+        return json.loads(result.decode('utf-8'))
+    main_queue_length = r.llen(queue)
+    processing_queue_length = r.llen(f'{queue}:processing')
+    logger.info(f"Queue status: main={main_queue_length}, processing={processing_queue_length}")
+    if main_queue_length == 0:
+        return "QUEUE_EMPTY"
+    return None
+
+
+def renew_leases(r, queue, consumer, tasks):
+    """Reset idle time on tasks this worker still holds so they aren't reclaimed"""
+    # list() copies the deque in one step; the pipeline's lease thread may be appending
+    held = [t['msg_id'] for t in tasks] + [t['msg_id'] for t in list(_leased.get(queue, []))]
+    if QUEUE_BACKEND != 'stream' or not held:
+        return
+    r.xclaim(queue, GROUP, consumer, 0, held, justid=True)
+
+
+def complete_tasks(r, queue, tasks):
+    if not tasks:
+        return
+    pipe = r.pipeline()
+    if QUEUE_BACKEND == 'stream':
+        ids = [t['msg_id'] for t in tasks]
+        pipe.xack(queue, GROUP, *ids)
+        pipe.xdel(queue, *ids)
+    else:
+        for task in tasks:
+            pipe.lrem(f'{queue}:processing', 1, json.dumps(task, sort_keys=True))
+    pipe.execute()
+
+
+def fail_task(r, queue, task):
+    """Requeue a failed task, or dead-letter it after MAX_DELIVERIES attempts"""
+    if QUEUE_BACKEND != 'stream':
+        task_str = json.dumps(task, sort_keys=True)
+        pipe = r.pipeline()
+        pipe.lrem(f'{queue}:processing', 1, task_str)
+        pipe.lpush(queue, task_str)
+        pipe.execute()
+        return
+
+    attempts = task.get('attempts', 0) + 1
+    fields = {'task': json.dumps(task_key(task)), 'attempts': attempts}
+    pipe = r.pipeline()
+    if attempts >= MAX_DELIVERIES:
+        logger.warning(f"Task {task.get('pid')} failed {attempts} times, moving to {queue}:failed")
+        pipe.xadd(f'{queue}:failed', {**fields, 'reason': 'max attempts'})
+    else:
+        pipe.xadd(queue, fields)
+    pipe.xack(queue, GROUP, task['msg_id'])
+    pipe.xdel(queue, task['msg_id'])
+    pipe.execute()
+
+
+def workers_key(queue):
+    """hash of worker id -> latest heartbeat JSON"""
+    return f'{queue}:workers'
+
+
+def heartbeat(r, queue, worker, **stats):
+    r.hset(workers_key(queue), worker, json.dumps({'ts': time.time(), **stats}))
+
+
+def remove_worker(r, queue, worker):
+    r.hdel(workers_key(queue), worker)
+
+
+def live_workers(r, queue, max_age=LEASE_MS / 1000):
+    """{worker: heartbeat} for workers heard from in the last max_age seconds
+
+    Workers beat once per page and a page can take as long as its longest LLM
+    deadline, so the default is the lease time: a worker quiet for longer has
+    lost its leases anyway.
+    """
+    now = time.time()
+    beats = {k.decode('utf-8'): json.loads(v) for k, v in r.hgetall(workers_key(queue)).items()}
+    return {w: b for w, b in beats.items() if now - b['ts'] <= max_age}
+
+
+def stuck_leases(r, queue, limit=10000):
+    """Leases idle past LEASE_MS - their worker died and nobody has reclaimed them yet"""
+    if QUEUE_BACKEND != 'stream' or not r.exists(queue):
+        return 0
+    return len(r.xpending_range(queue, GROUP, min='-', max='+', count=limit, idle=LEASE_MS))
+
+
+def release_leases(r, queue):
+    """Hand back tasks leased in a batch but never started (on worker exit)"""
+    buffered = _leased.pop(queue, deque())
+    if QUEUE_BACKEND != 'stream' or not buffered:
+        return
+    pipe = r.pipeline()
+    for task in buffered:
+        pipe.xadd(queue, {'task': json.dumps(task_key(task)), 'attempts': task['attempts']})
+        pipe.xack(queue, GROUP, task['msg_id'])
+        pipe.xdel(queue, task['msg_id'])
+    pipe.execute()
+    logger.info(f"Released {len(buffered)} unstarted tasks back to {queue}")
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+# stage-time breakdown from the trace files of all worker pods (see tracing.py)
+#
+#   kubectl cp temp-access:/shared-output/traces ./traces
+#   python trace_report.py 'traces/*.jsonl'
+#
+# For each span name (llm_query split by prompt type) prints the count, total
+# and mean/p50/p95/max seconds, the mean payload size and the span's time as
+# a share of total task time. LLM queries for a page run concurrently, so
+# shares can add up to more than 100%; "task" is the wall-clock time per page.
+
+import sys
+import glob
+import json
+import argparse
+from collections import defaultdict
+
+SIZE_ATTRS = ['up', 'down', 'bytes', 'px', 'boxes']
+
+
+def read_spans(paths, since=0):
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                try:
+                    span = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # partial line from a pod killed mid-write
+                if span['ts'] >= since:
+                    yield span
+
+
+def percentile(values, q):
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def breakdown(spans):
+    """{stage: {'seconds': [...], size attr: [...]}} and the set of traces seen"""
+    stages = defaultdict(lambda: defaultdict(list))
+    traces = set()
+    for span in spans:
+        name = span['n']
+        if 'prompt' in span and name == 'llm_query':
+            name = f"{name}:{span['prompt']}"
+        stages[name]['seconds'].append(span['d'])
+        for attr in SIZE_ATTRS:
+            if attr in span:
+                stages[name][attr].append(span[attr])
+        traces.add(span['t'])
+    return stages, traces
+
+
+def report(stages, traces):
+    task_total = sum(stages['task']['seconds']) if 'task' in stages else 0
+    rows = []
+    for name, values in stages.items():
+        seconds = sorted(values['seconds'])
+        total = sum(seconds)
+        sizes = {attr: sum(v) / len(v) for attr, v in values.items() if attr != 'seconds'}
+        rows.append({
+            'stage': name, 'count': len(seconds), 'total': total,
+            'mean': total / len(seconds), 'p50': percentile(seconds, 0.5),
+            'p95': percentile(seconds, 0.95), 'max': seconds[-1],
+            'share': total / task_total if task_total else None, **sizes,
+        })
+    rows.sort(key=lambda r: -r['total'])
+    return {'traces': len(traces), 'tasks': len(stages['task']['seconds']) if 'task' in stages else 0,
+            'stages': rows}
+
+
+def print_report(result):
+    print(f"{result['traces']} traces, {result['tasks']} finished tasks")
+    print(f"{'stage':<24}{'count':>8}{'total s':>11}{'mean':>8}{'p50':>8}{'p95':>8}{'max':>8}{'share':>7}  payload")
+    for r in result['stages']:
+        share = f"{r['share']:.0%}" if r['share'] is not None else '-'
+        payload = ' '.join(f"{attr}={r[attr]:,.0f}" for attr in SIZE_ATTRS if attr in r)
+        print(f"{r['stage']:<24}{r['count']:>8}{r['total']:>11.0f}{r['mean']:>8.2f}{r['p50']:>8.2f}"
+              f"{r['p95']:>8.2f}{r['max']:>8.1f}{share:>7}  {payload}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Aggregate worker trace files into a stage-time breakdown')
+    parser.add_argument('patterns', nargs='*', default=['/shared-output/traces/*.jsonl'])
+    parser.add_argument('--since', type=float, default=0, help='only spans starting after this unix time')
+    parser.add_argument('--json', action='store_true')
+    args = parser.parse_args()
+
+    paths = sorted({p for pattern in args.patterns for p in glob.glob(pattern)})
+    if not paths:
+        sys.exit(f"No trace files match {args.patterns}")
+    result = report(*breakdown(read_spans(paths, args.since)))
+    if args.json:
+        print(json.dumps(result, indent=1))
+    else:
+        print_report(result)
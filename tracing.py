@@ -0,0 +1,185 @@
+# per-task trace spans and an opt-in sampling profiler
+#
+# Each task gets a trace ID and a tree of timed spans - get_image, np_array,
+# detect, filter_lp, and every encode and llm_query - with payload sizes as
+# attributes. Spans are appended as compact JSON lines to TRACE_FILE (one file
+# per worker, {worker} is replaced by the pod name):
+#
+#   {"t":"3f9c..","s":5,"p":1,"n":"llm","pid":"ns:123","ts":1712345678.12,"d":41.2,"prompt":"items","up":912334}
+#
+# t = trace id, s = span id, p = parent span id, n = name, ts = start time,
+# d = duration in seconds. The root span ("task") is written when the task
+# ends and covers the time from its first span (the fetch) to results. Spans opened on other
+# threads (the prefetch pipeline, the LLM pool) attach to the task's root;
+# spans nested on the same thread attach to the enclosing span.
+#
+# PROFILE_EVERY=N samples the stacks of every thread every PROFILE_INTERVAL
+# seconds while every Nth task is processed and writes them in collapsed-stack
+# format (flamegraph.pl, speedscope) to PROFILE_DIR/<worker>_<pid>.folded.
+#
+# trace_report.py aggregates the trace files of all pods into a per-stage
+# time breakdown.
+
+import os
+import sys
+import json
+import time
+import uuid
+import logging
+import threading
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+TRACE_FILE = os.environ.get('TRACE_FILE')
+PROFILE_EVERY = int(os.environ.get('PROFILE_EVERY', 0))
+PROFILE_INTERVAL = float(os.environ.get('PROFILE_INTERVAL', 0.01))
+PROFILE_DIR = os.environ.get('PROFILE_DIR', '/shared-output/profiles')
+
+_lock = threading.Lock()
+_local = threading.local()
+_traces = {}  # pid -> [trace id, root span id, start]
+_span_ids = iter(range(1, sys.maxsize))
+_file = None
+_worker = None
+
+
+def setup(worker_id):
+    """Open this worker's trace file (no-op without TRACE_FILE)"""
+    global _file, _worker
+    _worker = worker_id
+    if not TRACE_FILE:
+        return
+    path = TRACE_FILE.format(worker=worker_id)
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    _file = open(path, 'a', buffering=1)
+    logger.info(f"Writing trace spans to {path}")
+
+
+def _write(record):
+    line = json.dumps(record, separators=(',', ':'), default=str)
+    with _lock:
+        _file.write(line + '\n')
+
+
+def _trace(pid):
+    with _lock:
+        if pid not in _traces:
+            _traces[pid] = [uuid.uuid4().hex[:16], next(_span_ids), time.time()]
+        return _traces[pid]
+
+
+def trace_id(pid):
+    return _trace(pid)[0] if _file else None
+
+
+def record(name, pid, start, seconds, parent=None, **attrs):
+    """Write a span measured elsewhere (e.g. one batch timed once for several pages)"""
+    if not _file:
+        return
+    trace, root, _ = _trace(pid)
+    with _lock:
+        span_id = next(_span_ids)
+    _write({'t': trace, 's': span_id, 'p': parent or root, 'n': name, 'pid': pid,
+            'ts': round(start, 3), 'd': round(seconds, 4), **attrs})
+    return span_id
+
+
+class span:
+    """with tracing.span('llm', pid, prompt='items') as s: ...; s['up'] = len(payload)
+
+    Attributes set on the span while it is open are written with it.
+    """
+
+    def __init__(self, name, pid, **attrs):
+        self.name = name
+        self.pid = pid
+        self.attrs = attrs
+
+    def __setitem__(self, key, value):
+        self.attrs[key] = value
+
+    def __enter__(self):
+        if not _file:
+            return self
+        trace, root, _ = _trace(self.pid)
+        stack = getattr(_local, 'stack', None)
+        if stack is None:
+            stack = _local.stack = []
+        self.parent = stack[-1] if stack and stack[-1][0] == trace else (trace, root)
+        with _lock:
+            self.id = next(_span_ids)
+        stack.append((trace, self.id))
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if not _file:
+            return
+        seconds = time.time() - self.start
+        _local.stack.pop()
+        if exc_type is not None:
+            self.attrs['error'] = exc_type.__name__
+        _write({'t': self.parent[0], 's': self.id, 'p': self.parent[1], 'n': self.name, 'pid': self.pid,
+                'ts': round(self.start, 3), 'd': round(seconds, 4), **self.attrs})
+
+
+def end(pid, **attrs):
+    """Close the task's trace: writes the root span from its first span to now"""
+    with _lock:
+        trace = _traces.pop(pid, None)
+    if not _file or trace is None:
+        return
+    trace_id_, root, start = trace
+    _write({'t': trace_id_, 's': root, 'p': None, 'n': 'task', 'pid': pid, 'worker': _worker,
+            'ts': round(start, 3), 'd': round(time.time() - start, 4), **attrs})
+
+
+class Profiler:
+    """Stack sampler over all threads; a no-op unless this is an Nth task
+
+    profiler = tracing.Profiler(pid, task_number).start() ... profiler.stop()
+    """
+
+    def __init__(self, pid, task_number):
+        self.pid = pid
+        self.enabled = PROFILE_EVERY > 0 and task_number % PROFILE_EVERY == 0
+        self.stacks = Counter()
+
+    def _sample(self):
+        me = threading.get_ident()
+        while not self._stop.wait(PROFILE_INTERVAL):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})')
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        if self.enabled:
+            self._stop = threading.Event()
+            self._thread = threading.Thread(target=self._sample, daemon=True, name='profiler')
+            self._thread.start()
+        return self
+
+    def stop(self):
+        if not self.enabled:
+            return
+        self.enabled = False
+        self._stop.set()
+        self._thread.join()
+        try:
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            path = os.path.join(PROFILE_DIR, f"{_worker}_{self.pid.replace(':', '_')}.folded")
+            with open(path, 'w') as f:
+                for stack, count in self.stacks.most_common():
+                    f.write(f'{stack} {count}\n')
+            logger.info(f"Profile of {self.pid} ({sum(self.stacks.values())} samples) written to {path}")
+        except OSError as e:
+            logger.warning(f"Could not write profile: {e}")
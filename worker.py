@@ -22,39 +22,39 @@ import redis
 import time
 import logging
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
 
 # Import your prompts
 import prompts
+import redis_pool
+import task_queue
+import pipeline
+import layout
+import lp_store
+import page_fetch
+import encoding
+import json_extract
+import result_writer
+import metrics
+import tracing
+import llm_limit
+import rate_limit
+import llm_cache
+import result_journal
 
 # Redis queue with improved error handling
+# connections come from a shared pool so each call doesn't open a new socket
 def get_redis_connection():
-    redis_host = os.environ.get('REDIS_HOST', 'redis-service')
-    return redis.Redis(host=redis_host, port=6379, db=0, socket_timeout=10, socket_connect_timeout=10)
+    return redis_pool.get_redis_connection('redis-service')
+
+queue_name = 'newspaper-jobs'
 
 def get_next_task():
-    """Get next PID from queue using BRPOPLPUSH for safety"""
+    """Lease next PID from queue (see task_queue for stream vs list backend)"""
     try:
         r = get_redis_connection()
-        # Move from main queue to processing queue (atomic operation)
-        result = r.brpoplpush('newspaper-jobs', 'newspaper-jobs:processing', timeout=60)
-        if result:
-            return json.loads(result.decode('utf-8'))
-        else:
-            # Check if both queues are empty
-            main_queue_length = r.llen('newspaper-jobs')
-            processing_queue_length = r.llen('newspaper-jobs:processing')
-            logger.info(f"Queue status: main={main_queue_length}, processing={processing_queue_length}")
-
-            if main_queue_length == 0 and processing_queue_length == 0:
-                logger.info("All queues empty - no more work")
-                return "QUEUE_EMPTY"
-            elif main_queue_length == 0:
-                logger.info("Main queue empty, but items still processing elsewhere")
-                return "QUEUE_EMPTY"
-            else:
-                logger.info("Queue not empty but no task received, retrying...")
-                return None
-
+        return task_queue.next_task(r, queue_name, worker_id)
     except redis.ConnectionError as e:
         logger.error(f"Redis connection failed: {str(e)}")
         return "REDIS_ERROR"
@@ -62,24 +62,35 @@ def get_next_task():
         logger.error(f"Redis error: {str(e)}")
         return "REDIS_ERROR"
 
-def complete_task(task):
-    """Remove completed task from processing queue"""
+def complete_task(tasks):
+    """Ack completed tasks so they leave the processing set"""
+    try:
+        r = get_redis_connection()
+        task_queue.complete_tasks(r, queue_name, tasks)
+    except Exception as e:
+        logger.warning(f"Could not complete {len(tasks)} tasks: {str(e)}")
+
+def renew_leases(tasks):
+    """Keep leases on finished-but-unsaved tasks from being reclaimed"""
+    try:
+        r = get_redis_connection()
+        task_queue.renew_leases(r, queue_name, worker_id, tasks)
+    except Exception as e:
+        logger.warning(f"Could not renew leases: {str(e)}")
+
+def send_heartbeat(processed):
+    """Per-worker progress for monitor_queue.py"""
     try:
         r = get_redis_connection()
-        task_str = json.dumps(task, sort_keys=True)
-        removed = r.lrem('newspaper-jobs:processing', 1, task_str)
+        task_queue.heartbeat(r, queue_name, worker_id, started=worker_started, processed=processed)
     except Exception as e:
-        logger.warning(f"Could not complete task {task.get('pid', 'unknown')}: {str(e)}")
+        logger.warning(f"Could not send heartbeat: {str(e)}")
 
 def fail_task(task):
     """Move failed task back to main queue for potential retry"""
     try:
         r = get_redis_connection()
-        task_str = json.dumps(task, sort_keys=True)
-        # Remove from processing queue
-        r.lrem('newspaper-jobs:processing', 1, task_str)
-        # Add back to main queue for retry (optional)
-        r.lpush('newspaper-jobs', task_str)
+        task_queue.fail_task(r, queue_name, task)
         logger.debug(f"Task {task['pid']} marked as failed")
     except Exception as e:
         logger.warning(f"Could not fail task {task.get('pid', 'unknown')}: {str(e)}")
@@ -101,21 +112,27 @@ except Exception as e:
 
 # Setup LLM
 key = os.environ.get('LLM_KEY')
+# LLM_CACHE_MODE=replay answers every query from the response cache
+# (see llm_cache.py) and never calls the endpoint
+if llm_cache.MODE == 'replay':
+    key = key or 'replay'
 if not key:
     logger.error('LLM_KEY environment variable not set')
     sys.exit(1)
 
-client = OpenAI(api_key=key, base_url="https://ellm.nrp-nautilus.io/v1", max_retries=0)
+# retries and per-call timeouts are handled in llm_query (see llm_limit.py)
+client = OpenAI(api_key=key, base_url="https://ellm.nrp-nautilus.io/v1", max_retries=0, timeout=120)
 # llm_model = 'glm-v' # depracated April 2026
 llm_model = 'qwen3'
 
 # Test LLM connection
 try:
-    completion = client.chat.completions.create(
-        model=llm_model,
-        messages=[{"role": "system", "content": ""},
-                 {"role": "user", "content": "Just checking to see if you're awake."}])
-    logger.info('LLM connection successful')
+    if llm_cache.MODE != 'replay':
+        completion = client.chat.completions.create(
+            model=llm_model,
+            messages=[{"role": "system", "content": ""},
+                     {"role": "user", "content": "Just checking to see if you're awake."}])
+        logger.info('LLM connection successful')
 except Exception as e:
     logger.error(f'LLM connection failed: {str(e)}')
     sys.exit(1)
@@ -143,64 +160,81 @@ def load_newspaper_navigator():
         device=device
     )
 
-logger.info("Loading layoutparser model...")
-try:
-    lp_model = load_newspaper_navigator()
-    logger.info("Layoutparser model loaded successfully")
-except Exception as e:
-    logger.error(f"Failed to load layoutparser model: {str(e)}")
-    sys.exit(1)
+# LP_SOURCE=store looks boxes up in the sqlite index of worker_lp.py output
+# (see lp_store.py) instead of loading the model, so LLM pods can run CPU-only
+LP_SOURCE = os.environ.get('LP_SOURCE', 'model')
+LP_STORE = os.environ.get('LP_STORE', '/shared-output/lp_items.sqlite')
 
-# END - comment out to skip layoutparser
+if LP_SOURCE == 'store':
+    try:
+        lp_db = lp_store.open_store(LP_STORE)
+        logger.info(f"Using stored LP results from {LP_STORE}, skipping model load")
+    except Exception as e:
+        logger.error(f"Failed to open LP store {LP_STORE}: {str(e)}")
+        sys.exit(1)
+else:
+    logger.info("Loading layoutparser model...")
+    try:
+        lp_model = load_newspaper_navigator()
+        logger.info("Layoutparser model loaded successfully")
+    except Exception as e:
+        logger.error(f"Failed to load layoutparser model: {str(e)}")
+        sys.exit(1)
 
+# END - comment out to skip layoutparser
 
-# highlight specific columns from lp
-def filter_lp(results):
-    max_items = {}
-    for item in results:
-        key = (item['x_1'], item['y_1'], item['x_2'], item['y_2'])
-        if key not in max_items or item['score'] > max_items[key]['score']:
-            max_items[key] = item
-    return list(max_items.values())
 
 def get_image(pid, max_retries=5):
 
-    url = f'https://digital.lib.ku.edu/islandora/object/{pid}/datastream/OBJ/view'
-
-    # Retry loop for GET request
+    # Retry loop for GET request (served from the PVC image cache when possible)
     for attempt in range(max_retries):
         try:
-            response = requests.get(url, timeout=60)
-            response.raise_for_status()
-            image = Image.open(io.BytesIO(response.content))
-            if image.mode != 'RGB':
-                image = image.convert('RGB')
+            # full resolution OBJ for LLM crops; stored LP boxes are in the pixels
+            # of the datastream worker_lp.py read (JP2, else OBJ), so use that one
+            with tracing.span('get_image', pid, attempt=attempt) as s:
+                if LP_SOURCE == 'store':
+                    image, _ = page_fetch.open_page_image(pid)
+                else:
+                    image, _ = page_fetch.open_image(pid, 'OBJ')
+                s['px'] = image.size[0] * image.size[1]
             return image
         except Exception as e:
             if attempt == max_retries - 1:  # Last attempt
                 raise
+            metrics.inc('retries_total', what='fetch')
             time.sleep(3 ** attempt)  # Exponential backoff: 1s, 3s, 9s
 
 
 def run_lp(pid, identifier):
-
     image = get_image(pid)
-    results = []
+    return detect_lp(pid, identifier, image), image
+
+def detect_lp(pid, identifier, image):
+
+    return detect_lp_batch([(pid, identifier, image)])[0]
+
+def detect_lp_batch(pages):
+    """pages = [(pid, identifier, image)] -> LP results per page, LP_BATCH_SIZE pages per forward pass"""
+    if LP_SOURCE == 'store':
+        return [lp_store.lookup(lp_db, pid, identifier) for pid, identifier, _ in pages]
     # START - comment out to skip layoutparser (2 of 2)
-    image_for_lp = np.array(image)
-    layout = lp_model.detect(image_for_lp)
-
-    for l in layout:
-        results.append({
-                'x_1': l.block.x_1, 'y_1': l.block.y_1, 'x_2': l.block.x_2, 'y_2': l.block.y_2,
-                'score': l.score, 'type': l.type,
-                'identifier': identifier, 'pid': pid,
-                })
-
-    results = filter_lp(results)
-    logger.info(f'Layout Parser complete with {len(results)} items')
+    arrays = []
+    for pid, _, image in pages:
+        with tracing.span('np_array', pid) as s:
+            arrays.append(np.asarray(image))
+            s['bytes'] = arrays[-1].nbytes
+    start = time.time()
+    layouts = layout.detect_batch(lp_model, arrays)
+    for pid, _, _ in pages:
+        tracing.record('detect', pid, start, time.time() - start, batch=len(pages))
+    all_results = []
+    for (pid, identifier, _), page_layout in zip(pages, layouts):
+        with tracing.span('filter_lp', pid) as s:
+            all_results.append(layout.to_results(page_layout, pid, identifier))
+            s['boxes'] = len(all_results[-1])
+    logger.info(f'Layout Parser complete with {[len(r) for r in all_results]} items')
     # END - comment out to skip layoutparser
-    return results, image
+    return all_results
 
 def parse_dates(s):
     s = s.replace('udk_','').replace('udk-','')
@@ -240,206 +274,199 @@ def parse_dates(s):
         logger.warning(f'Unknown date format: {s}, error: {str(e)}')
         return None, None
 
-def encode_img(image):
-    buffer = io.BytesIO()
-    image.save(buffer, format='JPEG', quality=95, optimize=True, subsampling=0)
-    buffer.seek(0)
-    return base64.b64encode(buffer.read()).decode("utf-8")
-
-def crop_and_encode(image, header=False, coords=None):
+def query_region(image, header=False, coords=None):
+    """(crop box, encode stage) an llm_query sends; box None = whole page"""
+    box = None
     if header:
         w, h = image.size
         # COMMENT OUT TWO OF THESE - A or B or C
         # # A: look at header only
         # crop_top_15 = int(h * 0.15)
-        # img = image.crop((0, 0, w, crop_top_15))
+        # box = (0, 0, w, crop_top_15)
 
         # # B: look at footer only
         # crop_bottom_15 = int(h * 0.85)
-        # img = image.crop((0, crop_bottom_15, w, h))
+        # box = (0, crop_bottom_15, w, h)
 
         # C: look at whole image
-        img = image
+        box = None
+        return box, 'header'
     elif coords:
-        img = image.crop((coords['x_1'], coords['y_1'], coords['x_2'], coords['y_2']))
-    else:
-        img = image
-    if img.mode in ('RGBA', 'LA', 'P'):
-        img = img.convert('RGB')
+        c = coords[1]
+        return (c['x_1'], c['y_1'], c['x_2'], c['y_2']), coords[0]
+    return box, 'items'
 
-    max_file_size = 3355443  # 3.2MB
-    max_size = 4000 # pixel length
+def crop_and_encode(image, header=False, coords=None, page=None):
+    box, stage = query_region(image, header, coords)
+    # sized to fit the endpoint's limit (3.2MB) in one or two encodes, and
+    # memoized per page (option C and the item query both send the whole page)
+    return encoding.encode_region(image, box, stage=stage, page=page), stage
 
-    # Try original image first
-    image_encode = encode_img(img)
-    image_encode_size = len(image_encode)
-
-    if image_encode_size <= max_file_size:
-        logger.info(f"Image size OK: {image_encode_size / (1024 * 1024):.2f}MB")
-        return image_encode
-
-    while max_size >= 100:
-        # Calculate new dimensions
-        width, height = img.size
-        scale = max_size / max(width, height)
-
-        if scale >= 1:
-            resized_img = img
-        else:
-            new_width = int(width * scale)
-            new_height = int(height * scale)
-            resized_img = img.resize((new_width, new_height), Image.LANCZOS)
-
-        image_encode = encode_img(resized_img)
-        logger.info(f'Resized image: {len(image_encode)/(1024*1024):.2f}MB')
-
-        # Check size
-        if len(image_encode) <= max_file_size:
-            return image_encode
-
-        # Calculate next size
-        size_ratio = max_file_size / len(image_encode)
-        max_size = int(max_size * (size_ratio ** 0.5) * 0.93)
-
-    return image_encode
-
-def fix_json_values(text):
-    try:
-        text = repair_json(text)
-        return text
-    except Exception as e:
-        # Fallback to manual fixes if json-repair fails
-        logger.debug(f"json-repair failed: {e}, trying manual fixes")
-        text = re.sub(r'("[^"]+"):\s*([0-9]+[A-Za-z][A-Za-z0-9]*)', r'\1: "\2"', text)
-        text = re.sub(r',(\s*[}\]])', r'\1', text)
-        return text
+# raw LLM responses appended here (JSONL) when set, for the json_extract
+# fixture corpus in benchmarks/fixtures
+LLM_RECORD_FILE = os.environ.get('LLM_RECORD_FILE')
+record_lock = threading.Lock()
 
+def record_response(stage, msg):
+    with record_lock, open(LLM_RECORD_FILE, 'a') as f:
+        f.write(json.dumps({'stage': stage, 'response': msg}) + '\n')
 
 def decode_message(message):
     try:
         text = message.content[0].text
     except:
         text = message
+    # one pass for the first complete object; json_repair only if it won't parse
+    return json_extract.extract_json(text or '')
 
-    to_strip = [r'json\n', '<|end_of_box|>', '<|start_of_box|>','<|begin_of_box|>',
-                '<think>', '</think>', '```json', '```']
 
-    for t in to_strip:
-        try:
-            text = text.strip().replace(t, '')
-        except (IndexError, AttributeError):
-            continue
-
-    cleaned = text.replace('\n', '').strip()
-
-    if cleaned and cleaned[0] != '{':
-        cleaned = '{' + cleaned
-    if cleaned and not cleaned.endswith('}'):
-        cleaned = cleaned + '}'
-
-    for i, char in enumerate(cleaned):
-        if char == '{':
-            bracket_count = 0
-            for j in range(i, len(cleaned)):
-                if cleaned[j] == '{':
-                    bracket_count += 1
-                elif cleaned[j] == '}':
-                    bracket_count -= 1
-                    if bracket_count == 0:
-                        candidate = cleaned[i:j+1]
-
-                        try:
-                            data = json.loads(candidate)
-                            return data
-                        except json.JSONDecodeError as e:
-                            try:
-                                data = json.loads(fix_json_values(candidate))
-                                return data
-                            except json.JSONDecodeError as e:
-                                logger.warning(f'JSON decode error at position {e.pos}: {e.msg}')
-                                logger.warning(f'Problematic text: {candidate[max(0, e.pos-50):e.pos+50]}')
-
-                                return {"error": "Badly formed JSON response"}
-
-    logger.warning(f'JSON decode error: {cleaned[:200]}')
-    return {"error":"Badly formed JSON response"}
-
-def llm_query(pid, identifier, date, image, header=False, coords=None, max_retries=5):
+def llm_query(pid, identifier, date, image, header=False, coords=None, page=None, max_retries=5):
 
     # Determine prompt and image based on query type
     if header:
-        img_enc = crop_and_encode(image, header=True)
-        url = f"data:image/jpeg;base64,{img_enc}"
         sys_prompt = prompts.page_prompt()
     elif coords:
         if coords[0] == 'ads':
             sys_prompt = prompts.ad_prompt()
         else:
             sys_prompt = prompts.ed_comics_prompt()
-        img_enc = crop_and_encode(image, coords=coords[1])
-        url = f"data:image/jpeg;base64,{img_enc}"
     else:
-
-        # url = f'https://digital.lib.ku.edu/islandora/object/{pid}/datastream/OBJ/view'
-        # alt method of sending pre-encoded image
-        img_enc = crop_and_encode(image)
-        url = f"data:image/jpeg;base64,{img_enc}"
         sys_prompt = prompts.item_prompt()
 
+    # url = f'https://digital.lib.ku.edu/islandora/object/{pid}/datastream/OBJ/view'
+    # alt method of sending pre-encoded image
+    with tracing.span('crop_and_encode', pid) as s:
+        img_enc, stage = crop_and_encode(image, header=header, coords=coords, page=page)
+        s['prompt'] = stage
+        s['bytes'] = len(img_enc)
+    url = f"data:{encoding.mime_type(stage)};base64,{img_enc}"
+
     text = """Process this image according to system directions."""
     if date:
         text += f"Likely date range for this item is {date}."
 
-    # Retry loop with exponential backoff
+    # the same request from an earlier pass is answered from the cache
+    cache_key = llm_cache.key(llm_model, sys_prompt, text, img_enc)
+    cached = llm_cache.get(cache_key, stage)
+    if cached:
+        result = decode_message(cached[0])
+        result['model'] = cached[1]
+        return result
+
+    # Retry loop: overload and dropped connections are retried with jittered
+    # backoff until the prompt type's deadline; other errors are raised at once
+    deadline = llm_limit.deadline_for(stage)
     for attempt in range(max_retries):
         try:
-            completion = client.chat.completions.create(
-                model=llm_model,
-                messages=[
-                    {"role": "system", "content": sys_prompt},
-                    {
-                        "role": "user",
-                        "content": [{
-                            "type": "text",
-                            "text": text
+            # fleet-wide requests/s and image bytes/s (LLM_RATE_*), before taking
+            # a slot so throttling doesn't hold one or count as endpoint latency
+            try:
+                rate_limit.take(get_redis_connection(), len(img_enc), deadline)
+            except TimeoutError as e:
+                raise llm_limit.DeadlineExceeded(str(e)) from e
+            # slot first, so llm_seconds and the span time only the request; the
+            # wait for a slot is llm_wait in stage_seconds (see llm_limit.py)
+            with llm_limiter.slot(stage, deadline), \
+                    metrics.timer('llm_seconds', prompt=stage), \
+                    tracing.span('llm_query', pid, prompt=stage, attempt=attempt, up=len(url)) as s:
+                # counted per attempt actually sent, not for cache hits
+                metrics.inc('bytes_total', len(img_enc), direction='uploaded')
+                completion = client.chat.completions.create(
+                    model=llm_model,
+                    messages=[
+                        {"role": "system", "content": sys_prompt},
+                        {
+                            "role": "user",
+                            "content": [{
+                                "type": "text",
+                                "text": text
+                            },
+                            {"type": "image_url",
+                             "image_url": {"url": url}}]
                         },
-                        {"type": "image_url",
-                         "image_url": {"url": url}}]
-                    },
-                    {"role": "assistant", "content": "{"}
-                ],
-            )
+                        {"role": "assistant", "content": "{"}
+                    ],
+                    timeout=max(1, deadline - time.time()),
+                )
+                if not completion.choices:
+                    raise llm_limit.EmptyResponse(f"No choices in response from {completion.model}")
 
-            msg = completion.choices[0].message.content
+                msg = completion.choices[0].message.content
+                s['down'] = len(msg or '')
 
             # Add small delay between successful calls to avoid hammering LLM
             # time.sleep(0.5)
-            # test for valid json
-            try:
-                result = json.loads(msg)
-                result['model'] = completion.model
-                return result
-            except JSONDecodeError:
-                decoded_msg = decode_message(msg)
-                decoded_msg['model'] = completion.model
-                return decoded_msg
+            if LLM_RECORD_FILE:
+                record_response(stage, msg)
+
+            result = decode_message(msg)
+            if result != json_extract.BAD_JSON:
+                llm_cache.put(cache_key, stage, msg, completion.model)
+            result['model'] = completion.model
+            return result
 
         except Exception as e:
             error_str = str(e)
-            base_delay = 2
+            retryable, delay = llm_limit.retry_delay(e, attempt)
 
-            if attempt < max_retries - 1:
-                delay = base_delay * (2 ** attempt) + random.uniform(0, 1)
+            if retryable and attempt < max_retries - 1 and time.time() + delay < deadline:
                 logger.warning(f"LLM error for {pid} (attempt {attempt+1}/{max_retries}), retrying in {delay:.1f}s: {error_str}")
+                metrics.inc('retries_total', what='llm', prompt=stage)
                 time.sleep(delay)
                 continue
-            # Non-retryable error or out of retries
+            # Non-retryable error, out of retries or past the deadline
             raise
 
+# Per-page LLM fan-out. A page's queries (header, items, each ad and editorial
+# comic crop) run on a bounded thread pool so page time is roughly the slowest
+# call rather than the sum. LLM_MAX_CONCURRENCY=1 runs them one at a time.
+# Queries are registered with submit_llm() and sent by dispatch_llm(), which
+# first starts every region's encode on the encode pool so the crops are ready
+# (or nearly) by the time their queries go out.
+# Within that, llm_limiter adapts how many run at once to the endpoint's
+# latency and 429/5xx responses, starting from LLM_CONCURRENCY (see llm_limit.py).
+LLM_MAX_CONCURRENCY = llm_limit.LLM_MAX_CONCURRENCY
+llm_executor = ThreadPoolExecutor(max_workers=LLM_MAX_CONCURRENCY) if LLM_MAX_CONCURRENCY > 1 else None
+llm_limiter = llm_limit.AdaptiveLimiter()
+pending_llm = []
+
+def submit_llm(*args, **kwargs):
+    """Register an llm_query for the current page and return its Future"""
+    future = Future()
+    pending_llm.append((future, args, kwargs))
+    return future
+
+def run_llm(future, args, kwargs):
+    if not future.set_running_or_notify_cancel():
+        return
+    try:
+        future.set_result(llm_query(*args, **kwargs))
+    except Exception as e:
+        future.set_exception(e)
+
+def dispatch_llm(image):
+    """Encode every region the page's queries send, then send the queries"""
+    page = encoding.begin_page()
+    encoding.prepare_regions(image, [query_region(image, kwargs.get('header', False), kwargs.get('coords'))
+                                     for _, _, kwargs in pending_llm], page)
+    for future, args, kwargs in pending_llm:
+        kwargs['page'] = page
+        if llm_executor is None:
+            run_llm(future, args, kwargs)
+        else:
+            llm_executor.submit(run_llm, future, args, kwargs)
+
+def cancel_llm_queries():
+    """Drop queued queries for a page that has already failed"""
+    for future, _, _ in pending_llm:
+        future.cancel()
+    pending_llm.clear()
+
 def log_error(pid, identifier, e, task, error_count, consecutive_errors):
     error_count += 1
     consecutive_errors += 1
     logger.error(f"Error processing {pid}: {str(e)}")
+    metrics.inc('tasks_total', result='error')
 
     error_results.append({
         'pid': pid,
@@ -459,53 +486,123 @@ def log_error(pid, identifier, e, task, error_count, consecutive_errors):
 # Setup output files
 worker_id = os.environ.get('HOSTNAME', 'worker-unknown')
 
+# METRICS_PORT / METRICS_FILE (see metrics.py)
+metrics.serve(worker_id)
+# TRACE_FILE / PROFILE_EVERY (see tracing.py)
+tracing.setup(worker_id)
+
 # Ensure output directory exists
 os.makedirs('/shared-output', exist_ok=True)
 
-output_files = {
-    'lp_items': '/shared-output/lp_items_{}_{}.csv',
-    'pages': '/shared-output/pages_{}_{}.csv',
-    'llm_items': '/shared-output/llm_items_{}_{}.csv',
-    'ads': '/shared-output/ads_{}_{}.csv',
-    'ed_comics': '/shared-output/ed_comics_{}_{}.csv',
-    'errors': '/shared-output/errors_{}_{}.csv',
-}
+# one rolling parquet file per stream (see result_writer); rows are
+# buffered there until the file holding them is finalized
+writer = result_writer.ResultWriter(
+    worker_id, ['lp_items', 'lp_pages', 'pages', 'llm_items', 'ads', 'ed_comics', 'errors'])
 
-def save_results():
-    """Save current results to CSV"""
+# each finished page is journaled and its task acked once the journal is
+# synced (see result_journal.py); pages journaled by a worker that died
+# before its files were finalized are replayed into the writer first
+def recover_journals():
+    try:
+        r = get_redis_connection()
+        live = task_queue.live_workers(r, queue_name, max_age=result_journal.JOURNAL_STALE_SECONDS)
+    except Exception as e:
+        logger.warning(f"Could not read worker heartbeats, recovering by journal age only: {str(e)}")
+        live = {}
+    try:
+        pages = result_journal.recover(writer, worker_id, live)
+        if pages:
+            logger.info(f"Recovered {pages} journaled pages from stopped workers")
+    except Exception as e:
+        logger.error(f"Journal recovery failed: {str(e)}")
 
-    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S%f')
+recover_journals()
+journal = result_journal.Journal(worker_id)
 
-    for data in [(lp_results, 'lp_items'),(page_results,'pages'),
-        (llm_item_results,'llm_items'),(ad_results,'ads'),
-        (edc_results,'ed_comics'),(error_results,'errors')]:
-        if data[0]:
-            fn = output_files[data[1]].format(worker_id, timestamp)
-            pd.DataFrame(data[0]).to_csv(fn, index=False)
-            logger.info(f"Saved {len(data[0])} {fn}")
+def result_lists():
+    return {'lp_items': lp_results, 'lp_pages': lp_page_results, 'pages': page_results, 'llm_items': llm_item_results,
+            'ads': ad_results, 'ed_comics': edc_results, 'errors': error_results}
 
-    logger.info(f"Results saved successfully")
+def save_results(finalize=False):
+    """Hand current results to the writer; returns journaled tasks not yet acked
+    once everything is in finalized files"""
+
+    writer.write(result_lists())
+    if finalize:
+        writer.finalize()
+    if writer.holding():
+        return []
 
+    # every journaled page is now in a finalized file
+    saved = journal.reset()
+    logger.info(f"Results saved successfully")
+    writer.log_stats()
+    journal.log_stats()
+    redis_pool.log_connection_stats(worker_id)
+    pipeline.log_stats()
+    page_fetch.log_cache_stats()
+    encoding.log_memo_stats()
+    json_extract.log_extract_stats()
+    llm_limiter.log_stats()
+    rate_limit.log_stats()
+    llm_cache.log_cache_stats()
+    return saved
+
+def flush_results(finalize=False):
+    """Save results, ack any tasks still waiting on the journal, and reset lists to keep memory free"""
+    global lp_results, lp_page_results, page_results, llm_item_results, ad_results, edc_results
+    global error_results
+
+    saved = save_results(finalize)
+
+    # Mark tasks as completed only once their results are on disk
+    if saved:
+        complete_task(saved)
+
+    lp_results = []
+    lp_page_results = []
+    page_results = []
+    llm_item_results = []
+    ad_results = []
+    edc_results = []
+    error_results = []
+
+
+# Prefetch pipeline: lease PREFETCH_TASKS ahead, download pages on a small
+# pool and run layout detection on its own thread while the main loop works
+# through LLM calls. PREFETCH_TASKS=0 runs fetch/detect inline per task.
+PREFETCH_TASKS = int(os.environ.get('PREFETCH_TASKS', 2))
+FETCH_WORKERS = int(os.environ.get('FETCH_WORKERS', 2))
+
+page_pipeline = pipeline.run_pipeline(
+    get_next_task,
+    lambda task: get_image(task['pid']),
+    lambda task, image: detect_lp(task['pid'], task['identifier'], image),
+    prefetch=PREFETCH_TASKS, fetch_workers=FETCH_WORKERS,
+    batch_detect=lambda tasks, images: detect_lp_batch(
+        [(t['pid'], t['identifier'], image) for t, image in zip(tasks, images)]),
+    batch_size=layout.LP_BATCH_SIZE)
 
 # Main processing loop
 logger.info(f"Worker {worker_id} starting...")
+worker_started = time.time()
 processed_count = 0
 error_count = 0
 consecutive_errors = 0
 
 # Initialize result lists
 lp_results = []
+lp_page_results = []
 page_results = []
 llm_item_results = []
 ad_results = []
 edc_results = []
 error_results = []
-tasks_in_process = []
 
 while True:
     try:
-        # Get next task
-        task = get_next_task()
+        # Get next task - image and LP results were prepared by the pipeline
+        task, image, lp_data, lp_error = next(page_pipeline)
 
         if task == "QUEUE_EMPTY":
             logger.info("Queue is empty, worker exiting")
@@ -515,29 +612,39 @@ while True:
             sys.exit(1)
         elif task is None:
             logger.info("No tasks available, waiting...")
-            time.sleep(10)  # Wait before checking again
-            continue
+            # ack what this worker holds so its own leases don't keep the tail open
+            if writer.holding() or journal.unsynced() or any(result_lists().values()):
+                flush_results(finalize=True)
+            send_heartbeat(processed_count)
+            continue  # the pipeline waits before leasing again
 
         pid = task['pid']
         identifier = task['identifier']
 
         logger.info(f"Processing {pid} (task {processed_count + 1})")
+        profiler = tracing.Profiler(pid, processed_count + 1).start()
+        # where this page's rows start in each result list, for the journal
+        marks = {stream: len(rows) for stream, rows in result_lists().items()}
 
-        # putting try/except here, since run_lp() is the funct that
-        # pulls the img from Islandora
+        # putting try/except here, since the fetch/detect stages are what
+        # pull the img from Islandora
         try:
             # layout parser
-            lp_data, image = run_lp(pid, identifier)
+            if lp_error:
+                raise lp_error
             logger.info("Image retrieved successfully")
             consecutive_errors = 0
 
-            # Store results
-            if lp_data:
+            # Store results (stored LP results are already on the PVC)
+            if LP_SOURCE != 'store':
                 lp_results.extend(lp_data)
+                lp_page_results.append({'pid': pid, 'identifier': identifier, 'boxes': len(lp_data)})
                 logger.info("LP data added")
 
         except Exception as e:
             logger.info(e)
+            profiler.stop()
+            tracing.end(pid, result='error')
             consecutive_errors = log_error(pid, identifier, e, task, error_count, consecutive_errors)
             if consecutive_errors >= 10:
                 logger.error("Too many consecutive errors, exiting")
@@ -549,63 +656,92 @@ while True:
             start_date, end_date = parse_dates(identifier.split('/')[0])
             date_range = f"{start_date} to {end_date}" if start_date and end_date else "unknown"
 
+            # the page's LLM requests are independent: submit them all, then
+            # collect results in submission order (see LLM_MAX_CONCURRENCY)
+            page_future = None
+            item_future = None
+            ad_futures = None
+            edc_futures = None
+            image.load()  # decode once before threads crop from it
+
             # START - comment out to skip page-level LLM (1 of 1)
             # Page metadata - header
-            page_query = llm_query(pid, identifier, date_range, image, header=True)
-            # date = page_query.get('date', date_range)
-            page_results.append({'pid': pid, "identifier": identifier, **page_query})
-            logger.info("Page processed successfully")
+            page_future = submit_llm(pid, identifier, date_range, image, header=True)
             # END - comment out to skip page-level LLM (1 of 1)
 
             # START - comment out to skip item-level LLM (1 of 1)
             # LLM items
-            llm_item_query = llm_query(pid, identifier, date_range, image)
-            if len(llm_item_query.get('items', [])) > 0:
-                for item in llm_item_query['items']:
-                    llm_item_results.append({'pid': pid, "identifier": identifier, **item})
-            logger.info("Items processed successfully")
+            item_future = submit_llm(pid, identifier, date_range, image)
             # END - comment out to skip item-level LLM
 
             # START - comment out to skip ads via LLM (requires layoutparser) (1 of 1)
             # Ads
             lp_ads = [d for d in lp_data if d['type'] == 6]
             xy_coords = ['x_1', 'x_2', 'y_1', 'y_2']
-
-            if len(lp_ads) == 0:
-                ad_results.append({'pid': pid, 'identifier': identifier, 'error': 'No ads found by LLM'})
-            else:
-                for ad_dict in lp_ads:
-                    ad_coords = {k: ad_dict[k] for k in xy_coords if k in ad_dict}
-                    ad_query = llm_query(pid, identifier, date_range, image, coords=('ads',ad_coords))
-                    ad_results.append({'pid': pid, "identifier": identifier, **ad_coords, **ad_query})
-            logger.info("Ads processed successfully")
+            ad_futures = []
+            for ad_dict in lp_ads:
+                ad_coords = {k: ad_dict[k] for k in xy_coords if k in ad_dict}
+                ad_futures.append((ad_coords, submit_llm(pid, identifier, date_range, image, coords=('ads',ad_coords))))
             # END - comment out to skip ads
 
             # START - comment out to skip editorial comics via LLM (requires layoutparser) (1 of 1)
             # editorial comics
 
-            # OPTION A - set lp_edc from existing lp_df
-            # # lp_data = lp_df[(lp_df.pid==pid) & (lp_df.type==4)]
-            # # lp_edc = lp_data.to_dict('records')
-
-            # OPTION B - set lp_edc from just-run lp_data
+            # lp_data is either just-run LP or, with LP_SOURCE=store, the
+            # page's rows from the LP index
             lp_edc = [d for d in lp_data if d['type'] == 4]
             xy_coords = ['x_1', 'x_2', 'y_1', 'y_2']
+            edc_futures = []
+            for edc_dict in lp_edc:
+                edc_coords = {k: edc_dict[k] for k in xy_coords if k in edc_dict}
+                edc_futures.append((edc_coords, submit_llm(pid, identifier, date_range, image, coords=('edc',edc_coords))))
+            # END - comment out to skip editorial comics
 
-            if len(lp_edc) == 0:
-                pass
+            dispatch_llm(image)
+
+            # collect results
+            if page_future:
+                page_query = page_future.result()
+                # date = page_query.get('date', date_range)
+                page_results.append({'pid': pid, "identifier": identifier, **page_query})
+                logger.info("Page processed successfully")
+
+            if item_future:
+                llm_item_query = item_future.result()
+                if len(llm_item_query.get('items', [])) > 0:
+                    for item in llm_item_query['items']:
+                        llm_item_results.append({'pid': pid, "identifier": identifier, **item})
+                logger.info("Items processed successfully")
+
+            if ad_futures is not None:
+                if len(ad_futures) == 0:
+                    ad_results.append({'pid': pid, 'identifier': identifier, 'error': 'No ads found by LLM'})
+                for ad_coords, ad_future in ad_futures:
+                    ad_results.append({'pid': pid, "identifier": identifier, **ad_coords, **ad_future.result()})
+                logger.info("Ads processed successfully")
+
+            if edc_futures:
                 # edc_results.append({'pid': pid, 'identifier': identifier, 'error': 'No editorial comics found by LP'})
-            else:
-                for edc_dict in lp_edc:
-                    edc_coords = {k: edc_dict[k] for k in xy_coords if k in edc_dict}
-                    edc_query = llm_query(pid, identifier, date_range, image, coords=('edc',edc_coords))
-                    edc_results.append({'pid': pid, "identifier": identifier, **edc_coords, **edc_query})
+                for edc_coords, edc_future in edc_futures:
+                    edc_results.append({'pid': pid, "identifier": identifier, **edc_coords, **edc_future.result()})
                 logger.info("Editorial cartoons processed successfully")
-            # END - comment out to skip editorial comics
 
+            pending_llm.clear()
+            encoding.clear_page_memo()
+            profiler.stop()
+            tracing.end(pid, result='ok')
             processed_count += 1
             consecutive_errors = 0  # Reset error counter on success
-            logger.info(f"Successfully processed {pid} ({processed_count} total)")
+            metrics.inc('tasks_total', result='ok')
+            journal.append(task, {stream: rows[marks[stream]:] for stream, rows in result_lists().items()})
+            # ack pages once their journal lines are on disk (every JOURNAL_FSYNC_SECONDS)
+            durable = journal.sync()
+            if durable:
+                complete_task(durable)
+            renew_leases(journal.unsynced() + pipeline.in_flight)
+            send_heartbeat(processed_count)
+            rss, peak = page_fetch.memory_mb()
+            logger.info(f"Successfully processed {pid} ({processed_count} total, rss={rss:.0f}MB, peak={peak:.0f}MB)")
 
             # optional logging to keep running count
             for data in [(lp_results, 'lp_items'),(page_results,'pages'),
@@ -615,6 +751,10 @@ while True:
                     logger.info(f"  -- Current count: {len(data[0])} {data[1]}")
 
         except Exception as e:
+            cancel_llm_queries()
+            encoding.clear_page_memo()
+            profiler.stop()
+            tracing.end(pid, result='error')
             consecutive_errors = log_error(pid, identifier, e, task, error_count, consecutive_errors)
             logger.info(e)
             if consecutive_errors >= 10:
@@ -623,26 +763,8 @@ while True:
             continue
 
         # save every ## items
-        # uncomment "if" and indent the next block
         if processed_count % 20 == 0:
-
-            # START indent
-            # Save results
-            save_results()
-
-            # Mark task as completed
-            for task in tasks_in_process:
-                complete_task(task)
-
-            # reset lists to keep memory free
-            lp_results = []
-            page_results = []
-            llm_item_results = []
-            ad_results = []
-            edc_results = []
-            error_results = []
-            tasks_in_process = []
-            # END indent
+            flush_results()
 
     except KeyboardInterrupt:
         logger.info("Worker interrupted by user")
@@ -653,19 +775,20 @@ while True:
 
 # Final save and summary
 logger.info("Saving final results...")
-save_results()
-# Mark task as completed
-for task in tasks_in_process:
-    complete_task(task)
+flush_results(finalize=True)
+journal.close()
 logger.info(f"Worker {worker_id} completed. Processed: {processed_count}, Errors: {error_count}")
 
 # Final queue status check
 try:
     r = get_redis_connection()
-    main_remaining = r.llen('newspaper-jobs')
-    processing_remaining = r.llen('newspaper-jobs:processing')
-    logger.info(f"Final queue status: main={main_remaining}, processing={processing_remaining}")
+    task_queue.release_leases(r, queue_name)
+    task_queue.remove_worker(r, queue_name, worker_id)
+    status = task_queue.queue_status(r, queue_name)
+    logger.info(f"Final queue status: main={status['pending']}, processing={status['processing']}, failed={status['failed']}")
 except:
     pass
 
+redis_pool.log_connection_stats(worker_id)
+metrics.flush(worker_id)
 logger.info(f"Worker {worker_id} exiting")
@@ -21,36 +21,25 @@ import sys
 
 # Import your prompts
 import prompts
+import redis_pool
+import task_queue
+import layout
+import page_fetch
+import result_writer
+import metrics
 
 # Redis queue with improved error handling
+# connections come from a shared pool so each call doesn't open a new socket
 def get_redis_connection():
-    redis_host = os.environ.get('REDIS_HOST', 'redis-service-lp')
-    return redis.Redis(host=redis_host, port=6379, db=0, socket_timeout=10, socket_connect_timeout=10)
+    return redis_pool.get_redis_connection('redis-service-lp')
+
+queue_name = 'newspaper-jobs-lp'
 
 def get_next_task():
-    """Get next PID from queue using BRPOPLPUSH for safety"""
+    """Lease next PID from queue (see task_queue for stream vs list backend)"""
     try:
         r = get_redis_connection()
-        # Move from main queue to processing queue (atomic operation)
-        result = r.brpoplpush('newspaper-jobs-lp', 'newspaper-jobs-lp:processing', timeout=60)
-        if result:
-            return json.loads(result.decode('utf-8'))
-        else:
-            # Check if both queues are empty
-            main_queue_length = r.llen('newspaper-jobs-lp')
-            processing_queue_length = r.llen('newspaper-jobs-lp:processing')
-            logger.info(f"Queue status: main={main_queue_length}, processing={processing_queue_length}")
-
-            if main_queue_length == 0 and processing_queue_length == 0:
-                logger.info("All queues empty - no more work")
-                return "QUEUE_EMPTY"
-            elif main_queue_length == 0:
-                logger.info("Main queue empty, but items still processing elsewhere")
-                return "QUEUE_EMPTY"
-            else:
-                logger.info("Queue not empty but no task received, retrying...")
-                return None
-
+        return task_queue.next_task(r, queue_name, worker_id)
     except redis.ConnectionError as e:
         logger.error(f"Redis connection failed: {str(e)}")
         return "REDIS_ERROR"
@@ -58,28 +47,35 @@ def get_next_task():
         logger.error(f"Redis error: {str(e)}")
         return "REDIS_ERROR"
 
-def complete_task(task):
-    """Remove completed task from processing queue"""
+def complete_task(tasks):
+    """Ack completed tasks so they leave the processing set"""
+    try:
+        r = get_redis_connection()
+        task_queue.complete_tasks(r, queue_name, tasks)
+    except Exception as e:
+        logger.warning(f"Could not complete {len(tasks)} tasks: {str(e)}")
+
+def renew_leases(tasks):
+    """Keep leases on finished-but-unsaved tasks from being reclaimed"""
     try:
         r = get_redis_connection()
-        task_str = json.dumps(task, sort_keys=True)
-        removed = r.lrem('newspaper-jobs-lp:processing', 1, task_str)
-        # if removed:
-        #     logger.debug(f"Task {task['pid']} marked as completed")
-        # else:
-        #     logger.warning(f"Could not find task {task['pid']} in processing queue")
+        task_queue.renew_leases(r, queue_name, worker_id, tasks)
     except Exception as e:
-        logger.warning(f"Could not complete task {task.get('pid', 'unknown')}: {str(e)}")
+        logger.warning(f"Could not renew leases: {str(e)}")
+
+def send_heartbeat(processed):
+    """Per-worker progress for monitor_queue.py"""
+    try:
+        r = get_redis_connection()
+        task_queue.heartbeat(r, queue_name, worker_id, started=worker_started, processed=processed)
+    except Exception as e:
+        logger.warning(f"Could not send heartbeat: {str(e)}")
 
 def fail_task(task):
     """Move failed task back to main queue for potential retry"""
     try:
         r = get_redis_connection()
-        task_str = json.dumps(task, sort_keys=True)
-        # Remove from processing queue
-        r.lrem('newspaper-jobs-lp:processing', 1, task_str)
-        # Add back to main queue for retry (optional)
-        r.lpush('newspaper-jobs-lp', task_str)
+        task_queue.fail_task(r, queue_name, task)
         logger.debug(f"Task {task['pid']} marked as failed")
     except Exception as e:
         logger.warning(f"Could not fail task {task.get('pid', 'unknown')}: {str(e)}")
@@ -118,48 +114,25 @@ except Exception as e:
     logger.error(f"Failed to load layoutparser model: {str(e)}")
     sys.exit(1)
 
-# highlight specific columns from lp
-def filter_lp(results):
-    max_items = {}
-    for item in results:
-        key = (item['x_1'], item['y_1'], item['x_2'], item['y_2'])
-        if key not in max_items or item['score'] > max_items[key]['score']:
-            max_items[key] = item
-    return list(max_items.values())
+# LP_DECODE_SCALE=2 (or 4) decodes pages at 1/2 (1/4) size for detection;
+# boxes are scaled back up to full-resolution coordinates
+LP_DECODE_SCALE = int(os.environ.get('LP_DECODE_SCALE', 1))
+
+def get_page_array(pid):
+    # 'JP2' if available, otherwise 'OBJ' as fallback; raises for HTTP errors
+    image, reduced_by = page_fetch.open_page_image(pid, scale=LP_DECODE_SCALE)
+    # asarray avoids the extra copy np.array makes; the PIL image is dropped
+    return np.asarray(image), reduced_by
 
 def run_lp(pid, identifier):
-    # Return 'JP2' if available, otherwise 'OBJ' as fallback
-    try:
-        url = f'https://digital.lib.ku.edu/islandora/object/{pid}/datastream/JP2/view'
-        r = requests.head(url, timeout=5, allow_redirects=True)
-        if r.status_code != 200:
-            url = f'https://digital.lib.ku.edu/islandora/object/{pid}/datastream/OBJ/view'
-    except Exception as e:
-        url = f'https://digital.lib.ku.edu/islandora/object/{pid}/datastream/OBJ/view'
-    response = requests.get(url, timeout=60)  # Add timeout
-    response.raise_for_status()  # Raise exception for HTTP errors
-
-    image = Image.open(io.BytesIO(response.content))
-    if image.mode != 'RGB':
-        image = image.convert('RGB')
-    image_for_lp = np.array(image)
-    layout = lp_model.detect(image_for_lp)
-
-    results = []
-    for l in layout:
-        results.append({
-            'x_1': l.block.x_1, 'y_1': l.block.y_1, 'x_2': l.block.x_2, 'y_2': l.block.y_2,
-            'score': l.score, 'type': l.type,
-            'identifier': identifier, 'pid': pid,
-        })
-
-    results = filter_lp(results)
-    return results
+    page, reduced_by = get_page_array(pid)
+    return layout.detect_pages(lp_model, [(pid, identifier, page, reduced_by)])[0]
 
 def log_error(pid, identifier, e, task, error_count, consecutive_errors):
     error_count += 1
     consecutive_errors += 1
     logger.error(f"Error processing {pid}: {str(e)}")
+    metrics.inc('tasks_total', result='error')
 
     error_results.append({
         'pid': pid,
@@ -179,36 +152,41 @@ def log_error(pid, identifier, e, task, error_count, consecutive_errors):
 # Setup output files
 worker_id = os.environ.get('HOSTNAME', 'worker-unknown')
 
+# METRICS_PORT / METRICS_FILE (see metrics.py)
+metrics.serve(worker_id)
+
 # Ensure output directory exists
 os.makedirs('/shared-output', exist_ok=True)
 
-output_files = {
-    'lp_items': '/shared-output/lp_items_{}_{}.csv',
-    'errors': '/shared-output/errors_{}_{}.csv',
-}
+# one rolling parquet file per stream (see result_writer); rows are
+# buffered there and tasks acked once the file holding them is finalized
+writer = result_writer.ResultWriter(worker_id, ['lp_items', 'lp_pages', 'errors'])
 
-def save_results():
-    """Save current results to CSV"""
+def save_results(tasks=(), finalize=False):
+    """Hand current results to the writer; returns tasks whose results are on disk"""
 
-    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S%f')
+    saved = writer.write({'lp_items': lp_results, 'lp_pages': lp_page_results, 'errors': error_results}, tasks)
+    if finalize:
+        saved += writer.finalize()
 
-    for data in [(lp_results, 'lp_items'),(error_results,'errors')]:
-        if data[0]:
-            fn = output_files[data[1]].format(worker_id, timestamp)
-            pd.DataFrame(data[0]).to_csv(fn, index=False)
-            logger.info(f"Saved {len(data[0])} {fn}")
-
-    logger.info(f"Results saved successfully")
+    if saved:
+        logger.info(f"Results saved successfully")
+        writer.log_stats()
+        redis_pool.log_connection_stats(worker_id)
+        page_fetch.log_cache_stats()
+    return saved
 
 
 # Main processing loop
 logger.info(f"Worker {worker_id} starting...")
+worker_started = time.time()
 processed_count = 0
 error_count = 0
 consecutive_errors = 0
 
 # Initialize result lists
 lp_results = []
+lp_page_results = []  # every page detected, so the LP store knows a page with no boxes was done
 error_results = []
 
 while True:
@@ -224,26 +202,52 @@ while True:
             sys.exit(1)
         elif task is None:
             logger.info("No tasks available, waiting...")
+            send_heartbeat(processed_count)
+            # finalize so this worker's own leases don't keep the tail open
+            if writer.unacked():
+                complete_task(save_results(finalize=True))
             time.sleep(10)  # Wait before checking again
             continue
 
-        pid = task['pid']
-        identifier = task['identifier']
-
-        logger.info(f"Processing {pid} (task {processed_count + 1})")
+        # lease up to LP_BATCH_SIZE tasks so detection runs them in one forward pass
+        tasks = [task]
+        while len(tasks) < layout.LP_BATCH_SIZE:
+            extra = get_next_task()
+            if not isinstance(extra, dict):
+                break
+            tasks.append(extra)
 
-        # putting try/except here, since run_lp() is the funct that
+        # putting try/except here, since get_page_array() is the funct that
         # pulls the img from Islandora
+        pages = []
+        worker_failed = False
+        for task in tasks:
+            pid = task['pid']
+            identifier = task['identifier']
+            logger.info(f"Processing {pid} (task {processed_count + len(pages) + 1})")
+            try:
+                with metrics.timer('stage_seconds', stage='fetch'):
+                    pages.append((task, *get_page_array(pid)))
+            except Exception as e:
+                consecutive_errors = log_error(pid, identifier, e, task, error_count, consecutive_errors)
+                logger.info(e)
+                worker_failed = True
+
         try:
             # layout parser
-            lp_data = run_lp(pid, identifier)
+            with metrics.timer('stage_seconds', stage='detect'):
+                lp_batch = layout.detect_pages(
+                    lp_model, [(t['pid'], t['identifier'], image, reduced_by) for t, image, reduced_by in pages])
+            rss, peak = page_fetch.memory_mb()
 
             # Store results
-            lp_results.extend(lp_data)
-
-            processed_count += 1
-            consecutive_errors = 0  # Reset error counter on success
-            logger.info(f"Successfully processed {pid} ({processed_count} total)")
+            for (task, _, _), lp_data in zip(pages, lp_batch):
+                lp_results.extend(lp_data)
+                lp_page_results.append({'pid': task['pid'], 'identifier': task['identifier'], 'boxes': len(lp_data)})
+                processed_count += 1
+                consecutive_errors = 0  # Reset error counter on success
+                metrics.inc('tasks_total', result='ok')
+                logger.info(f"Successfully processed {task['pid']} ({processed_count} total, rss={rss:.0f}MB, peak={peak:.0f}MB)")
 
             # optional logging to keep running count
             for data in [(lp_results, 'lp_items'),(error_results,'errors')]:
@@ -251,20 +255,28 @@ while True:
                     logger.info(f"  -- Current count: {len(data[0])} {data[1]}")
 
         except Exception as e:
-            consecutive_errors = log_error(pid, identifier, e, task, error_count, consecutive_errors)
+            for task, _, _ in pages:
+                consecutive_errors = log_error(task['pid'], task['identifier'], e, task, error_count, consecutive_errors)
             logger.info(e)
-            break
-
-        # Save results
-        save_results()
+            pages = []
+            worker_failed = True
 
-        # Mark task as completed
-        complete_task(task)
+        # Save results; tasks are acked once the file with their rows is finalized
+        saved = save_results([task for task, _, _ in pages])
+        if saved:
+            complete_task(saved)
+        # acks can wait up to OUTPUT_ROTATE_SECONDS, so keep the rest leased meanwhile
+        renew_leases(writer.unacked())
+        send_heartbeat(processed_count)
 
         # reset lists to keep memory free
         lp_results = []
+        lp_page_results = []
         error_results = []
 
+        if worker_failed:
+            break
+
     except KeyboardInterrupt:
         logger.info("Worker interrupted by user")
         break
@@ -274,16 +286,21 @@ while True:
 
 # Final save and summary
 logger.info("Saving final results...")
-save_results()
+saved = save_results(finalize=True)
+if saved:
+    complete_task(saved)
 logger.info(f"Worker {worker_id} completed. Processed: {processed_count}, Errors: {error_count}")
 
 # Final queue status check
 try:
     r = get_redis_connection()
-    main_remaining = r.llen('newspaper-jobs-lp')
-    processing_remaining = r.llen('newspaper-jobs-lp:processing')
-    logger.info(f"Final queue status: main={main_remaining}, processing={processing_remaining}")
+    task_queue.release_leases(r, queue_name)
+    task_queue.remove_worker(r, queue_name, worker_id)
+    status = task_queue.queue_status(r, queue_name)
+    logger.info(f"Final queue status: main={status['pending']}, processing={status['processing']}, failed={status['failed']}")
 except:
     pass
 
+redis_pool.log_connection_stats(worker_id)
+metrics.flush(worker_id)
 logger.info(f"Worker {worker_id} exiting")